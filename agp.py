@@ -0,0 +1,316 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file computes an Ambulatory Glucose Profile (AGP) : the 5th, 25th,
+# 50th, 75th and 95th percentiles of glucose by local time of day, over the
+# last 14 or 90 days.
+#
+# The readings for the whole range are read in one query, into numpy arrays.
+# Each reading's local time of day is found with about two time zone lookups
+# per day of data, rather than one per reading, and all the percentiles of
+# all the time of day bins come from a single sort.
+#
+# Profiles are cached by database, range, time shift, time zone and bin size,
+# along with the database's change count, so a new download makes the cached
+# profiles of that database stale.
+#
+# GetProfile() is the headless API. dexctrack draws a profile over the graph,
+# repeated for each day shown, when the overlay is turned on.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import datetime
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pytz
+
+import changefeed
+import constants
+import dbschema
+
+SECONDS_PER_DAY = 60 * 60 * 24
+MINUTES_PER_DAY = 60 * 24
+PERCENTILES = (5, 25, 50, 75, 95)
+DEFAULT_BIN_MINUTES = 15
+# Time zone offsets only change on the hour or half hour, so on a day with
+# a daylight saving change, one lookup per half hour of readings is enough
+TZ_LOOKUP_SECONDS = 30 * 60
+# The number of profiles to keep in the cache
+MAX_CACHED_PROFILES = 8
+UTC_BASE_TIME = datetime.datetime(*constants.BASE_TIME.timetuple()[:6], tzinfo=pytz.UTC)
+
+
+class Profile(object):
+    """Glucose percentiles by local time of day.
+
+    Attributes:
+        binMinutes: the width of each time of day bin
+        binStarts: minutes after local midnight at which each bin starts
+        percentiles: the percentiles held, such as (5, 25, 50, 75, 95)
+        values: an array of shape (len(percentiles), bins) in mg/dL, with
+                NaN for bins which have no readings
+        counts: the number of readings in each bin
+        startSecs, endSecs: the range of receiver seconds covered
+        days: the length of the range, in days
+        tzName: the time zone the bins are in
+    """
+
+    def __init__(self, binMinutes, percentiles, values, counts, startSecs, endSecs, tzName):
+        self.binMinutes = binMinutes
+        self.binStarts = np.arange(0, MINUTES_PER_DAY, binMinutes)
+        self.percentiles = tuple(percentiles)
+        self.values = values
+        self.counts = counts
+        self.startSecs = startSecs
+        self.endSecs = endSecs
+        self.days = (endSecs - startSecs) / float(SECONDS_PER_DAY)
+        self.tzName = tzName
+
+    def curve(self, percentile):
+        """The values of one percentile, for each bin"""
+        return self.values[self.percentiles.index(percentile)]
+
+    def readingCount(self):
+        return int(self.counts.sum())
+
+    def __repr__(self):
+        return 'Profile(%g days, %d readings, %d minute bins, %s)' % (
+            self.days, self.readingCount(), self.binMinutes, self.tzName)
+
+
+def TzName(tz):
+    # pytz zones have a 'zone' name, and zoneinfo zones a 'key'
+    return getattr(tz, 'zone', None) or getattr(tz, 'key', None) or str(tz)
+
+
+def LoadReadings(curs, startSecs, endSecs, offsetSeconds=0):
+    """Read the real glucose readings with sysSeconds + offsetSeconds in
+    [startSecs, endSecs).
+
+    Returns:
+        (secs, glucose), as numpy int64 and float64 arrays, with offsetSeconds
+        included in secs
+    """
+    curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE glucose > 12 AND sysSeconds >= ? AND sysSeconds < ?'
+                 ' ORDER BY sysSeconds', (int(startSecs - offsetSeconds), int(endSecs - offsetSeconds)))
+    rows = curs.fetchall()
+    # np.fromiter() over the flattened rows is several times faster than np.array(rows)
+    flat = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)).reshape(-1, 2)
+    return (flat[:, 0] + offsetSeconds, flat[:, 1].astype(np.float64))
+
+
+def _utcOffset(tz, secs):
+    utcTime = UTC_BASE_TIME + datetime.timedelta(seconds=int(secs))
+    return int(utcTime.astimezone(tz).utcoffset().total_seconds())
+
+
+def LocalMinuteOfDay(secs, tz):
+    """Find the local time of day, in minutes after midnight, of each of an
+    array of receiver seconds."""
+    secs = np.asarray(secs, dtype=np.int64)
+    if len(secs) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Look up the offset at the start of each day, and the next. Only days
+    # where those differ, which hold a daylight saving change, need a
+    # lookup for each half hour.
+    (days, dayInverse) = np.unique(secs // SECONDS_PER_DAY, return_inverse=True)
+    dayInverse = dayInverse.reshape(-1)
+    startOffsets = np.array([_utcOffset(tz, day * SECONDS_PER_DAY) for day in days], dtype=np.int64)
+    endOffsets = np.array([_utcOffset(tz, (day + 1) * SECONDS_PER_DAY) for day in days], dtype=np.int64)
+    offsets = startOffsets[dayInverse]
+    for changeDay in np.nonzero(startOffsets != endOffsets)[0]:
+        inDay = np.nonzero(dayInverse == changeDay)[0]
+        (blocks, blockInverse) = np.unique(secs[inDay] // TZ_LOOKUP_SECONDS, return_inverse=True)
+        blockOffsets = np.array([_utcOffset(tz, block * TZ_LOOKUP_SECONDS) for block in blocks], dtype=np.int64)
+        offsets[inDay] = blockOffsets[blockInverse.reshape(-1)]
+    localSecs = secs + offsets
+    # BASE_TIME is a UTC midnight, so local days start at multiples of a day
+    return (localSecs % SECONDS_PER_DAY) // 60
+
+
+def ComputeProfile(secs, glucose, tz, binMinutes=DEFAULT_BIN_MINUTES, percentiles=PERCENTILES,
+                   startSecs=None, endSecs=None):
+    """Compute the percentiles of glucose for each time of day bin.
+
+    Percentiles are interpolated linearly, as np.percentile() does by default.
+
+    Returns:
+        A Profile
+    """
+    if MINUTES_PER_DAY % binMinutes:
+        raise ValueError('binMinutes must divide a day evenly, not %s' % binMinutes)
+    bins = MINUTES_PER_DAY // binMinutes
+    glucose = np.asarray(glucose, dtype=np.float64)
+    binIndex = LocalMinuteOfDay(secs, tz) // binMinutes
+
+    # Sort by bin, then by glucose, so each bin's readings are together and in order
+    order = np.lexsort((glucose, binIndex))
+    sortedGluc = glucose[order]
+    counts = np.bincount(binIndex, minlength=bins)
+    firsts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    values = np.full((len(percentiles), bins), np.nan)
+    present = counts > 0
+    for (row, percentile) in enumerate(percentiles):
+        # Fractional position of the percentile within each bin's readings
+        position = firsts[present] + (counts[present] - 1) * (percentile / 100.0)
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, firsts[present] + counts[present] - 1)
+        fraction = position - below
+        values[row, present] = sortedGluc[below] * (1.0 - fraction) + sortedGluc[above] * fraction
+
+    if startSecs is None:
+        startSecs = int(secs[0]) if len(secs) else 0
+    if endSecs is None:
+        endSecs = int(secs[-1]) + 1 if len(secs) else 0
+    return Profile(binMinutes, percentiles, values, counts, startSecs, endSecs, TzName(tz))
+
+
+class ProfileCache(object):
+    """Recently computed profiles, keyed by (dbPath, startSecs, endSecs,
+    offsetSeconds, time zone name, binMinutes) and the database's change count."""
+
+    def __init__(self, maxProfiles=MAX_CACHED_PROFILES):
+        self.maxProfiles = maxProfiles
+        self._lock = threading.Lock()
+        self._profiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            profile = self._profiles.pop(key, None)
+            if profile is None:
+                self.misses += 1
+                return None
+            self._profiles[key] = profile
+            self.hits += 1
+            return profile
+
+    def put(self, key, profile):
+        with self._lock:
+            self._profiles.pop(key, None)
+            self._profiles[key] = profile
+            while len(self._profiles) > self.maxProfiles:
+                self._profiles.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+
+defaultCache = ProfileCache()
+
+
+def GetProfile(dbPath, endSecs, days=14, tz=pytz.UTC, offsetSeconds=0,
+               binMinutes=DEFAULT_BIN_MINUTES, curs=None, cache=defaultCache):
+    """Get the profile of the 'days' days before endSecs, from the cache if
+    possible.
+
+    Args:
+        dbPath: the database file
+        endSecs: the end of the range, in receiver seconds, including offsetSeconds
+        days: the length of the range, usually 14 or 90
+        tz: the local time zone
+        offsetSeconds: time shift added to each reading's sysSeconds
+        binMinutes: the width of each time of day bin
+        curs: optional cursor to read with. Otherwise, a read-only
+              connection is opened and closed.
+        cache: a ProfileCache, or None
+
+    Returns:
+        A Profile
+    """
+    endSecs = int(endSecs)
+    startSecs = endSecs - int(days * SECONDS_PER_DAY)
+    key = (dbPath, startSecs, endSecs, offsetSeconds, TzName(tz), binMinutes, changefeed.ChangeCount(dbPath))
+    if cache is not None:
+        profile = cache.get(key)
+        if profile is not None:
+            return profile
+
+    if curs is None:
+        conn = dbschema.ReadOnlyConnection(dbPath)
+        try:
+            (secs, glucose) = LoadReadings(conn.cursor(), startSecs, endSecs, offsetSeconds)
+        finally:
+            conn.close()
+    else:
+        (secs, glucose) = LoadReadings(curs, startSecs, endSecs, offsetSeconds)
+
+    profile = ComputeProfile(secs, glucose, tz, binMinutes, startSecs=startSecs, endSecs=endSecs)
+    if cache is not None:
+        cache.put(key, profile)
+    return profile
+
+
+if __name__ == '__main__':
+    # Print the profile of a database, by hour, and compare the time taken
+    # with binning each reading's datetime and calling np.percentile() per bin.
+    import sys
+    import time
+    import tzlocal
+
+    if len(sys.argv) < 2:
+        print('Usage: %s <database file> [days]' % sys.argv[0])
+        sys.exit(1)
+    dbPath = sys.argv[1]
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 14
+    tz = tzlocal.get_localzone()
+
+    conn = dbschema.ReadOnlyConnection(dbPath)
+    curs = conn.cursor()
+    curs.execute('SELECT MAX(sysSeconds) FROM EgvRecord')
+    endSecs = curs.fetchone()[0] + 1
+
+    startTime = time.time()
+    profile = GetProfile(dbPath, endSecs, days, tz, curs=curs)
+    firstTime = time.time() - startTime
+    startTime = time.time()
+    GetProfile(dbPath, endSecs, days, tz, curs=curs)
+    cachedTime = time.time() - startTime
+
+    # The per reading way
+    startTime = time.time()
+    curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE glucose > 12 AND sysSeconds >= ? AND sysSeconds < ?',
+                 (profile.startSecs, profile.endSecs))
+    binned = [[] for b in profile.binStarts]
+    for (sysSeconds, glucose) in curs.fetchall():
+        local = (UTC_BASE_TIME + datetime.timedelta(seconds=sysSeconds)).astimezone(tz)
+        binned[(local.hour * 60 + local.minute) // profile.binMinutes].append(glucose)
+    slowValues = np.array([np.percentile(b, PERCENTILES) if b else [np.nan] * len(PERCENTILES)
+                           for b in binned]).T
+    slowTime = time.time() - startTime
+    conn.close()
+
+    print('%s in %s' % (profile, dbPath))
+    print(' Time   ' + ''.join('%7d%%' % p for p in PERCENTILES) + '  readings')
+    for b in range(0, len(profile.binStarts), 60 // profile.binMinutes):
+        print('%02d:%02d  ' % divmod(profile.binStarts[b], 60) +
+              ''.join('%8.0f' % v for v in profile.values[:, b]) + '%10d' % profile.counts[b])
+    agree = np.allclose(profile.values, slowValues, equal_nan=True)
+    print('Vectorized %.4f s, cached %.6f s, per reading %.4f s (%.0fx), results agree = %s' %
+          (firstTime, cachedTime, slowTime, slowTime / max(firstTime, 1e-9), agree))
+    sys.exit(0 if agree else 1)
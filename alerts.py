@@ -0,0 +1,431 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file raises local alerts for low, high, rapidly rising or rapidly
+# falling glucose, and for glucose which is projected to go low or high
+# soon. The limits come from the receiver's own alert settings, as read by
+# GetCurrentUserSettings(), or else from the displayed target range.
+#
+# An AlertEngine subscribes to the change feed, so each new EgvRecord is
+# checked on the download thread, right after it's committed, whether or
+# not the graph is being drawn. Each database keeps a small, fixed amount
+# of state : an order 1 trend.KalmanTrend for the rate of change, and which
+# alerts are currently active. An alert is raised when its condition starts,
+# and can't be raised again until the condition has cleared.
+#
+# Alerts are passed to hooks. CommandHook runs a shell command, with the
+# details of the alert in environment variables, and DesktopHook shows a
+# desktop notification. Hooks start programs without waiting for them, so
+# the download thread isn't held up.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import datetime
+import os
+import subprocess
+import sys
+import threading
+from traceback import print_exc
+
+import changefeed
+import trend
+
+LOW = 'low'
+HIGH = 'high'
+FALL = 'fall'
+RISE = 'rise'
+LOW_SOON = 'lowSoon'
+HIGH_SOON = 'highSoon'
+
+# Predict a low or high this many minutes ahead
+DEFAULT_PREDICT_MINUTES = 20
+# Once an alert is active, glucose must come back this far past the limit,
+# or the rate this far under the limit, for it to clear. This stops noise
+# around a limit from raising the same alert over and over.
+GLUCOSE_HYSTERESIS = 5
+RATE_HYSTERESIS = 0.5
+# Only readings this close to the newest one in a download raise alerts.
+# Older readings, such as the history read when a receiver is first seen,
+# only update the trend. A long download is published in several batches,
+# so this is measured from the newest reading of the whole download.
+FRESH_SECONDS = 15 * 60
+# Default limits, used until the receiver's own settings have been read
+DEFAULT_LOW_ALERT = 70
+DEFAULT_HIGH_ALERT = 200
+# Rate and projected alerts wait until this many readings have gone
+# into the trend filter
+MIN_TREND_READINGS = 3
+
+
+class AlertSettings(object):
+    """Alert limits, in mg/dL and mg/dL per minute. A limit of 0 or None
+    is turned off. The glucose limits default to DEFAULT_LOW_ALERT and
+    DEFAULT_HIGH_ALERT.
+
+    Args:
+        lowAlert: raise LOW at or below this glucose
+        highAlert: raise HIGH at or above this glucose
+        fallRate: raise FALL when falling at least this fast
+        riseRate: raise RISE when rising at least this fast
+        predictMinutes: raise LOW_SOON or HIGH_SOON when the current trend
+                        crosses a limit within this many minutes
+    """
+
+    def __init__(self, lowAlert=DEFAULT_LOW_ALERT, highAlert=DEFAULT_HIGH_ALERT, fallRate=None, riseRate=None,
+                 predictMinutes=DEFAULT_PREDICT_MINUTES):
+        self.lowAlert = lowAlert or None
+        self.highAlert = highAlert or None
+        self.fallRate = fallRate or None
+        self.riseRate = riseRate or None
+        self.predictMinutes = predictMinutes
+
+    def __repr__(self):
+        return 'AlertSettings(low=%s, high=%s, fall=%s, rise=%s, predict=%s min)' % (
+            self.lowAlert, self.highAlert, self.fallRate, self.riseRate, self.predictMinutes)
+
+
+def SettingsFromReceiver(userSettings, displayLow=None, displayHigh=None):
+    """Build AlertSettings from the tuple returned by GetCurrentUserSettings().
+    Where the receiver didn't give a glucose limit, displayLow and displayHigh
+    (in mg/dL) are used instead.
+
+    Args:
+        userSettings: (transmitterPaired, highAlert, lowAlert, riseRate, fallRate, outOfRangeAlert, status)
+    """
+    (paired, highAlert, lowAlert, riseRate, fallRate, outOfRange, status) = userSettings
+    if status != 0:
+        highAlert = lowAlert = riseRate = fallRate = None
+    return AlertSettings(lowAlert=lowAlert or displayLow,
+                         highAlert=highAlert or displayHigh,
+                         fallRate=fallRate, riseRate=riseRate)
+
+
+class Alert(object):
+    """One alert.
+
+    Attributes:
+        kind: LOW, HIGH, FALL, RISE, LOW_SOON or HIGH_SOON
+        dbPath: the database the reading went into
+        sysSeconds: the receiver's system time of the reading
+        glucose: the reading, in mg/dL
+        rate: the estimated rate of change, in mg/dL per minute, or None
+        minutes: for LOW_SOON and HIGH_SOON, the projected minutes until
+                 the limit is crossed, otherwise None
+        limit: the setting which was crossed
+    """
+
+    def __init__(self, kind, dbPath, sysSeconds, glucose, rate, minutes, limit):
+        self.kind = kind
+        self.dbPath = dbPath
+        self.sysSeconds = sysSeconds
+        self.glucose = glucose
+        self.rate = rate
+        self.minutes = minutes
+        self.limit = limit
+        self.raisedTime = datetime.datetime.now()
+
+    def message(self):
+        if self.kind == LOW:
+            return 'Low glucose : %d mg/dL' % self.glucose
+        if self.kind == HIGH:
+            return 'High glucose : %d mg/dL' % self.glucose
+        if self.kind == FALL:
+            return 'Glucose falling %.1f mg/dL/min, now %d mg/dL' % (-self.rate, self.glucose)
+        if self.kind == RISE:
+            return 'Glucose rising %.1f mg/dL/min, now %d mg/dL' % (self.rate, self.glucose)
+        if self.kind == LOW_SOON:
+            return 'Glucose %d mg/dL, projected below %d in %d minutes' % (self.glucose, self.limit, round(self.minutes))
+        return 'Glucose %d mg/dL, projected above %d in %d minutes' % (self.glucose, self.limit, round(self.minutes))
+
+    def __repr__(self):
+        return 'Alert(%s, sysSeconds %d, %s)' % (self.kind, self.sysSeconds, self.message())
+
+
+class _DbState(object):
+    # The incremental state kept for each database
+    def __init__(self):
+        self.trend = trend.KalmanTrend(1)
+        self.active = set()
+
+
+class AlertEngine(object):
+    """Check each new reading against AlertSettings, and pass alerts to hooks.
+
+    Hooks are called as hook(alert) on the thread which adds the reading,
+    which is usually the download thread. An exception in a hook is
+    reported, but doesn't stop the other hooks.
+
+    Args:
+        settings: default AlertSettings for every database
+        hooks: a list of callables
+    """
+
+    def __init__(self, settings=None, hooks=None, dbg=False):
+        self.settings = settings or AlertSettings()
+        self.hooks = list(hooks or [])
+        self.debug = dbg
+        self._lock = threading.Lock()
+        self._dbSettings = {}
+        self._states = {}
+        self._feed = None
+
+    def setSettings(self, settings, dbPath=None):
+        """Set the limits for one database, or the default for all of them"""
+        with self._lock:
+            if dbPath is None:
+                self.settings = settings
+            else:
+                self._dbSettings[os.path.abspath(dbPath)] = settings
+        if self.debug:
+            print('AlertEngine :', dbPath or 'default', settings)
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def attach(self, feed=None):
+        """Start checking readings published to a change feed"""
+        self._feed = feed or changefeed.defaultFeed
+        self._feed.subscribe(self.onBatch, tables=('EgvRecord',))
+
+    def detach(self):
+        if self._feed is not None:
+            self._feed.unsubscribe(self.onBatch)
+            self._feed = None
+
+    def onBatch(self, batch):
+        # Change feed subscriber. EgvRecord rows are
+        # (sysSeconds, dispSeconds, full_glucose, glucose, testNum, trend)
+        freshSeconds = batch.newestSeconds - FRESH_SECONDS
+        # Readings older than the trend filter would keep don't matter
+        oldestSeconds = batch.newestSeconds - trend.WARMUP_SECONDS
+        for row in sorted(batch.rows):
+            if row[0] >= oldestSeconds:
+                self.addReading(batch.dbPath, row[0], row[3], fresh=(row[0] >= freshSeconds))
+
+    def addReading(self, dbPath, sysSeconds, glucose, fresh=True):
+        """Check one reading, in time order. Status codes (12 or less) are
+        skipped. If 'fresh' is False, only the trend is updated.
+
+        Returns:
+            A list of the alerts raised
+        """
+        if glucose <= 12:
+            return []
+        path = os.path.abspath(dbPath)
+        with self._lock:
+            state = self._states.get(path)
+            if state is None:
+                state = self._states[path] = _DbState()
+            settings = self._dbSettings.get(path, self.settings)
+            if not state.trend.update(sysSeconds, glucose):
+                return []
+            if not fresh:
+                return []
+            rate = None
+            if state.trend.count >= MIN_TREND_READINGS:
+                rate = state.trend.rate()
+            alerts = []
+            for (kind, minutes, limit) in self._conditions(settings, state.active, glucose, rate):
+                if minutes is False:
+                    state.active.discard(kind)
+                elif kind not in state.active:
+                    state.active.add(kind)
+                    alerts.append(Alert(kind, dbPath, sysSeconds, glucose, rate, minutes, limit))
+            # A reading that's already low or high replaces the warning of one to come
+            if LOW in state.active:
+                state.active.add(LOW_SOON)
+            if HIGH in state.active:
+                state.active.add(HIGH_SOON)
+
+        for alert in alerts:
+            self._raise(alert)
+        return alerts
+
+    def _conditions(self, settings, active, glucose, rate):
+        # Yields (kind, minutes, limit) for each configured alert. minutes is
+        # False if the condition doesn't hold, and None if it has no time.
+        def margin(kind, amount):
+            return amount if kind in active else 0
+
+        low = settings.lowAlert
+        high = settings.highAlert
+        if low:
+            holds = glucose <= low + margin(LOW, GLUCOSE_HYSTERESIS)
+            yield (LOW, None if holds else False, low)
+        if high:
+            holds = glucose >= high - margin(HIGH, GLUCOSE_HYSTERESIS)
+            yield (HIGH, None if holds else False, high)
+        if rate is None:
+            return
+        if settings.fallRate:
+            holds = rate <= -(settings.fallRate - margin(FALL, RATE_HYSTERESIS))
+            yield (FALL, None if holds else False, settings.fallRate)
+        if settings.riseRate:
+            holds = rate >= settings.riseRate - margin(RISE, RATE_HYSTERESIS)
+            yield (RISE, None if holds else False, settings.riseRate)
+        if settings.predictMinutes:
+            # The projected time at which the trend crosses each limit
+            if low:
+                minutes = False
+                if (rate < 0) and (glucose > low):
+                    crossing = (glucose - low) / -rate
+                    if crossing <= settings.predictMinutes + margin(LOW_SOON, settings.predictMinutes / 2.0):
+                        minutes = crossing
+                yield (LOW_SOON, minutes, low)
+            if high:
+                minutes = False
+                if (rate > 0) and (glucose < high):
+                    crossing = (high - glucose) / rate
+                    if crossing <= settings.predictMinutes + margin(HIGH_SOON, settings.predictMinutes / 2.0):
+                        minutes = crossing
+                yield (HIGH_SOON, minutes, high)
+
+    def _raise(self, alert):
+        if self.debug:
+            print('AlertEngine :', alert)
+        for hook in self.hooks:
+            try:
+                hook(alert)
+            except Exception as e:
+                print('AlertEngine : hook', hook, 'failed :', e)
+                print_exc()
+                if sys.version_info < (3, 0):
+                    sys.exc_clear()
+
+
+def _findProgram(name):
+    # shutil.which() isn't available in python2
+    for folder in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class _ProgramHook(object):
+    # Starts programs without waiting for them, and reaps them later
+    def __init__(self):
+        self._children = []
+
+    def _start(self, cmd, **kwargs):
+        self._children = [child for child in self._children if child.poll() is None]
+        self._children.append(subprocess.Popen(cmd, **kwargs))
+
+
+class CommandHook(_ProgramHook):
+    """Run a shell command for each alert. The alert is described by the
+    environment variables DEXC_ALERT (the kind), DEXC_GLUCOSE, DEXC_RATE,
+    DEXC_MINUTES, DEXC_SYSSECONDS, DEXC_DATABASE and DEXC_MESSAGE."""
+
+    def __init__(self, command):
+        _ProgramHook.__init__(self)
+        self.command = command
+
+    def __call__(self, alert):
+        env = dict(os.environ)
+        env['DEXC_ALERT'] = alert.kind
+        env['DEXC_GLUCOSE'] = str(alert.glucose)
+        env['DEXC_RATE'] = '' if alert.rate is None else '%.2f' % alert.rate
+        env['DEXC_MINUTES'] = '' if alert.minutes is None else '%d' % round(alert.minutes)
+        env['DEXC_SYSSECONDS'] = str(alert.sysSeconds)
+        env['DEXC_DATABASE'] = alert.dbPath
+        env['DEXC_MESSAGE'] = alert.message()
+        self._start(self.command, shell=True, env=env)
+
+
+class DesktopHook(_ProgramHook):
+    """Show each alert as a desktop notification, with notify-send on Linux
+    or osascript on macOS. Where neither exists, the alert is printed."""
+
+    def __init__(self):
+        _ProgramHook.__init__(self)
+        self.notifySend = _findProgram('notify-send')
+        self.osascript = _findProgram('osascript')
+
+    def __call__(self, alert):
+        urgent = alert.kind in (LOW, LOW_SOON)
+        if self.notifySend:
+            self._start([self.notifySend, '-u', 'critical' if urgent else 'normal',
+                         'DexcTrack', alert.message()])
+        elif self.osascript:
+            self._start([self.osascript, '-e', 'display notification "%s" with title "DexcTrack"' % alert.message()])
+        else:
+            print('DexcTrack alert at', alert.raisedTime.strftime("%Y-%m-%d %H:%M:%S"), ':', alert.message())
+
+
+if __name__ == '__main__':
+    # Replay simulated readings through the change feed, one download per
+    # reading, and report the alerts raised and how long each download's
+    # check took, from publishing the batch to the hook being called.
+    import time
+
+    feed = changefeed.ChangeFeed()
+    raised = []
+    publishTimes = []
+
+    def recordHook(alert):
+        raised.append((alert, time.time() - publishTimes[-1]))
+
+    engine = AlertEngine(AlertSettings(lowAlert=70, highAlert=200, fallRate=2, riseRate=3),
+                         hooks=[recordHook])
+    engine.attach(feed)
+
+    # Flat, then a fast fall into a low, a recovery and a climb to a high
+    glucoseList = ([120] * 10 + list(range(120, 60, -12)) + [58, 57, 60, 66, 75, 85, 95]
+                   + list(range(100, 230, 20)) + [230] * 5 + list(range(225, 150, -5)))
+    checkTimes = []
+    for (i, glucose) in enumerate(glucoseList):
+        sysSeconds = 500000000 + 300 * i
+        batch = changefeed.ChangeBatch('/tmp/alerts.sqlite', 'EgvRecord',
+                                       [(sysSeconds, sysSeconds - 3600, glucose, glucose, i, 0)])
+        publishTimes.append(time.time())
+        feed.publish([batch])
+        checkTimes.append(time.time() - publishTimes[-1])
+
+    for (alert, latency) in raised:
+        print('%3d min : %-8s %-55s hook after %.3f ms' % ((alert.sysSeconds - 500000000) // 60, alert.kind,
+                                                          alert.message(), 1000.0 * latency))
+    print('%d readings, %d alerts, %.3f ms per reading on average, %.3f ms at most' %
+          (len(glucoseList), len(raised), 1000.0 * sum(checkTimes) / len(checkTimes), 1000.0 * max(checkTimes)))
+    kinds = [alert.kind for (alert, latency) in raised]
+    ok = all(kinds.count(kind) == 1 for kind in (LOW, HIGH, FALL, RISE, LOW_SOON, HIGH_SOON))
+    print('Each kind raised once :', ok)
+
+    # A catch-up download of two weeks, published in 2000 row batches as
+    # WriteRecordsToDb() does. Only the readings at the end of the whole
+    # download are fresh.
+    del raised[:]
+    engine.detach()
+    engine = AlertEngine(hooks=[recordHook])
+    engine.attach(feed)
+    # There is a low at the end of every batch but the last
+    history = [(600000000 + 300 * i, 55 if i % 2000 >= 1994 else 120) for i in range(14 * 288)]
+    newest = history[-1][0]
+    for first in range(0, len(history), 2000):
+        publishTimes.append(time.time())
+        feed.publish([changefeed.ChangeBatch('/tmp/alerts.sqlite', 'EgvRecord',
+                                             [(secs, secs, g, g, 0, 0) for (secs, g) in history[first:first + 2000]],
+                                             newestSeconds=newest)])
+    stale = [alert for (alert, latency) in raised if alert.sysSeconds < newest - FRESH_SECONDS]
+    catchUpOk = not stale
+    print('Catch-up download raised %d alerts for old readings :' % len(stale), 'OK' if catchUpOk else 'FAILED')
+    sys.exit(0 if ok and catchUpOk else 1)
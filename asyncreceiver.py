@@ -0,0 +1,344 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file provides an asyncio client for Dexcom receivers, so that several
+# receivers (plus anything else, like a status web server) can be driven
+# from a single thread. It sits alongside the blocking readdata.Dexcom class,
+# and shares its packet composition, page decoding and record parsers, and
+# the SQL storage code in readReceiver.
+#
+# Each command runs under a timeout sized to its expected response, and
+# every coroutine may be cancelled. If a command is interrupted part way
+# through a response, the remaining bytes are discarded before the next
+# command is sent.
+#
+# This file requires python 3.7 or newer.
+#
+###############################################################################
+
+import asyncio
+import io
+import sqlite3
+import struct
+import serial
+import constants
+import changefeed
+import crc16
+import packetwriter
+import readdata
+import readReceiver
+
+# Parsers for each type of device, as chosen from its firmware version
+CODEC_CLASSES = {
+    'g4': readdata.Dexcom,
+    'g5': readdata.DexcomG5,
+    'g6': readdata.DexcomG6,
+}
+
+# How long the port must be quiet before we believe an interrupted
+# response has been fully discarded
+DRAIN_QUIET_TIME = 0.05
+
+
+class AsyncDexcom(object):
+    """An asyncio client for one Dexcom receiver.
+
+    Use it as an async context manager, or call open() and close():
+
+        async with AsyncDexcom('/dev/ttyACM0') as dex:
+            records = await dex.read_records('EGV_DATA')
+    """
+
+    def __init__(self, port_name, dbg=False):
+        self.port_name = port_name
+        # Newly stored records are published here after each download
+        self.change_feed = changefeed.defaultFeed
+        # The latest SQL write, which keeps running on its executor thread
+        # even if the download awaiting it is cancelled
+        self.write_future = None
+        self.device_type = None
+        self._debug_mode = dbg
+        self._serial = None
+        self._reader = None
+        self._selectable = False
+        self._lock = None
+        self._codec = None
+        self._firmware_header = None
+        self._serial_number = None
+        self._resync = False
+
+    async def open(self):
+        self._lock = asyncio.Lock()
+        self._serial = serial.Serial(port=self.port_name, baudrate=readdata.BAUD_RATE,
+                                     timeout=0)
+        self._reader = asyncio.StreamReader()
+        loop = asyncio.get_event_loop()
+        try:
+            loop.add_reader(self._serial.fileno(), self._on_readable)
+            self._selectable = True
+        except (AttributeError, NotImplementedError, ValueError, io.UnsupportedOperation) as e:
+            # Windows serial ports can't be watched by the event loop, so
+            # we'll have to make blocking reads on an executor thread.
+            self._selectable = False
+        return self
+
+    def close(self):
+        if self._serial is not None:
+            if self._selectable:
+                asyncio.get_event_loop().remove_reader(self._serial.fileno())
+            self._serial.close()
+            self._serial = None
+        self._firmware_header = None
+        self._serial_number = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _on_readable(self):
+        try:
+            data = self._serial.read(self._serial.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            # Probably unplugged. Stop watching, and fail any pending read.
+            asyncio.get_event_loop().remove_reader(self._serial.fileno())
+            self._selectable = False
+            self._reader.set_exception(serial.SerialException(str(e)))
+            return
+        if data:
+            self._reader.feed_data(data)
+
+    async def _read_exactly(self, count):
+        if self._selectable:
+            return await self._reader.readexactly(count)
+        loop = asyncio.get_event_loop()
+        data = b''
+        while len(data) < count:
+            chunk = await loop.run_in_executor(None, self._blocking_read, count - len(data))
+            data += chunk
+        return data
+
+    def _blocking_read(self, count):
+        # Used off the event loop thread, when the port isn't selectable.
+        # A short timeout keeps cancellation responsive.
+        self._serial.timeout = 0.1
+        return self._serial.read(count)
+
+    async def _drain(self):
+        # Throw away what's left of an interrupted response
+        self._serial.reset_input_buffer()
+        if self._selectable:
+            self._reader = asyncio.StreamReader()
+            while True:
+                try:
+                    await asyncio.wait_for(self._reader.read(4096), DRAIN_QUIET_TIME)
+                except asyncio.TimeoutError:
+                    break
+        else:
+            await asyncio.sleep(DRAIN_QUIET_TIME)
+            self._serial.reset_input_buffer()
+        self._resync = False
+
+    async def _read_packet(self):
+        header = await self._read_exactly(4)
+        if header[0] != 1:
+            raise constants.Error('Error reading packet header!')
+        length = struct.unpack('<H', header[1:3])[0]
+        if length > 6:
+            data = await self._read_exactly(length - 6)
+        else:
+            data = b''
+        suffix = await self._read_exactly(2)
+        sent_crc = struct.unpack('<H', suffix)[0]
+        local_crc = crc16.crc16(header + data, 0, len(header) + len(data))
+        if sent_crc != local_crc:
+            raise constants.CrcError("readpacket Failed CRC check")
+        return readdata.ReadPacket(header[3], data)
+
+    async def _transact(self, command_id, payload):
+        if self._resync:
+            await self._drain()
+        p = packetwriter.PacketWriter()
+        p.ComposePacket(command_id, payload)
+        self._serial.write(bytes(p.PacketBytes()))
+        return await self._read_packet()
+
+    async def command(self, command_id, payload=None, timeout=None):
+        """Send a command and wait for its response.
+
+        Args:
+            command_id: one of the command numbers in constants.py
+            payload: optional data for the command, as for PacketWriter
+            timeout: seconds to wait for the response. By default, this is
+                     sized to the expected length of the response.
+
+        Returns:
+            A readdata.ReadPacket
+
+        Raises:
+            asyncio.TimeoutError, serial.SerialException, constants.Error
+        """
+        if self._serial is None:
+            raise serial.SerialException('Port %s is not open' % self.port_name)
+        if timeout is None:
+            timeout = readdata.CommandTimeout(command_id)
+        async with self._lock:
+            try:
+                return await asyncio.wait_for(self._transact(command_id, payload), timeout)
+            except BaseException:
+                # The response may be partly read, so resynchronize before
+                # the next command. This covers cancellation too.
+                self._resync = True
+                raise
+
+    async def get_firmware_header(self):
+        if self._firmware_header is None:
+            packet = await self.command(constants.READ_FIRMWARE_HEADER)
+            self._firmware_header = readdata.ET.fromstring(packet.data)
+        return self._firmware_header
+
+    async def get_device_type(self):
+        if self.device_type is None:
+            fwh = await self.get_firmware_header()
+            self.device_type = readdata.DeviceTypeFromFirmware(fwh.get('FirmwareVersion'))
+            if self.device_type not in CODEC_CLASSES:
+                raise constants.Error('Unrecognized firmware version %s' % self.device_type)
+            # The codec is never connected. We only use its page parsers.
+            self._codec = CODEC_CLASSES[self.device_type](self.port_name)
+        return self.device_type
+
+    async def read_serial_number(self):
+        if self._serial_number is None:
+            md = await self.read_records('MANUFACTURING_DATA')
+            if md:
+                self._serial_number = readdata.ET.fromstring(md[0].xmldata).get('SerialNumber')
+        return self._serial_number
+
+    async def read_glucose_unit(self):
+        UNIT_TYPE = (None, 'mg/dL', 'mmol/L')
+        packet = await self.command(constants.READ_GLUCOSE_UNIT)
+        return UNIT_TYPE[bytearray(packet.data)[0]]
+
+    async def read_battery(self):
+        # Returns (powerState, powerLevel), like readReceiverBase.GetPowerInfo()
+        packet = await self.command(constants.READ_BATTERY_STATE)
+        powerState = constants.BATTERY_STATES[bytearray(packet.data)[0]]
+        packet = await self.command(constants.READ_BATTERY_LEVEL)
+        powerLevel = struct.unpack('I', packet.data)[0]
+        return (powerState, powerLevel)
+
+    async def read_page_range(self, record_type):
+        """Returns (first page, last page) for a record type"""
+        record_type_index = constants.RECORD_TYPES.index(record_type)
+        packet = await self.command(constants.READ_DATABASE_PAGE_RANGE,
+                                    chr(record_type_index))
+        return struct.unpack('II', packet.data)
+
+    async def read_pages(self, record_type, start, end):
+        """Read the records held in pages start through end-1, in order"""
+        await self.get_device_type()
+        record_type_index = constants.RECORD_TYPES.index(record_type)
+        records = []
+        for page in range(start, end):
+            packet = await self.command(constants.READ_DATABASE_PAGES,
+                                        (chr(record_type_index), struct.pack('I', page), chr(1)))
+            records.extend(self._codec.DecodePage(record_type, page, packet))
+        return records
+
+    async def read_records(self, record_type):
+        """Read every record of a given type, oldest first"""
+        assert record_type in constants.RECORD_TYPES
+        start, end = await self.read_page_range(record_type)
+        if start != end or not end:
+            end += 1
+        return await self.read_pages(record_type, start, end)
+
+    async def read_last_records(self, record_type, count=1):
+        """Read just the newest 'count' records of a given type, oldest first.
+        Pages are read from the last one backwards, only as far as needed."""
+        start, end = await self.read_page_range(record_type)
+        if start != end or not end:
+            end += 1
+        records = []
+        page = end
+        while (len(records) < count) and (page > start):
+            page -= 1
+            records[:0] = await self.read_pages(record_type, page, page + 1)
+        return records[-count:] if count > 0 else []
+
+    async def download_to_db(self, dbPath):
+        """Copy new records into an SQL database, as readReceiverBase.DownloadToDb()
+        does. The SQL work runs on an executor thread, to keep the event loop free.
+
+        Returns:
+            0 on success, 1 for an SQL error, 2 for a serial error or timeout,
+            3 for a ValueError, or 4 for any other error
+        """
+        db_read_status = 0
+        try:
+            await self.get_device_type()
+            records = {}
+            for record_type in readReceiver.DOWNLOAD_RECORD_TYPES:
+                records[record_type] = await self.read_records(record_type)
+            glUnits = await self.read_glucose_unit()
+            loop = asyncio.get_event_loop()
+            self.write_future = loop.run_in_executor(None, readReceiver.WriteRecordsToDb, dbPath,
+                                                     records, glUnits, self.device_type, self.change_feed)
+            # Shielded, so a timeout leaves write_future pending until the
+            # thread is really finished
+            await asyncio.shield(self.write_future)
+        except asyncio.CancelledError:
+            raise
+        except sqlite3.Error as e:
+            print ('download_to_db() : Rolling back SQL changes due to exception =', e)
+            db_read_status = 1
+        except (serial.SerialException, asyncio.TimeoutError, OSError) as e:
+            db_read_status = 2
+            if self._debug_mode:
+                print ('download_to_db() : Serial Exception =', repr(e))
+        except ValueError as e:
+            db_read_status = 3
+            if self._debug_mode:
+                print ('download_to_db() : ValueError Exception =', e)
+        except Exception as e:
+            db_read_status = 4
+            if self._debug_mode:
+                print ('download_to_db() : Exception =', repr(e))
+        return db_read_status
+
+
+if __name__ == '__main__':
+    import util
+
+    async def showDevice(port):
+        async with AsyncDexcom(port, dbg=True) as dex:
+            devType = await dex.get_device_type()
+            sNum = await dex.read_serial_number()
+            egvRecords = await dex.read_records('EGV_DATA')
+            print (port, ':', devType, sNum, ':', len(egvRecords), 'EGV records')
+
+    async def showAllDevices():
+        ports = util.find_all_usbserial(constants.DEXCOM_USB_VENDOR,
+                                        constants.DEXCOM_USB_PRODUCT)
+        if not ports:
+            print ('No Dexcom receivers found')
+        await asyncio.gather(*[showDevice(port) for port in ports])
+
+    asyncio.run(showAllDevices())
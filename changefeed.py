@@ -0,0 +1,134 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file provides an in-process publish/subscribe hook for newly stored
+# receiver records. After each download is committed, the rows which were
+# actually inserted (not those already present) are published as a batch
+# per table. Consumers, such as the graph, statistics, exporters or alerts,
+# can then update incrementally, rather than re-querying the database.
+#
+# Each database also has a change count, which goes up whenever records are
+# added or edited, so caches of what was read from it can tell they're stale.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import os
+import sys
+import threading
+from traceback import print_exc
+
+# The tables which are published, with the columns of each row, as
+# inserted by readReceiver.WriteRecordsToDb(). sysSeconds always comes first.
+TABLE_COLUMNS = {
+    'EgvRecord': ('sysSeconds', 'dispSeconds', 'full_glucose', 'glucose', 'testNum', 'trend'),
+    'UserEvent': ('sysSeconds', 'dispSeconds', 'meterSeconds', 'type', 'subtype', 'value', 'xoffset', 'yoffset'),
+    'SensorInsert': ('sysSeconds', 'dispSeconds', 'insertSeconds', 'state', 'number', 'transmitter'),
+    'Calib': ('sysSeconds', 'dispSeconds', 'meterSeconds', 'type', 'glucose', 'testNum', 'xx'),
+}
+
+
+class ChangeBatch(object):
+    """Rows newly inserted into one table of one database.
+
+    Attributes:
+        dbPath: the database file
+        table: the table name, one of TABLE_COLUMNS
+        columns: the names of the values in each row
+        rows: a list of tuples, in the order they were inserted
+        firstSeconds, lastSeconds: the range of sysSeconds in rows
+        newestSeconds: the newest sysSeconds of this table in the whole
+                 download, which may be published over several batches.
+                 It's lastSeconds if the publisher didn't give it.
+    """
+
+    def __init__(self, dbPath, table, rows, newestSeconds=None):
+        self.dbPath = dbPath
+        self.table = table
+        self.columns = TABLE_COLUMNS[table]
+        self.rows = rows
+        self.firstSeconds = min(row[0] for row in rows)
+        self.lastSeconds = max(row[0] for row in rows)
+        self.newestSeconds = self.lastSeconds if newestSeconds is None else max(newestSeconds, self.lastSeconds)
+
+    def __repr__(self):
+        return 'ChangeBatch(%s, %s, %d rows, sysSeconds %d to %d)' % (
+            self.dbPath, self.table, len(self.rows), self.firstSeconds, self.lastSeconds)
+
+
+class ChangeFeed(object):
+    """Deliver ChangeBatch objects to subscribers.
+
+    Subscribers are called as callback(batch), on the publishing thread,
+    which is usually a device read thread. Anything which must run on
+    another thread, like drawing the graph, should be handed off there.
+    An exception in one subscriber is reported, but doesn't stop the
+    others, or the download which published the batch.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, callback, tables=None):
+        # Optionally, only deliver batches for the given tables
+        with self._lock:
+            self._subscribers.append((callback, tables))
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [(cb, tables) for (cb, tables) in self._subscribers
+                                 if cb != callback]
+
+    def publish(self, batches):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for batch in batches:
+            for (callback, tables) in subscribers:
+                if (tables is not None) and (batch.table not in tables):
+                    continue
+                try:
+                    callback(batch)
+                except Exception as e:
+                    print('ChangeFeed.publish() : subscriber', callback, 'failed :', e)
+                    print_exc()
+                    if sys.version_info < (3, 0):
+                        sys.exc_clear()
+
+
+# The feed which downloads publish to, unless told otherwise
+defaultFeed = ChangeFeed()
+
+_changeLock = threading.Lock()
+_changeCounts = {}
+
+
+def NoteChange(dbPath):
+    """Record that a database's contents have changed"""
+    path = os.path.abspath(dbPath)
+    with _changeLock:
+        _changeCounts[path] = _changeCounts.get(path, 0) + 1
+
+
+def ChangeCount(dbPath):
+    """Returns the number of changes to a database seen by this process"""
+    with _changeLock:
+        return _changeCounts.get(os.path.abspath(dbPath), 0)
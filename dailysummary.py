@@ -0,0 +1,252 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file maintains the DailySummary table, which holds the count, sum,
+# sum of squares, minimum, maximum, a histogram and the first and last
+# times of the glucose readings for each day. Days are receiver system
+# days, sysSeconds // 86400.
+#
+# Long range statistics, like the 3 month average, HbA1c, standard deviation
+# and time in range, can then be found from about 90 summary rows, rather
+# than about 26,000 EgvRecord rows. Only the partial days at either end of
+# a range are read from EgvRecord, so the results are exact.
+#
+# The table is created by a dbschema migration, and then updated by
+# readReceiver.WriteRecordsToDb(), for just the days touched by each download.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import math
+import sqlite3
+import struct
+
+SECONDS_PER_DAY = 60 * 60 * 24
+# Glucose values of 12 or less are status codes, not readings. This is
+# written into the SQL, rather than passed as a parameter, so that SQLite
+# can use the EgvRecordReadings index, which only holds real readings.
+REAL_READING = 'glucose > 12'
+# The histogram has one bin per mg/dL, from 0 through 400. The receivers
+# can't report anything higher, but any higher value goes in the last bin.
+HISTOGRAM_BINS = 401
+HISTOGRAM_FORMAT = '<%dH' % HISTOGRAM_BINS
+
+CREATE_TABLE_SQL = ('CREATE TABLE IF NOT EXISTS DailySummary( day INTEGER PRIMARY KEY, count INT, sum INT,'
+                    ' sumSquares INT, minGlucose INT, maxGlucose INT, histogram BLOB,'
+                    ' firstSeconds INT, lastSeconds INT);')
+
+
+class RangeStats(object):
+    """Glucose statistics for a range of time, built from summary rows
+    and individual readings."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.totalSquares = 0
+        self.minimum = None
+        self.maximum = None
+        self.firstSeconds = None
+        self.lastSeconds = None
+        self.histogram = [0] * HISTOGRAM_BINS
+
+    def addReading(self, sysSeconds, glucose):
+        self.count += 1
+        self.total += glucose
+        self.totalSquares += glucose * glucose
+        if (self.minimum is None) or (glucose < self.minimum):
+            self.minimum = glucose
+        if (self.maximum is None) or (glucose > self.maximum):
+            self.maximum = glucose
+        if (self.firstSeconds is None) or (sysSeconds < self.firstSeconds):
+            self.firstSeconds = sysSeconds
+        if (self.lastSeconds is None) or (sysSeconds > self.lastSeconds):
+            self.lastSeconds = sysSeconds
+        self.histogram[min(glucose, HISTOGRAM_BINS - 1)] += 1
+
+    def addSummary(self, row):
+        # row = (count, sum, sumSquares, minGlucose, maxGlucose, histogram, firstSeconds, lastSeconds)
+        (count, total, totalSquares, minimum, maximum, histogram, firstSeconds, lastSeconds) = row
+        if not count:
+            return
+        self.count += count
+        self.total += total
+        self.totalSquares += totalSquares
+        if (self.minimum is None) or (minimum < self.minimum):
+            self.minimum = minimum
+        if (self.maximum is None) or (maximum > self.maximum):
+            self.maximum = maximum
+        if (self.firstSeconds is None) or (firstSeconds < self.firstSeconds):
+            self.firstSeconds = firstSeconds
+        if (self.lastSeconds is None) or (lastSeconds > self.lastSeconds):
+            self.lastSeconds = lastSeconds
+        for (i, binCount) in enumerate(struct.unpack(HISTOGRAM_FORMAT, bytes(histogram))):
+            self.histogram[i] += binCount
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return float(self.total) / self.count
+
+    def sampleVariance(self):
+        # For a Sample Variance, divide by N - 1
+        if self.count < 2:
+            return 0.0
+        variance = (self.totalSquares - float(self.total) * self.total / self.count) / (self.count - 1)
+        return max(variance, 0.0)
+
+    def stdDev(self):
+        return math.sqrt(self.sampleVariance())
+
+    def countBelow(self, glucose):
+        return sum(n for (g, n) in enumerate(self.histogram) if g < glucose)
+
+    def countBetween(self, low, high):
+        # Inclusive of both limits
+        return sum(n for (g, n) in enumerate(self.histogram) if low <= g <= high)
+
+    def countAbove(self, glucose):
+        return sum(n for (g, n) in enumerate(self.histogram) if g > glucose)
+
+    def percentile(self, percent):
+        """Returns the glucose value at the given percentile (0 - 100), or None"""
+        if self.count == 0:
+            return None
+        target = percent / 100.0 * self.count
+        seen = 0
+        for (g, n) in enumerate(self.histogram):
+            seen += n
+            if n and (seen >= target):
+                return g
+        return self.maximum
+
+
+def CreateTable(curs):
+    """Create the DailySummary table, if necessary.
+
+    Returns:
+        True if the table had to be created
+    """
+    curs.execute("SELECT count(*) from sqlite_master where type='table' and name='DailySummary'")
+    exists = curs.fetchone()[0] > 0
+    if not exists:
+        curs.execute(CREATE_TABLE_SQL)
+    return not exists
+
+
+def UpdateDays(curs, days):
+    """Recalculate the summaries of the given days from EgvRecord"""
+    for day in sorted(set(days)):
+        stats = RangeStats()
+        curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE ' + REAL_READING + ' AND sysSeconds >= ? AND sysSeconds < ?',
+                     (day * SECONDS_PER_DAY, (day + 1) * SECONDS_PER_DAY))
+        for (sysSeconds, glucose) in curs.fetchall():
+            stats.addReading(sysSeconds, glucose)
+        if stats.count == 0:
+            curs.execute('DELETE FROM DailySummary WHERE day = ?', (day,))
+        else:
+            curs.execute('INSERT OR REPLACE INTO DailySummary( day, count, sum, sumSquares, minGlucose, maxGlucose,'
+                         ' histogram, firstSeconds, lastSeconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                         (day, stats.count, stats.total, stats.totalSquares, stats.minimum, stats.maximum,
+                          sqlite3.Binary(struct.pack(HISTOGRAM_FORMAT, *stats.histogram)),
+                          stats.firstSeconds, stats.lastSeconds))
+
+
+def UpdateForReadings(curs, sysSecondsList):
+    """Update the summaries for the days holding the given readings.
+    The table is created and filled by a dbschema migration."""
+    UpdateDays(curs, [s // SECONDS_PER_DAY for s in sysSecondsList])
+
+
+def Rebuild(curs):
+    """Recalculate the summary of every day in EgvRecord"""
+    curs.execute('DELETE FROM DailySummary')
+    curs.execute('SELECT DISTINCT sysSeconds / ? FROM EgvRecord WHERE ' + REAL_READING, (SECONDS_PER_DAY,))
+    UpdateDays(curs, [row[0] for row in curs.fetchall()])
+
+
+def QueryRange(curs, startSecs, endSecs):
+    """Find glucose statistics for readings with sysSeconds from startSecs
+    through endSecs. Whole days come from DailySummary, and the partial days
+    at either end come from EgvRecord. If there's no DailySummary table, as in
+    a database from an older version of DexcTrack, only EgvRecord is used.
+
+    Returns:
+        A RangeStats
+    """
+    startSecs = int(startSecs)
+    endSecs = int(endSecs)
+    stats = RangeStats()
+    rawRanges = [(startSecs, endSecs)]
+
+    curs.execute("SELECT count(*) from sqlite_master where type='table' and name='DailySummary'")
+    if curs.fetchone()[0] > 0:
+        # The days which lie entirely within the range
+        firstDay = (startSecs + SECONDS_PER_DAY - 1) // SECONDS_PER_DAY
+        lastDay = (endSecs + 1) // SECONDS_PER_DAY - 1
+        if firstDay <= lastDay:
+            curs.execute('SELECT count, sum, sumSquares, minGlucose, maxGlucose, histogram, firstSeconds, lastSeconds'
+                         ' FROM DailySummary WHERE day >= ? AND day <= ?', (firstDay, lastDay))
+            for row in curs.fetchall():
+                stats.addSummary(row)
+            rawRanges = [(startSecs, firstDay * SECONDS_PER_DAY - 1),
+                         ((lastDay + 1) * SECONDS_PER_DAY, endSecs)]
+
+    for (rangeStart, rangeEnd) in rawRanges:
+        if rangeStart <= rangeEnd:
+            curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE ' + REAL_READING + ' AND sysSeconds >= ? AND sysSeconds <= ?',
+                         (rangeStart, rangeEnd))
+            for (sysSeconds, glucose) in curs.fetchall():
+                stats.addReading(sysSeconds, glucose)
+    return stats
+
+
+if __name__ == '__main__':
+    # Compare against a plain scan of EgvRecord, and time both, using a
+    # database given on the command line.
+    import sys
+    import time
+
+    if len(sys.argv) < 2:
+        print('Usage: %s <database file>' % sys.argv[0])
+        sys.exit(1)
+    import dbschema
+    conn = sqlite3.connect(sys.argv[1])
+    dbschema.Migrate(conn)
+    curs = conn.cursor()
+    curs.execute('SELECT MAX(sysSeconds) FROM EgvRecord')
+    endSecs = curs.fetchone()[0]
+    startSecs = endSecs - 90 * SECONDS_PER_DAY
+
+    startTime = time.time()
+    curs.execute('SELECT COUNT(*), AVG(glucose), MAX(glucose) FROM EgvRecord WHERE ' + REAL_READING + ' AND sysSeconds >= ? AND sysSeconds <= ?',
+                 (startSecs, endSecs))
+    scan = curs.fetchone()
+    scanTime = time.time() - startTime
+
+    startTime = time.time()
+    stats = QueryRange(curs, startSecs, endSecs)
+    summaryTime = time.time() - startTime
+
+    print('EgvRecord scan    : count = %d, mean = %.3f, max = %d in %.4f seconds' % (scan[0], scan[1], scan[2], scanTime))
+    print('DailySummary      : count = %d, mean = %.3f, max = %d in %.4f seconds' % (stats.count, stats.mean(), stats.maximum, summaryTime))
+    print('Standard deviation = %.3f, median = %d' % (stats.stdDev(), stats.percentile(50)))
+    conn.close()
@@ -0,0 +1,377 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file holds the database schema, and the migrations which bring an
+# older database up to date. The schema version is kept in the database's
+# 'PRAGMA user_version', and each migration runs once, in its own
+# transaction, when a database is first opened.
+#
+# Databases are put in WAL (write-ahead log) mode, so that a download
+# writing to the database never blocks the display from reading it, and
+# each reader sees a consistent snapshot.
+#
+# Running this file migrates a database in the original schema, checks the
+# resulting tables and indexes, and checks that none of the frequently run
+# queries needs a full table scan, using EXPLAIN QUERY PLAN.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import os
+import sys
+import sqlite3
+import threading
+import dailysummary
+import sensorsession
+import signalgaps
+
+# The current definition of each table. Tables keyed by time use an
+# INTEGER PRIMARY KEY, which makes sysSeconds the rowid, so rows are
+# stored in time order, and time range queries need no separate index.
+TABLES = {
+    'EgvRecord': 'CREATE TABLE IF NOT EXISTS EgvRecord( sysSeconds INTEGER PRIMARY KEY, dispSeconds INT, full_glucose INT, glucose INT, testNum INT, trend INT);',
+    'UserEvent': 'CREATE TABLE IF NOT EXISTS UserEvent( sysSeconds INTEGER PRIMARY KEY, dispSeconds INT, meterSeconds INT, type INT, subtype INT, value INT, xoffset REAL, yoffset REAL);',
+    'SensorInsert': 'CREATE TABLE IF NOT EXISTS SensorInsert( sysSeconds INTEGER PRIMARY KEY, dispSeconds INT, insertSeconds INT, state INT, number INT, transmitter STR);',
+    'Calib': 'CREATE TABLE IF NOT EXISTS Calib( sysSeconds INTEGER PRIMARY KEY, dispSeconds INT, meterSeconds INT, type INT, glucose INT, testNum INT, xx INT);',
+    'UserNote': 'CREATE TABLE IF NOT EXISTS UserNote( sysSeconds INTEGER PRIMARY KEY, message TEXT, xoffset REAL, yoffset REAL);',
+    'Config': 'CREATE TABLE IF NOT EXISTS Config( id INT PRIMARY KEY CHECK (id = 0), displayLow REAL, displayHigh REAL, legendX REAL, legendY REAL, glUnits STR, scale REAL, timeOffset INTEGER);',
+}
+# The tables keyed by sysSeconds
+TIME_TABLES = ('Calib', 'EgvRecord', 'SensorInsert', 'UserEvent', 'UserNote')
+
+# The Config scale for DexcTrack's default display range, of one day + 1 hour,
+# on a scale from 4 hours to 2 weeks
+DEFAULT_SCALE = 100.0 * (25 - 4) / (14 * 24 - 4)
+
+# Settings for the long lived, read-only connection used by the display,
+# which mostly scans ranges of readings
+READER_MMAP_SIZE = 64 * 1024 * 1024     # bytes of the file to memory map
+READER_CACHE_SIZE = -16 * 1024          # negative means KiB, so 16 MiB
+
+INDEXES = (
+    # Real readings (glucose values of 12 or less are status codes) in time
+    # order. This covers the range, latest and nearest reading queries.
+    'CREATE INDEX IF NOT EXISTS EgvRecordReadings ON EgvRecord( sysSeconds, glucose, trend) WHERE glucose > 12;',
+    # The time at which an event was recorded on the meter, in receiver time
+    'CREATE INDEX IF NOT EXISTS UserEventTime ON UserEvent( sysSeconds-dispSeconds+meterSeconds);',
+    'CREATE INDEX IF NOT EXISTS SensorInsertState ON SensorInsert( state);',
+)
+
+
+def _tableExists(curs, table):
+    curs.execute("SELECT count(*) from sqlite_master where type='table' and name=?", (table,))
+    return curs.fetchone()[0] > 0
+
+def _tableInfo(curs, table):
+    # pragma table_info rows are (cid, name, type, notnull, dflt_value, pk)
+    curs.execute('PRAGMA table_info(%s)' % table)
+    return curs.fetchall()
+
+def _hasIntegerKey(curs, table):
+    return any(row[5] and (row[2].upper() == 'INTEGER') for row in _tableInfo(curs, table))
+
+def _rebuildTable(curs, table):
+    # Copy a table into a new one with the current definition
+    curs.execute('ALTER TABLE %s RENAME TO %s_old' % (table, table))
+    curs.execute(TABLES[table])
+    curs.execute('INSERT OR IGNORE INTO %s SELECT * FROM %s_old' % (table, table))
+    curs.execute('DROP TABLE %s_old' % table)
+
+# Each migration is called with a cursor, inside a transaction. It returns
+# True if the database should be vacuumed once the migrations are complete.
+
+def _migration1(curs):
+    # Make sysSeconds the rowid of each table, and add indexes for the hot queries
+    for table in TIME_TABLES:
+        if not _tableExists(curs, table):
+            curs.execute(TABLES[table])
+        elif not _hasIntegerKey(curs, table):
+            _rebuildTable(curs, table)
+    for indexSql in INDEXES:
+        curs.execute(indexSql)
+    return False
+
+def _migration2(curs):
+    # Older versions of the Config table didn't have 'scale' or 'timeOffset' columns
+    if not _tableExists(curs, 'Config'):
+        curs.execute(TABLES['Config'])
+        return False
+    columns = [row[1] for row in _tableInfo(curs, 'Config')]
+    if 'scale' not in columns:
+        curs.execute('ALTER TABLE Config ADD COLUMN scale REAL DEFAULT %f' % DEFAULT_SCALE)
+    if 'timeOffset' not in columns:
+        curs.execute('ALTER TABLE Config ADD COLUMN timeOffset INTEGER DEFAULT 0')
+    return False
+
+def _migration3(curs):
+    # Earlier releases had a UserSettings table, but it sucked up a huge amount of storage space,
+    # and didn't provide anything useful. So, if that table exists, we'll drop it and run
+    # vacuum to free up 97% of the disk space.
+    if _tableExists(curs, 'UserSettings'):
+        print('Deleting UserSettings table from database')
+        curs.execute('DROP TABLE UserSettings')
+        return True
+    return False
+
+def _migration4(curs):
+    # Summarize the readings of each day
+    dailysummary.CreateTable(curs)
+    dailysummary.Rebuild(curs)
+    return False
+
+def _migration5(curs):
+    # Index the sensor sessions, for per-sensor statistics
+    sensorsession.CreateTable(curs)
+    sensorsession.Rebuild(curs)
+    return False
+
+def _migration6(curs):
+    # Index the gaps in the readings, and the runs of special glucose values
+    signalgaps.CreateTable(curs)
+    signalgaps.Rebuild(curs)
+    return False
+
+# MIGRATIONS[n] brings a database from version n to version n + 1
+MIGRATIONS = (
+    _migration1,
+    _migration2,
+    _migration3,
+    _migration4,
+    _migration5,
+    _migration6,
+)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def Migrate(conn, dbg=False):
+    """Bring a database up to the current schema version.
+
+    Each migration is run in its own transaction, which also reads and
+    updates the version, so an interrupted migration is simply run again,
+    and another process migrating the same file at once waits for each
+    step, rather than repeating it.
+
+    Returns:
+        The database's schema version
+
+    Raises:
+        sqlite3.Error
+    """
+    curs = conn.cursor()
+    curs.execute('PRAGMA user_version')
+    version = curs.fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        curs.close()
+        return version
+
+    # Manage the transactions ourselves, since older versions of the
+    # sqlite3 module commit before any schema change.
+    isolation = conn.isolation_level
+    conn.isolation_level = None
+    vacuum = False
+    try:
+        while True:
+            # Take the write lock before reading the version, so the version
+            # can't change under us
+            curs.execute('BEGIN IMMEDIATE')
+            try:
+                curs.execute('PRAGMA user_version')
+                version = curs.fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    curs.execute('COMMIT')
+                    break
+                if dbg:
+                    print('Migrate() : Updating database schema from version', version, 'to', version + 1)
+                if MIGRATIONS[version](curs):
+                    vacuum = True
+                # PRAGMA doesn't accept parameters
+                curs.execute('PRAGMA user_version = %d' % (version + 1))
+                curs.execute('COMMIT')
+            except sqlite3.Error:
+                curs.execute('ROLLBACK')
+                raise
+        # VACUUM can't be run inside a transaction, and it rewrites the whole
+        # file, so it's only done here, once, when a migration asks for it.
+        if vacuum:
+            curs.execute('VACUUM')
+    finally:
+        conn.isolation_level = isolation
+        curs.close()
+    return version
+
+
+_migratedPaths = set()
+_migrateLock = threading.Lock()
+
+def MigrateOnce(dbPath, dbg=False):
+    """Migrate a database file, and put it in WAL mode, if that hasn't already
+    been done by this process. A file is only remembered once both have
+    succeeded, so after an error, such as the database being locked, the
+    next call tries again.
+
+    Raises:
+        sqlite3.Error
+    """
+    path = os.path.abspath(dbPath)
+    with _migrateLock:
+        if path in _migratedPaths:
+            return
+        conn = sqlite3.connect(path)
+        try:
+            Migrate(conn, dbg)
+            # WAL mode is stored in the file, so this only changes anything
+            # the first time. It can't be done inside a transaction.
+            conn.execute('PRAGMA journal_mode = WAL')
+        finally:
+            conn.close()
+        _migratedPaths.add(path)
+
+
+def ReadOnlyConnection(dbPath):
+    """Open a read-only connection, tuned for scanning, for a database
+    which has been through MigrateOnce().
+
+    The connection is in autocommit mode, so run 'BEGIN' before a group of
+    queries which should all see the same snapshot, and commit() after them.
+
+    Raises:
+        sqlite3.Error
+    """
+    path = os.path.abspath(dbPath)
+    if sys.version_info >= (3, 4):
+        from urllib.request import pathname2url
+        conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(path), uri=True)
+    else:
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA query_only = ON')
+    conn.isolation_level = None
+    conn.execute('PRAGMA mmap_size = %d' % READER_MMAP_SIZE)
+    conn.execute('PRAGMA cache_size = %d' % READER_CACHE_SIZE)
+    return conn
+
+
+# Queries which run on every graph update or download, as (where, sql).
+# Parameters are all bound to 0, which doesn't affect the query plan.
+HOT_QUERIES = (
+    ('readRangeFromSql', 'SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds = (SELECT MIN(sysSeconds) FROM EgvRecord)'),
+    ('readRangeFromSql', 'SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds = (SELECT MAX(sysSeconds) FROM EgvRecord)'),
+    ('readDataFromSql', 'SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds <= ? AND glucose > 12 ORDER BY sysSeconds ASC LIMIT 1'),
+    ('readDataFromSql', 'SELECT glucose,trend FROM EgvRecord WHERE sysSeconds = (SELECT MAX(sysSeconds) FROM EgvRecord WHERE glucose > 12)'),
+    ('readDataFromSql', 'SELECT sysSeconds,glucose FROM Calib WHERE type=1 AND sysSeconds >= ? AND sysSeconds <= ?'),
+    ('readDataFromSql', 'SELECT sysSeconds,glucose FROM EgvRecord WHERE glucose > 12 AND sysSeconds BETWEEN ?-300 AND ?+300 ORDER BY ABS(sysSeconds - ?) LIMIT 1'),
+    ('readDataFromSql', 'SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds'),
+    ('readDataFromSql', 'SELECT sysSeconds,dispSeconds,meterSeconds,type,subtype,value,xoffset,yoffset FROM UserEvent WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds-dispSeconds+meterSeconds'),
+    ('readDataFromSql', 'SELECT sysSeconds,message,xoffset,yoffset FROM UserNote WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds'),
+    ('readDataFromSql', 'SELECT insertSeconds FROM SensorInsert WHERE sysSeconds = (SELECT MAX(sysSeconds) FROM SensorInsert WHERE state = 7)'),
+    ('updateEvents', 'SELECT sysSeconds,dispSeconds,meterSeconds,type,subtype,value,xoffset,yoffset FROM UserEvent WHERE sysSeconds-dispSeconds+meterSeconds=?'),
+    ('dailysummary.QueryRange', 'SELECT sysSeconds,glucose FROM EgvRecord WHERE glucose > 12 AND sysSeconds >= ? AND sysSeconds <= ?'),
+    ('sensorsession.UpdateForReadings', 'SELECT startSeconds,endSeconds,endState,transmitter,warmupEndSeconds,readingCount,specialCount,gapCount,firstSeconds,lastSeconds FROM SensorSession WHERE startSeconds <= ? AND (endSeconds IS NULL OR endSeconds > ?)'),
+    ('sensorsession.UpdateForInserts', 'SELECT sysSeconds, insertSeconds, state, transmitter FROM SensorInsert WHERE sysSeconds >= ? ORDER BY sysSeconds'),
+    ('sensorsession._countReadings', 'SELECT sysSeconds, glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds < ? ORDER BY sysSeconds'),
+    ('signalgaps.UpdateForReadings', 'SELECT MAX(sysSeconds) FROM EgvRecord WHERE sysSeconds < ?'),
+    ('signalgaps.UpdateForReadings', 'SELECT MIN(startSeconds) FROM SignalGap WHERE endSeconds >= ?'),
+    ('signalgaps.QueryIntervals', 'SELECT kind,startSeconds,endSeconds,glucose,count,ended FROM SignalGap WHERE endSeconds >= ? AND startSeconds <= ? ORDER BY startSeconds'),
+)
+
+def CheckQueryPlans(curs):
+    """Returns a list of (where, sql, plan) for each hot query which
+    would scan a whole table or index"""
+    failures = []
+    for (where, sql) in HOT_QUERIES:
+        curs.execute('EXPLAIN QUERY PLAN ' + sql, (0,) * sql.count('?'))
+        # The last column of each row describes a step of the plan
+        plan = [row[-1] for row in curs.fetchall()]
+        if any(step.startswith('SCAN ') for step in plan):
+            failures.append((where, sql, plan))
+    return failures
+
+
+if __name__ == '__main__':
+    # Check the migrations and query plans on a database in the original
+    # DexcTrack schema, or on a copy of one given on the command line.
+    import shutil
+    import tempfile
+
+    def createOriginal(curs):
+        # The tables as the first releases created them, with some readings
+        curs.execute('CREATE TABLE EgvRecord( sysSeconds INT PRIMARY KEY, dispSeconds INT, full_glucose INT, glucose INT, testNum INT, trend INT);')
+        curs.execute('CREATE TABLE UserEvent( sysSeconds INT PRIMARY KEY, dispSeconds INT, meterSeconds INT, type INT, subtype INT, value INT, xoffset REAL, yoffset REAL);')
+        curs.execute('CREATE TABLE Config( id INT PRIMARY KEY CHECK (id = 0), displayLow REAL, displayHigh REAL, legendX REAL, legendY REAL, glUnits STR);')
+        curs.execute('CREATE TABLE SensorInsert( sysSeconds INT PRIMARY KEY, dispSeconds INT, insertSeconds INT, state INT, number INT, transmitter STR);')
+        curs.execute('CREATE TABLE Calib( sysSeconds INT PRIMARY KEY, dispSeconds INT, meterSeconds INT, type INT, glucose INT, testNum INT, xx INT);')
+        curs.execute('CREATE TABLE UserNote( sysSeconds INT PRIMARY KEY, message TEXT, xoffset REAL, yoffset REAL);')
+        curs.execute('CREATE TABLE UserSettings( sysSeconds INT PRIMARY KEY, dispSeconds INT);')
+        curs.executemany('INSERT INTO EgvRecord VALUES (?, ?, ?, ?, ?, ?)',
+                         [(500000000 + 300 * i, 499996400 + 300 * i, 100 + i % 50, 100 + i % 50, i, 20)
+                          for i in range(3 * 288)])
+        curs.execute('INSERT INTO SensorInsert VALUES (500000000, 499996400, 500000000, 7, 0, ?)', ('TX1',))
+        curs.execute('INSERT INTO Config VALUES (0, 75.0, 180.0, 0.0, 0.0, ?)', ('mg/dL',))
+
+    tempDir = tempfile.mkdtemp()
+    try:
+        dbPath = os.path.join(tempDir, 'check.sqlite')
+        if len(sys.argv) > 1:
+            shutil.copyfile(sys.argv[1], dbPath)
+        else:
+            conn = sqlite3.connect(dbPath)
+            createOriginal(conn.cursor())
+            conn.commit()
+            conn.close()
+        conn = sqlite3.connect(dbPath)
+        readingCount = conn.execute('SELECT count(*) FROM EgvRecord').fetchone()[0]
+        conn.close()
+
+        MigrateOnce(dbPath, dbg=True)
+        # Check through the same kind of connection as the display uses
+        conn = ReadOnlyConnection(dbPath)
+        curs = conn.cursor()
+        version = curs.execute('PRAGMA user_version').fetchone()[0]
+        journalMode = curs.execute('PRAGMA journal_mode').fetchone()[0]
+        print('Schema version', version, ', journal mode', journalMode)
+        schemaOk = (version == SCHEMA_VERSION) and (journalMode == 'wal')
+        curs.execute("SELECT name FROM sqlite_master WHERE type='index'")
+        indexNames = set(row[0] for row in curs.fetchall())
+        wanted = [sql.split()[5] for sql in INDEXES + (signalgaps.CREATE_INDEX_SQL,)]
+        missing = [name for name in wanted if name not in indexNames]
+        missing.extend(table for table in TIME_TABLES if not _hasIntegerKey(curs, table))
+        missing.extend(table for table in ('DailySummary', 'SensorSession', 'SignalGap')
+                       if not _tableExists(curs, table))
+        if _tableExists(curs, 'UserSettings'):
+            missing.append('UserSettings was not dropped')
+        rowsOk = curs.execute('SELECT count(*) FROM EgvRecord').fetchone()[0] == readingCount
+        failures = CheckQueryPlans(curs)
+        conn.close()
+
+        # Migrating again changes nothing
+        conn = sqlite3.connect(dbPath)
+        againOk = Migrate(conn) == SCHEMA_VERSION
+        conn.close()
+    finally:
+        shutil.rmtree(tempDir)
+
+    print('Schema version and WAL mode :', 'OK' if schemaOk else 'FAILED')
+    print('Tables and indexes :', 'OK' if not missing else 'FAILED, missing %s' % ', '.join(missing))
+    print('%d readings kept :' % readingCount, 'OK' if rowsOk else 'FAILED')
+    print('Migrating again :', 'OK' if againOk else 'FAILED')
+    for (where, sql, plan) in failures:
+        print('Full scan in %s :\n    %s\n    %s' % (where, sql, plan))
+    print('%d of %d hot queries use an index' % (len(HOT_QUERIES) - len(failures), len(HOT_QUERIES)))
+    sys.exit(0 if (schemaOk and not missing and rowsOk and againOk and not failures) else 1)
@@ -0,0 +1,284 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file tracks which Dexcom receivers are plugged in, and publishes
+# 'attach' and 'detach' events to subscribers. Callers only need to talk
+# to a receiver over serial when one of these events arrives, rather than
+# probing the serial port on every poll.
+#
+# The events come from an event source. UdevEventSource uses udev hotplug
+# notifications on Linux. PollingEventSource periodically enumerates the
+# serial ports, which is much cheaper than sending serial commands, and
+# works on every platform. FakeEventSource is driven by hand, for testing.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import sys
+import threading
+import constants
+import util
+
+ATTACH = 'attach'
+DETACH = 'detach'
+
+
+#---------------------------------------------------------
+class FakeEventSource(object):
+    """An event source driven by calls to attach() and detach()."""
+
+    def __init__(self, ports=None):
+        self._initialPorts = list(ports or [])
+        self._emit = None
+
+    def start(self, emit):
+        self._emit = emit
+        for port in self._initialPorts:
+            emit(ATTACH, port)
+        return True
+
+    def stop(self):
+        self._emit = None
+
+    def attach(self, port):
+        if self._emit:
+            self._emit(ATTACH, port)
+
+    def detach(self, port):
+        if self._emit:
+            self._emit(DETACH, port)
+
+
+#---------------------------------------------------------
+class PollingEventSource(object):
+    """An event source which enumerates the serial ports every 'interval'
+    seconds and reports the differences."""
+
+    def __init__(self, vendor=constants.DEXCOM_USB_VENDOR,
+                 product=constants.DEXCOM_USB_PRODUCT, interval=3.0):
+        self.vendor = vendor
+        self.product = product
+        self.interval = interval
+        self._evobj = threading.Event()
+        self._thread = None
+
+    def _scan(self):
+        try:
+            return set(util.find_all_usbserial(self.vendor, self.product))
+        except NotImplementedError as e:
+            if sys.version_info < (3, 0):
+                sys.exc_clear()
+            return set()
+
+    def _run(self, emit):
+        present = set()
+        while True:
+            ports = self._scan()
+            for port in sorted(present - ports):
+                emit(DETACH, port)
+            for port in sorted(ports - present):
+                emit(ATTACH, port)
+            present = ports
+            # wait returns True if stop() set the event object
+            if self._evobj.wait(timeout=self.interval):
+                return
+
+    def start(self, emit):
+        self._evobj.clear()
+        self._thread = threading.Thread(target=self._run, args=(emit,),
+                                        name='Device poll thread')
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._evobj.set()
+        if self._thread is not None:
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
+
+
+#---------------------------------------------------------
+class UdevEventSource(object):
+    """An event source using udev hotplug notifications. start() returns
+    False if these are not available on this system."""
+
+    def __init__(self, vendor=constants.DEXCOM_USB_VENDOR,
+                 product=constants.DEXCOM_USB_PRODUCT):
+        self.vendor = vendor
+        self.product = product
+        self._observer = None
+
+    def start(self, emit):
+        def handleHotplug(action, device_node):
+            if action == 'add':
+                emit(ATTACH, device_node)
+            else:
+                emit(DETACH, device_node)
+
+        self._observer = util.usb_hotplug_observer(self.vendor, self.product, handleHotplug)
+        if self._observer is None:
+            return False
+        # Report any devices which were plugged in before we started watching
+        for port in util.find_all_usbserial(self.vendor, self.product):
+            emit(ATTACH, port)
+        return True
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+
+#---------------------------------------------------------
+class PresenceMonitor(object):
+    """Keep track of the attached receivers, and tell subscribers about
+    each change.
+
+    Subscribers are called as callback(event, port), where event is ATTACH
+    or DETACH. Callbacks run on the event source's thread, so they should
+    do little more than wake up the thread which will act on the change.
+    Repeated events for the same port and state are suppressed.
+    """
+
+    def __init__(self, source=None, pollInterval=3.0):
+        self.source = source
+        self.pollInterval = pollInterval
+        self._lock = threading.Lock()
+        self._ports = []
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def ports(self):
+        # Ports in the order in which they were attached
+        with self._lock:
+            return list(self._ports)
+
+    def isPresent(self, port=None):
+        with self._lock:
+            if port is None:
+                return len(self._ports) > 0
+            return port in self._ports
+
+    def _emit(self, event, port):
+        with self._lock:
+            if event == ATTACH:
+                if port in self._ports:
+                    return
+                self._ports.append(port)
+            else:
+                if port not in self._ports:
+                    return
+                self._ports.remove(port)
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(event, port)
+
+    def start(self):
+        if self.source is None:
+            self.source = UdevEventSource()
+            if self.source.start(self._emit):
+                return
+            self.source = PollingEventSource(interval=self.pollInterval)
+        self.source.start(self._emit)
+
+    def stop(self):
+        if self.source is not None:
+            self.source.stop()
+
+
+if __name__ == '__main__':
+    # Check the monitor against scripted event sources. Then, with '-w',
+    # report real receivers as they are plugged in or removed.
+    events = []
+
+    def recordEvent(event, port):
+        events.append((event, port))
+
+    fake = FakeEventSource(['/dev/ttyACM0'])
+    monitor = PresenceMonitor(fake)
+    monitor.subscribe(recordEvent)
+    monitor.start()
+    fake.attach('/dev/ttyACM1')
+    fake.attach('/dev/ttyACM0')     # already attached
+    fake.detach('/dev/ttyACM2')     # never attached
+    fake.detach('/dev/ttyACM0')
+    portsOk = (monitor.ports() == ['/dev/ttyACM1']) and monitor.isPresent() and \
+              monitor.isPresent('/dev/ttyACM1') and not monitor.isPresent('/dev/ttyACM0')
+    monitor.unsubscribe(recordEvent)
+    fake.detach('/dev/ttyACM1')
+    monitor.stop()
+    fake.attach('/dev/ttyACM3')     # after stop()
+    # A subscriber would probe the serial port once for each of these
+    fakeOk = portsOk and (events == [(ATTACH, '/dev/ttyACM0'), (ATTACH, '/dev/ttyACM1'),
+                                     (DETACH, '/dev/ttyACM0')]) and \
+             (monitor.ports() == []) and not monitor.isPresent()
+    print('Fake source : %d events,' % len(events), 'OK' if fakeOk else 'FAILED')
+
+    # Polling reports only the differences between successive scans
+    class ScriptedPollingSource(PollingEventSource):
+        def __init__(self, scans):
+            PollingEventSource.__init__(self, interval=0.01)
+            self.scans = list(scans)
+            self.finished = threading.Event()
+
+        def _scan(self):
+            if not self.scans:
+                # Every scripted scan has been reported
+                self.finished.set()
+                return set()
+            return set(self.scans.pop(0))
+
+    del events[:]
+    polling = ScriptedPollingSource([[], ['/dev/a'], ['/dev/a'], ['/dev/a', '/dev/b'], ['/dev/b'], []])
+    monitor = PresenceMonitor(polling)
+    monitor.subscribe(recordEvent)
+    monitor.start()
+    polling.finished.wait(5.0)
+    monitor.stop()
+    pollOk = (events == [(ATTACH, '/dev/a'), (ATTACH, '/dev/b'), (DETACH, '/dev/a'), (DETACH, '/dev/b')])
+    print('Polling source : %d events,' % len(events), 'OK' if pollOk else 'FAILED')
+    if not (fakeOk and pollOk):
+        sys.exit(1)
+
+    if '-w' in sys.argv[1:]:
+        def showEvent(event, port):
+            print(event, port)
+
+        monitor = PresenceMonitor()
+        monitor.subscribe(showEvent)
+        monitor.start()
+        print('Watching for Dexcom receivers using', type(monitor.source).__name__)
+        try:
+            while True:
+                threading.Event().wait(3600)
+        except KeyboardInterrupt:
+            monitor.stop()
+    sys.exit(0)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This is a headless service which downloads data from every attached Dexcom
+# receiver. Each receiver gets its own download loop, and its own database,
+# named dexc_<SERIAL_NUMBER>.sqlite, just as DexcTrack would use. So the
+# databases can be viewed with DexcTrack at any time.
+#
+# The loops run as asyncio tasks. Each serial command has its own timeout,
+# and each download has an overall timeout, while SQL work is done on
+# executor threads. So a failing or slow receiver can't stall the others.
+#
+# Per-device sync statistics are printed in debug mode, and may also be
+# served as JSON over HTTP, with the '--http <port>' option.
+#
+# This file requires python 3.7 or newer.
+#
+###############################################################################
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import time
+import alerts
+import asyncreceiver
+import devicepresence
+
+# Seconds between downloads. Receivers record a reading every 5 minutes.
+DEFAULT_INTERVAL = 300
+# After a failure, retry with exponential backoff from RETRY_BASE_DELAY
+# up to the normal download interval
+RETRY_BASE_DELAY = 5.0
+# The longest we'll wait for one complete download
+SYNC_TIMEOUT = 240.0
+# After this many failures in a row, close the serial port and open it again
+REOPEN_FAILURES = 3
+
+
+class DeviceSync(object):
+    """The download loop, and its statistics, for the receiver on one port."""
+
+    def __init__(self, port, sqlprefix, interval, dbg=False, alertEngine=None):
+        self.port = port
+        self.alertEngine = alertEngine
+        self.sqlprefix = sqlprefix
+        self.interval = interval
+        self.debug = dbg
+        self.task = None
+        self.serialNum = None
+        self.devType = None
+        self.dbPath = None
+        self.state = 'starting'
+        self.syncCount = 0
+        self.failCount = 0
+        self.consecutiveFailures = 0
+        self.reopenCount = 0
+        # An SQL write left running by a download which timed out
+        self.pendingWrite = None
+        self.lastStatus = None
+        self.lastError = None
+        self.lastSyncTime = None
+        self.lastSyncSeconds = None
+        self.totalSyncSeconds = 0.0
+        self.attachTime = time.time()
+
+    def stats(self):
+        if self.syncCount:
+            meanSyncSeconds = round(self.totalSyncSeconds / self.syncCount, 3)
+        else:
+            meanSyncSeconds = None
+        return {
+            'port': self.port,
+            'serialNumber': self.serialNum,
+            'deviceType': self.devType,
+            'database': self.dbPath,
+            'state': self.state,
+            'syncCount': self.syncCount,
+            'failCount': self.failCount,
+            'consecutiveFailures': self.consecutiveFailures,
+            'reopenCount': self.reopenCount,
+            'lastStatus': self.lastStatus,
+            'lastError': self.lastError,
+            'lastSyncTime': self.lastSyncTime,
+            'lastSyncSeconds': self.lastSyncSeconds,
+            'meanSyncSeconds': meanSyncSeconds,
+            'attachTime': datetime.datetime.fromtimestamp(self.attachTime).isoformat(),
+        }
+
+    def retryDelay(self):
+        delay = min(RETRY_BASE_DELAY * 2 ** (self.consecutiveFailures - 1), self.interval)
+        # Add jitter, so that receivers which failed together don't retry together
+        return delay * random.uniform(0.5, 1.0)
+
+    def _failed(self, status, error):
+        self.failCount += 1
+        self.consecutiveFailures += 1
+        self.lastStatus = status
+        self.lastError = error
+        self.state = 'retrying'
+
+    async def waitForWrite(self):
+        # A timeout only cancels the coroutine awaiting the SQL write. The
+        # write itself keeps going on its thread, so don't start another
+        # one on the same database until it has finished.
+        if (self.pendingWrite is not None) and not self.pendingWrite.done():
+            self.state = 'waiting for write'
+            if self.debug:
+                print('%s %s : waiting for an earlier SQL write to finish' % (self.port, self.serialNum))
+            await asyncio.wait([self.pendingWrite])
+        if self.pendingWrite is not None:
+            if not self.pendingWrite.cancelled() and (self.pendingWrite.exception() is not None) and self.debug:
+                print('%s %s : earlier SQL write failed : %r' % (self.port, self.serialNum, self.pendingWrite.exception()))
+            self.pendingWrite = None
+
+    async def syncOnce(self, dex):
+        await self.waitForWrite()
+        self.state = 'syncing'
+        startTime = time.time()
+        try:
+            status = await asyncio.wait_for(dex.download_to_db(self.dbPath), SYNC_TIMEOUT)
+        except asyncio.TimeoutError:
+            status = 2
+            if (dex.write_future is not None) and not dex.write_future.done():
+                self.pendingWrite = dex.write_future
+        elapsed = time.time() - startTime
+        if status == 0:
+            self.syncCount += 1
+            self.consecutiveFailures = 0
+            self.lastStatus = 0
+            self.lastError = None
+            self.lastSyncTime = datetime.datetime.now().isoformat()
+            self.lastSyncSeconds = round(elapsed, 3)
+            self.totalSyncSeconds += elapsed
+            self.state = 'idle'
+        else:
+            self._failed(status, 'download failed with status %d' % status)
+        if self.debug:
+            print('%s %s : sync status %d in %.2f seconds' % (self.port, self.serialNum, status, elapsed))
+        return status
+
+    async def loadAlertSettings(self, dex):
+        # Alert on the receiver's own settings, or the defaults if they can't be read
+        try:
+            records = await dex.read_last_records('USER_SETTING_DATA')
+        except Exception as e:
+            if self.debug:
+                print('%s : Unable to read alert settings : %r' % (self.port, e))
+            return
+        if records:
+            userSettings = records[-1]
+            self.alertEngine.setSettings(alerts.AlertSettings(lowAlert=userSettings.lowAlert,
+                                                              highAlert=userSettings.highAlert,
+                                                              fallRate=userSettings.fallRate,
+                                                              riseRate=userSettings.riseRate),
+                                         self.dbPath)
+
+    async def run(self):
+        while True:
+            try:
+                async with asyncreceiver.AsyncDexcom(self.port, dbg=self.debug) as dex:
+                    self.state = 'identifying'
+                    self.devType = await dex.get_device_type()
+                    self.serialNum = await dex.read_serial_number()
+                    if not self.serialNum:
+                        raise ValueError('no serial number')
+                    self.dbPath = '%s%s.sqlite' % (self.sqlprefix, self.serialNum)
+                    if self.alertEngine is not None:
+                        await self.loadAlertSettings(dex)
+                    while True:
+                        if await self.syncOnce(dex) == 0:
+                            await asyncio.sleep(self.interval)
+                        else:
+                            await asyncio.sleep(self.retryDelay())
+                            if self.consecutiveFailures % REOPEN_FAILURES == 0:
+                                # Retrying on the same handle isn't working.
+                                # Close the port, and open it again.
+                                if self.debug:
+                                    print('%s : reopening after %d failures' % (self.port, self.consecutiveFailures))
+                                self.state = 'reopening'
+                                self.reopenCount += 1
+                                break
+            except asyncio.CancelledError:
+                self.state = 'detached'
+                raise
+            except Exception as e:
+                # Couldn't open or identify the receiver. Start over shortly.
+                self._failed(None, repr(e))
+                if self.debug:
+                    print('%s : %r' % (self.port, e))
+                await asyncio.sleep(self.retryDelay())
+
+
+class IngestService(object):
+    """Start a DeviceSync for each receiver as it's attached, and cancel it
+    when the receiver is removed."""
+
+    def __init__(self, sqlprefix, interval=DEFAULT_INTERVAL, dbg=False, presence=None, alertEngine=None):
+        self.sqlprefix = sqlprefix
+        self.alertEngine = alertEngine
+        self.interval = interval
+        self.debug = dbg
+        self.presence = presence or devicepresence.PresenceMonitor()
+        self.devices = {}
+        self.startTime = time.time()
+        self._loop = None
+
+    def stats(self):
+        return {
+            'uptimeSeconds': round(time.time() - self.startTime, 1),
+            'devices': [dev.stats() for dev in self.devices.values()],
+        }
+
+    def _presenceEvent(self, event, port):
+        # Called on the presence monitor's thread
+        self._loop.call_soon_threadsafe(self._handleEvent, event, port)
+
+    def _handleEvent(self, event, port):
+        if self.debug:
+            print('%s %s at %s' % (event, port, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        if event == devicepresence.ATTACH:
+            if port not in self.devices:
+                dev = DeviceSync(port, self.sqlprefix, self.interval, self.debug, self.alertEngine)
+                dev.task = self._loop.create_task(dev.run())
+                self.devices[port] = dev
+        else:
+            dev = self.devices.pop(port, None)
+            if dev is not None:
+                dev.task.cancel()
+
+    async def _handleHttp(self, reader, writer):
+        try:
+            await asyncio.wait_for(reader.readline(), 5.0)
+            body = json.dumps(self.stats(), indent=2).encode('utf8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: application/json\r\n'
+                         b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, httpPort=None, statsPeriod=None):
+        self._loop = asyncio.get_event_loop()
+        server = None
+        if httpPort:
+            server = await asyncio.start_server(self._handleHttp, '127.0.0.1', httpPort)
+        self.presence.subscribe(self._presenceEvent)
+        self.presence.start()
+        try:
+            while True:
+                await asyncio.sleep(statsPeriod or 3600)
+                if statsPeriod:
+                    print(json.dumps(self.stats(), indent=2))
+        finally:
+            self.presence.stop()
+            for dev in self.devices.values():
+                dev.task.cancel()
+            if server is not None:
+                server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download data from all attached Dexcom receivers')
+    parser.add_argument("-d", "--debug", help="enable debug mode", action="store_true")
+    parser.add_argument("-i", "--interval", help="seconds between downloads (default %d)" % DEFAULT_INTERVAL,
+                        type=int, default=DEFAULT_INTERVAL)
+    parser.add_argument("--http", help="serve per-device sync statistics as JSON on this local port", type=int)
+    parser.add_argument("--dir", help="folder for the database files (default is your home folder)", type=str,
+                        default=os.path.expanduser('~'))
+    parser.add_argument("--notify", help="show desktop notifications of glucose alerts", action="store_true")
+    parser.add_argument("--alert-cmd", help="run this shell command for each glucose alert, described in DEXC_* environment variables",
+                        type=str)
+    args = parser.parse_args()
+
+    # Alerts are checked on the executor threads, as each download is committed
+    alertEngine = None
+    if args.notify or args.alert_cmd:
+        alertEngine = alerts.AlertEngine(dbg=args.debug)
+        if args.notify:
+            alertEngine.addHook(alerts.DesktopHook())
+        if args.alert_cmd:
+            alertEngine.addHook(alerts.CommandHook(args.alert_cmd))
+        alertEngine.attach()
+
+    service = IngestService(os.path.join(args.dir, 'dexc_'), args.interval, args.debug, alertEngine=alertEngine)
+    try:
+        asyncio.run(service.run(args.http, statsPeriod=60 if args.debug else None))
+    except KeyboardInterrupt:
+        pass
@@ -20,6 +20,14 @@
 # Support python3 print syntax in python2
 from __future__ import print_function
 
+import time
+# Startup phases, as (description, seconds since startup), for the
+# '--startup' report. See markStartup() and reportStartup().
+startupTime = time.time()
+startupPhases = []
+def markStartup(phase):
+    startupPhases.append((phase, time.time() - startupTime))
+
 import os
 import sys
 import glob
@@ -27,10 +35,10 @@ import sqlite3
 import datetime
 import threading
 import argparse
-import math
-from collections import deque
+markStartup('import standard modules')
 import tzlocal
 import pytz
+markStartup('import tzlocal, pytz')
 import matplotlib as mpl
 # To force use of a particular backend, uncomment one of the following:
 #mpl.use('TkAgg')
@@ -45,11 +53,26 @@ import matplotlib.dates as mdates
 from matplotlib.widgets import Slider
 from matplotlib.widgets import TextBox
 #from matplotlib.widgets import Button
+markStartup('import matplotlib')
 import numpy as np
+markStartup('import numpy')
 
-import readReceiver
+# The serial port stack (readReceiver, devicepresence) isn't needed
+# to draw the first graph, so it's imported when device seeking starts.
 import constants
 import screensize
+import pollscheduler
+import changefeed
+import dailysummary
+import dbschema
+import sqlwindow
+import timeconv
+import agp
+import alerts
+import trend
+import uiqueue
+import writebehind
+markStartup('import DexcTrack modules')
 
 
 dexctrackVersion = 3.9
@@ -69,6 +92,10 @@ parser.add_argument("-u", "--units", help="display alternate glucose units (mmol
 parser.add_argument("-x", "--xsize", help="specify width in pixels", type=int)
 parser.add_argument("-y", "--ysize", help="specify height in pixels", type=int)
 parser.add_argument("-t", "--timeoffset", help="specify a time offset for data. Format = {-}<hours>{:<min>{:<sec>}}", type=str)
+parser.add_argument("--startup", help="report startup timing, and exit once the first graph is drawn", action="store_true")
+parser.add_argument("--agp", help="start with an Ambulatory Glucose Profile of this many days drawn over the graph. The 'a' key cycles through 14 days, 90 days and off.", type=int, choices=[14, 90])
+parser.add_argument("--notify", help="show desktop notifications of glucose alerts", action="store_true")
+parser.add_argument("--alert-cmd", help="run this shell command for each glucose alert, described in DEXC_* environment variables", type=str)
 parser.add_argument("databaseFile", nargs='?', help="optionally specified database file", type=str)
 args = parser.parse_args()
 
@@ -358,6 +385,11 @@ if args.debug:
 print('DexcTrack  Copyright (C) 2018  Steve Erlenborn')
 print('This program comes with ABSOLUTELY NO WARRANTY.\n')
 
+# If it takes longer than this many seconds from startup to drawing the
+# first graph, the startup report will say so. In debug mode, the report
+# is printed whenever the budget is exceeded.
+startupBudget = 3.0
+
 # HD monitor  = 1920 x 1080 -> 1920/1080 = 1.78
 # small laptop  1366 x  768 -> 1366/ 768 = 1.78
 # macbook pro = 1440 x 900  -> 1440/900  = 1.6
@@ -367,6 +399,7 @@ if args.xsize and args.ysize:
     height = args.ysize
 else:
     width, height = screensize.get_screen_size()
+markStartup('get screen size')
 dispRatio = round(float(width) / float(height), 1)
 if args.debug:
     print('get_screen_size width =', width, ', get_screen_size height =', height, ', dispRatio =', dispRatio)
@@ -382,6 +415,7 @@ except IOError as e:
     style.use('ggplot')
     if sys.version_info.major < 3:
         sys.exc_clear()
+markStartup('load style')
 
 #####################################################################################################################
 # The following variables are set for G4, G5, or G6 devices. They might need to be altered for others.
@@ -391,6 +425,8 @@ meterSamplingPeriod = 60.0*5    # Dexcom will take a reading every 5 minutes, so
 minDisplayLow = 40              # the minimum glucose value Dexcom can detect
 maxDisplayHigh = 400            # the maximum glucose value Dexcom can detect
 sensorWarmupPeriod = 60*60*2    # 2 hours, in seconds
+maxSkippedReads = 5             # polls without a new glucose reading before we download anyway,
+                                # so calibrations, events, and sensor inserts or stops still arrive
 
 #####################################################################################################################
 # The following are user interface defaults.
@@ -413,10 +449,6 @@ lastPowerState = None
 powerLevel = 0
 lastPowerLevel = 0
 
-# Constants for use in SQL retrieve operations. We'll collect data
-# for (ninetyDaysInSeconds + bufferSeconds) at a time.
-ninetyDaysInSeconds = 60*60*24*90
-bufferSeconds = 60*60*24*15
 hourSeconds = 60*60
 
 graphHeightInFigure = graphTop - graphBottom
@@ -446,10 +478,17 @@ lastRealGluc = 0
 xnorm = []
 ynorm = []
 meanPlot = None
+# Rows of the records in the SQL window, each starting with its time as a
+# matplotlib date number
 eventList = []
 noteList = []
 calibList = []
 egvList = []
+# The times of egvList rows, as a numpy array of receiver seconds
+egvSeconds = np.zeros(0, dtype=np.int64)
+# The ranges of special glucose values, as [start, end] date numbers, from
+# the SignalGap table, or None if they have to be found from egvList
+specialZones = None
 dis_annot = None
 linePlot = None
 egvScatter = None
@@ -528,6 +567,33 @@ unitRead = None
 newRange = True
 disconUtcTime = datetime.datetime.min
 disconText = None
+# Updates from other threads, to be run on the main thread
+uiQueue = uiqueue.UiQueue()
+# The read-only database connection used by the main thread, and its file
+uiConn = None
+uiConnFile = None
+# The last PRAGMA data_version seen on uiConn, and the change feed's count
+# of this process's changes at the time. uiChanges counts the changes
+# made by other processes.
+uiDataVersion = None
+uiChangeCount = 0
+uiChanges = 0
+# Recently read SQL windows, and prefetches of the ones we're heading towards
+sqlWindows = sqlwindow.WindowManager(dbg=args.debug)
+# Recently used windows, decoded into egvList, calibList, eventList and noteList
+decodedWindows = sqlwindow.DecodedCache()
+# Checks each new reading for glucose alerts, if any were asked for
+alertEngine = None
+alertSettingsFile = None    # the database whose receiver's settings are in use
+if args.notify or args.alert_cmd:
+    alertEngine = alerts.AlertEngine(dbg=args.debug)
+    if args.notify:
+        alertEngine.addHook(alerts.DesktopHook())
+    if args.alert_cmd:
+        alertEngine.addHook(alerts.CommandHook(args.alert_cmd))
+    alertEngine.attach(changefeed.defaultFeed)
+# Debounced writes of configuration, notes and annotation positions
+writeBehind = writebehind.WriteBehind(onFlushed=lambda dbPath, keys: onDbWritten(dbPath, keys))
 # Number of digits to display after the decimal point for Target Range values
 tgtDecDigits = 0
 dayRotation = 30
@@ -546,7 +612,13 @@ calibFontSize = 'medium'
 eventFontSize = 16
 firstPlotGraph = 1
 cfgScale = (displayRange - displayRangeMin) / (displayRangeMax - displayRangeMin) * 100.0
-futurePlot = [None, None, None, None]
+# Days of readings in the Ambulatory Glucose Profile overlay, or 0 if it's off
+agpDays = args.agp or 0
+agpArtists = []
+agpDrawnKey = None
+futurePlot = None   # prediction line, from the trend filter
+futureBand = None   # its 95% confidence band
+trendTracker = trend.TrendTracker()
 futureSecs = 60 * 60    # predict values one hour into the future
 future_patch = None
 cfgOffsetSeconds = 0  # database configured time shift
@@ -684,10 +756,15 @@ def SetCurrentSqlSelectRange(calledFromPlotGraph=False):
                            max(lastTestSysSecs + futureSecs - firstTestSysSecs - displayRange, 0))
     displayEndSecs = min(displayStartSecs + displayRange, lastTestSysSecs + futureSecs)
 
+    # Start reading the windows we're heading towards, in the background
+    if sqlite_file:
+        sqlWindows.track(sqlite_file, displayEndSecs - offsetSeconds, firstTestSysSecs - offsetSeconds,
+                         lastTestSysSecs - offsetSeconds + futureSecs)
+
     if (displayStartSecs < curSqlMinTime) or (displayEndSecs > curSqlMaxTime):
         # the range of data we need is outside of the last retrieved one
-        curSqlMinTime = max(displayEndSecs - offsetSeconds - ninetyDaysInSeconds - bufferSeconds, firstTestSysSecs - offsetSeconds)
-        curSqlMaxTime = min(max(displayEndSecs - offsetSeconds + bufferSeconds, curSqlMinTime + ninetyDaysInSeconds + bufferSeconds), lastTestSysSecs - offsetSeconds + futureSecs)
+        curSqlMinTime, curSqlMaxTime = sqlwindow.WindowBounds(displayEndSecs - offsetSeconds, firstTestSysSecs - offsetSeconds,
+                                                              lastTestSysSecs - offsetSeconds + futureSecs)[1:]
         #qtime = ReceiverTimeToUtcTime(curSqlMinTime)
         #rtime = ReceiverTimeToUtcTime(curSqlMaxTime)
         newRange = True
@@ -825,8 +902,8 @@ def displayCurrentRange():
     if displayEndSecs > dispBegin:
         try:
             # the following can cause 'RuntimeError: dictionary changed size during iteration'
-            ax.set_xlim(mdates.date2num(ReceiverTimeToUtcTime(dispBegin)),
-                        mdates.date2num(ReceiverTimeToUtcTime(displayEndSecs)))
+            ax.set_xlim(timeconv.ReceiverSecondsToNum(dispBegin),
+                        timeconv.ReceiverSecondsToNum(displayEndSecs))
             #if args.debug:
                 #print('displayCurrentRange() before fig.canvas.draw_idle(), count =',len(muppy.get_objects()))
             fig.canvas.draw_idle()   # each call generates new references to 120 - 300 objects
@@ -897,6 +974,10 @@ class deviceReadThread(threading.Thread):
         self.evobj = threading.Event()
         self.restart = False
         self.firstDelayPeriod = 0
+        # Consecutive polls which skipped the download
+        self.skippedReads = 0
+        # Times our reads to land just after the receiver makes each reading
+        self.scheduler = pollscheduler.PollScheduler(period=meterSamplingPeriod)
         if args.debug:
             print('deviceReadThread launched at', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
@@ -920,49 +1001,74 @@ class deviceReadThread(threading.Thread):
         global receiverInstance
         global lastRealGluc
         global lastTrend
+        global powerState
+        global powerLevel
         while True:
             if self.restart is True:
                 self.restart = False
             else:
-                if stat_text:
-                    stat_text.set_text('Reading\nReceiver\nDevice')
-                    stat_text.set_backgroundcolor('yellow')
-                    stat_text.draw(fig.canvas.get_renderer())
+                uiQueue.post('status', setStatusText, 'Reading\nReceiver\nDevice', 'yellow')
 
                 if args.debug:
                     print('Reading device at', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
                 if sqlite_file is not None:
-                    if appendable_db:
+                    if receiverInstance is None:
+                        receiverInstance = getReceiverInstance()
+                    newData = False
+                    read_status = 2
+                    if receiverInstance:
+                        # A quick look at the newest readings tells us whether there's
+                        # anything new to download, and when the next reading is due.
+                        egvTimes, receiverNow, read_status = receiverInstance.GetRecentEgvTimes(12)
+                        if read_status == 0:
+                            newData = self.scheduler.learn(egvTimes, receiverNow)
+                    #else:
+                        #print('deviceReadThread.run() receiverInstance = NULL')
+
+                    if read_status != 0:
+                        if not appendable_db:
+                            lastRealGluc = 0
+                    elif (not newData) and (self.skippedReads < maxSkippedReads):
+                        # Other records, like calibrations and events, are only checked
+                        # by a download, so don't skip more than a few in a row.
+                        self.skippedReads += 1
+                        if args.debug:
+                            print('deviceReadThread.run() : No new readings, so skipping this read')
+                    elif appendable_db:
+                        self.skippedReads = 0
+                        if (alertEngine is not None) and (alertSettingsFile != sqlite_file):
+                            loadAlertSettings()
                         # We probably have new records to add to the database
                         read_status = self.readIntoDbFunc(sqlite_file)
-                        if (read_status != 0) and (args.debug != 0):
-                            print('deviceReadThread.run() : Read failed with status', read_status)
-                        if read_status != 0:
-                            self.firstDelayPeriod = 5
                     else:
-                        if receiverInstance is None:
-                            receiverInstance = getReceiverInstance()
-                        if receiverInstance:
-                            curGluc, curFullTrend, read_status = receiverInstance.GetCurrentGlucoseAndTrend()
-                            if curGluc and curFullTrend and (read_status == 0):
-                                lastRealGluc = curGluc
-                                lastTrend = curFullTrend & constants.EGV_TREND_ARROW_MASK
-                            else:
-                                if read_status != 0:
-                                    self.firstDelayPeriod = 10
-                                lastRealGluc = 0
+                        self.skippedReads = 0
+                        curGluc, curFullTrend, read_status = receiverInstance.GetCurrentGlucoseAndTrend()
+                        if curGluc and curFullTrend and (read_status == 0):
+                            lastRealGluc = curGluc
+                            lastTrend = curFullTrend & constants.EGV_TREND_ARROW_MASK
                         else:
                             lastRealGluc = 0
-                            #print('deviceReadThread.run() receiverInstance = NULL')
-
-                    if stat_text:
-                        stat_text.set_text('Receiver\nDevice\nPresent')
-                        stat_text.set_backgroundcolor('tomato')
-                        stat_text.draw(fig.canvas.get_renderer())
 
                     if read_status == 0:
-                        plotGraph()    # Draw a new graph
+                        self.scheduler.done()
+                        if newData and (receiverInstance is not None):
+                            # Refresh the battery state while we're talking to the device
+                            (powerState, powerLevel) = receiverInstance.GetPowerInfo()
+                    else:
+                        if args.debug:
+                            print('deviceReadThread.run() : Read failed with status', read_status)
+                        self.scheduler.failed()
+                        if sthread is not None:
+                            # The device may have gone away, so have it probed again
+                            sthread.recheck()
+
+                    uiQueue.post('status', setStatusText, 'Receiver\nDevice\nPresent', 'tomato')
+
+                    if (read_status == 0) and newData and not appendable_db:
+                        # Nothing was stored, so the change feed won't trigger
+                        # a redraw. Ask for one directly.
+                        uiQueue.post('plot', plotGraph)
 
             if self.firstDelayPeriod != 0:
                 mydelay = float(self.firstDelayPeriod)
@@ -971,7 +1077,10 @@ class deviceReadThread(threading.Thread):
                 self.firstDelayPeriod = 0
                 waitStatus = self.evobj.wait(timeout=mydelay)   # wait up to firstDelayPeriod seconds
             else:
-                waitStatus = self.evobj.wait(timeout=meterSamplingPeriod)
+                mydelay = self.scheduler.schedule()
+                if args.debug:
+                    print('Next device read in %.1f seconds' % mydelay)
+                waitStatus = self.evobj.wait(timeout=mydelay)
 
             # waitStatus = False on timeout, True if someone set() the event object
             if waitStatus is True:
@@ -983,15 +1092,7 @@ class deviceReadThread(threading.Thread):
                     if args.debug:
                         print('deviceReadThread terminated')
                     lastRealGluc = 0
-                    try:
-                        # During shutdown, set_window_title() can fail with
-                        # "AttributeError: 'NoneType' object has no attribute 'wm_title'"
-                        fig.canvas.manager.set_window_title('DexcTrack: %s' % (serialNum))
-                    except AttributeError as e:
-                        #if args.debug:
-                            #print('deviceReadThread.run() fig.canvas.manager.set_window_title: Exception =', e)
-                        if sys.version_info.major < 3:
-                            sys.exc_clear()
+                    uiQueue.post('title', setWindowTitle, 'DexcTrack: %s' % (serialNum))
                     return  # terminate the thread
         return
 
@@ -1004,15 +1105,38 @@ class deviceSeekThread(threading.Thread):
         self.name = name
         self.connected_state = None
         self.evobj = threading.Event()
+        # Probe the device on the first pass, and after each presence change
+        self.changed = True
+        self.terminate = False
+        import devicepresence
+        self.presence = devicepresence.PresenceMonitor()
         #if args.debug:
             #print('deviceSeekThread launched, threadID =', threadID)
 
     def stop(self):
+        self.terminate = True
+        self.presence.stop()
         self.evobj.set()
         if args.debug:
             print('Turning off device seek thread at', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
+    # Called by the presence monitor, on its own thread, when a receiver
+    # is attached or detached.
+    def presenceEvent(self, event, port):
+        if args.debug:
+            print('deviceSeekThread :', event, port, 'at', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        self.recheck()
+
+    # Ask for the device to be probed again, for example after a read failure
+    def recheck(self):
+        self.changed = True
+        self.evobj.set()
+
     def run(self):
+        self.presence.subscribe(self.presenceEvent)
+        self.presence.start()
+        if args.debug:
+            print('deviceSeekThread using', type(self.presence.source).__name__)
         while True:
             global sqlite_file
             global rthread
@@ -1020,37 +1144,38 @@ class deviceSeekThread(threading.Thread):
             global receiverInstance
             global powerState
             global powerLevel
-            global lastPowerState
-            global lastPowerLevel
-            global batt_text
             global disconUtcTime
-            global disconText
 
             prior_sqlite_file = sqlite_file
             prior_connected_state = self.connected_state
             sNum = None
-            if receiverInstance is None:
-                receiverInstance = getReceiverInstance()
-                self.connected_state = False
-
-            if receiverInstance is not None:
-                (powerState, powerLevel) = receiverInstance.GetPowerInfo()
-                if powerState is None:
-                    retryTime = 3.0
+            # Without a change in device presence, there's no need to talk
+            # to the receiver. We just wake up to update the disconnect timer.
+            retryTime = 21.0
+
+            if self.changed:
+                self.changed = False
+                if self.presence.isPresent():
+                    if receiverInstance is None:
+                        receiverInstance = getReceiverInstance()
+                    if receiverInstance is not None:
+                        sNum = receiverInstance.GetSerialNumber()
+                        sqlite_file = getSqlFileName(sNum)
+                    if sNum:
+                        self.connected_state = True
+                        (powerState, powerLevel) = receiverInstance.GetPowerInfo()
+                    else:
+                        # The device is present, but not responding yet. It may
+                        # still be settling, so probe again shortly.
+                        self.connected_state = False
+                        (powerState, powerLevel) = (None, 0)
+                        self.changed = True
+                        retryTime = 3.0
                 else:
-                    retryTime = 21.0
-                sNum = receiverInstance.GetSerialNumber()
-                if not sNum:
                     self.connected_state = False
                     (powerState, powerLevel) = (None, 0)
-                    retryTime = 3.0
-                else:
-                    self.connected_state = True
-
-                sqlite_file = getSqlFileName(sNum)
-            else:
-                (powerState, powerLevel) = (None, 0)
-                retryTime = 3.0
+                    if receiverInstance is not None:
+                        sqlite_file = getSqlFileName(None)
 
             if disconTimerEnabled is True:
                 if disconUtcTime != datetime.datetime.min:
@@ -1058,16 +1183,9 @@ class deviceSeekThread(threading.Thread):
                     disconMinutes = disconDelta.total_seconds() // 60
                     if disconMinutes > 0:
                         # Show how long the Receiver has been disconnected
-                        if disconText:
-                            disconText.set_text('%d minutes' % disconMinutes)
-                        else:
-                            disconText = plt.figtext(.10, .10, '%d minutes' % disconMinutes,
-                                                     size=largeFontSize, weight='bold')
-                        plt.draw()
+                        uiQueue.post('discon', showDisconnectTime, disconMinutes)
                 else:
-                    if disconText:
-                        disconText.remove()
-                        disconText = None
+                    uiQueue.post('discon', hideDisconnectTime)
 
             #if args.debug:
                 #print('deviceSeekThread.run() at', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
@@ -1082,22 +1200,17 @@ class deviceSeekThread(threading.Thread):
                         rthread.stop()
                         rthread.join()
                         rthread = None
-                    if stat_text:
-                        stat_text.set_text('Receiver\nDevice\nAbsent')
-                        stat_text.set_backgroundcolor('thistle')
-                        stat_text.draw(fig.canvas.get_renderer())
-                    if batt_text:
-                        batt_text.remove()
-                        batt_text = None
-                        (powerState, powerLevel) = (None, 0)
-                        (lastPowerState, lastPowerLevel) = (None, 0)
-                    plt.draw()
+                    if (receiverInstance is not None) and not self.presence.isPresent():
+                        # The device is gone, so start afresh when it returns
+                        receiverInstance.Disconnect()
+                        receiverInstance = None
+                    uiQueue.post('status', setStatusText, 'Receiver\nDevice\nAbsent', 'thistle')
+                    uiQueue.post('battery', removeBatteryText)
                 else:
                     # A different device has been connected
                     disconUtcTime = datetime.datetime.min
-                    if disconText:
-                        # Fade the text before complete removal
-                        disconText.set_alpha(0.5)
+                    # Fade the disconnect time before complete removal
+                    uiQueue.post('discon', fadeDisconnectTime)
 
                     if rthread is not None:
                         rthread.stop()
@@ -1110,6 +1223,10 @@ class deviceSeekThread(threading.Thread):
             waitStatus = self.evobj.wait(timeout=retryTime)  # wait up to retryTime seconds
             # waitStatus = False on timeout, True if someone set() the event object
             if waitStatus is True:
+                if self.terminate is False:
+                    # A device was attached or removed, or a recheck was requested
+                    self.evobj.clear()
+                    continue
                 if args.debug:
                     print('deviceSeekThread terminated')
                 return  # terminate the thread
@@ -1127,6 +1244,7 @@ def PerodicDeviceSeek():
 
 #---------------------------------------------------------
 def getReceiverInstance():
+    import readReceiver
     rsni = None
     rdi = None
 
@@ -1156,6 +1274,73 @@ def getReceiverInstance():
 
     return rdi
 
+#---------------------------------------------------------
+def toggleAgpOverlay():
+    global agpDays
+    agpDays = {0: 14, 14: 90}.get(agpDays, 0)
+    if args.debug:
+        print('AGP overlay :', '%d days' % agpDays if agpDays else 'off')
+    plotAgpOverlay()
+    fig.canvas.draw_idle()
+
+#---------------------------------------------------------
+def plotAgpOverlay():
+    # Draw the 5-95% and 25-75% percentile bands, and the median, of the
+    # Ambulatory Glucose Profile for the days before the latest reading
+    # shown. The profile is repeated for each day in the SQL window, so
+    # scrolling within the window doesn't need a redraw.
+    global agpArtists
+    global agpDrawnKey
+
+    if (agpDays == 0) or (not sqlite_file) or (lastTestSysSecs == 0):
+        for artist in agpArtists:
+            artist.remove()
+        agpArtists = []
+        agpDrawnKey = None
+        return
+
+    # Whole days, so the profile stays cached until the next download
+    agpEndSecs = (min(displayEndSecs, lastTestSysSecs) // agp.SECONDS_PER_DAY + 1) * agp.SECONDS_PER_DAY
+    conn = getUiConnection()
+    curs = conn.cursor()
+    curs.execute('BEGIN')
+    drawKey = (sqlite_file, agpEndSecs, agpDays, offsetSeconds, getUiChanges(curs), changefeed.ChangeCount(sqlite_file),
+               curSqlMinTime, curSqlMaxTime, gluMult)
+    if drawKey == agpDrawnKey:
+        curs.close()
+        conn.commit()
+        return
+
+    profile = agp.GetProfile(sqlite_file, agpEndSecs, agpDays, mytz, offsetSeconds, curs=curs)
+    curs.close()
+    conn.commit()
+    for artist in agpArtists:
+        artist.remove()
+
+    # Every bin start across the SQL window. Time zone offsets are whole
+    # multiples of a bin, so these fall on the local bin boundaries.
+    binSecs = profile.binMinutes * 60
+    xSecs = np.arange((curSqlMinTime + offsetSeconds) // binSecs * binSecs,
+                      curSqlMaxTime + offsetSeconds + 2 * binSecs, binSecs)
+    bins = agp.LocalMinuteOfDay(xSecs, mytz) // profile.binMinutes
+    xNum = timeconv.ReceiverSecondsToNum(xSecs)
+    (p5, p25, p50, p75, p95) = [profile.curve(p)[bins] * gluMult for p in agp.PERCENTILES]
+    agpArtists = [ax.fill_between(xNum, p5, p95, color='mediumpurple', alpha=0.18, linewidth=0, zorder=4),
+                  ax.fill_between(xNum, p25, p75, color='mediumpurple', alpha=0.30, linewidth=0, zorder=4)]
+    agpArtists.extend(ax.plot(xNum, p50, color='rebeccapurple', linewidth=1.0, alpha=0.7, zorder=5))
+    agpDrawnKey = drawKey
+    if args.debug:
+        print('AGP overlay :', profile)
+
+#---------------------------------------------------------
+def loadAlertSettings():
+    # Alert on the receiver's own alert settings, falling back to the
+    # target range for any glucose limit the receiver doesn't give
+    global alertSettingsFile
+    settings = alerts.SettingsFromReceiver(receiverInstance.GetCurrentUserSettings(), displayLow, displayHigh)
+    alertEngine.setSettings(settings, sqlite_file)
+    alertSettingsFile = sqlite_file
+
 #---------------------------------------------------------
 def PeriodicReadData():
     global rthread
@@ -1282,8 +1467,7 @@ def setPropsFromScale(val):
     if newInRangeFontSize != inRangeFontSize:
         # Update text on previously plotted in range regions
         for specRange in inRangePlottedSet:
-            startRangeNum = mdates.date2num(specRange[0])
-            endRangeNum = mdates.date2num(specRange[1])
+            (startRangeNum, endRangeNum) = specRange
             thePatch = inRangeDict.get((startRangeNum, endRangeNum), None)
             if thePatch:
                 # Update the text size for the inRangeArrow3 component
@@ -1381,6 +1565,10 @@ def press(event):
         elif event.key == 'alt+right':  # shift one hour right
             displayStartSecs = max(firstTestSysSecs + futureSecs, min(lastTestSysSecs + futureSecs - displayRange, displayStartSecs + hourSeconds))
 
+        elif event.key == 'a':          # cycle the AGP overlay through 14 days, 90 days and off
+            toggleAgpOverlay()
+            return
+
         else:
             #print('you pressed', event.key)
             return
@@ -1395,8 +1583,8 @@ def press(event):
             #print('press() : origPosition =', origPosition, 'position =', position)
         SetCurrentSqlSelectRange() # this may modify displayStartSecs, displayEndSecs, curSqlMinTime, curSqlMaxTime
         if displayStartSecs != origDisplayStartSecs:
-            ax.set_xlim(mdates.date2num(ReceiverTimeToUtcTime(displayStartSecs)),
-                        mdates.date2num(ReceiverTimeToUtcTime(min(displayStartSecs+displayRange, lastTestSysSecs+futureSecs+1))))
+            ax.set_xlim(timeconv.ReceiverSecondsToNum(displayStartSecs),
+                        timeconv.ReceiverSecondsToNum(min(displayStartSecs+displayRange, lastTestSysSecs+futureSecs+1)))
         if position != origPosition:
             calcStats()
             sPos.set_val(position)  # this will cause fig.canvas.draw() to be called
@@ -1542,7 +1730,7 @@ def writeNote(xoff=0.0, yoff=0.0):
             noteAnn.draggable()
             noteAnnSet.add(noteAnn)
             notePlotList.append(noteAnn)
-            timeIndex = getNearPos(xnorm, mdates.num2date(noteAnn.xy[0], tz=mytz))
+            timeIndex = getNearPos(xnorm, noteAnn.xy[0])
             noteTimeSet.add(xnorm[timeIndex])
             #print('writeNote Note @ %s \'%s\' X offset %f Y offset %f' % (xnorm[timeIndex].astimezone(mytz), noteText, xoffset, yoffset))
             saveAnnToDb(noteAnn)
@@ -1580,10 +1768,10 @@ def onpick(event):
             # Check for a right button click. Some mouse devices only have 2 buttons, and some
             # have 3, so treat either one as a "right button".
             if (mouseevent.button == 2) or (mouseevent.button == 3):
-                # We need to truncate the microseconds of the mouseevent because we store
+                # We need to round the mouseevent to a whole second because we store
                 # time in seconds granularity in the database, and we need the Note time to
                 # be precise for the code handling of noteTimeSet to work properly.
-                xdata_trunc = mdates.date2num(mdates.num2date(mouseevent.xdata, tz=mytz).replace(microsecond=0))
+                xdata_trunc = timeconv.ReceiverSecondsToNum(timeconv.NumToReceiverSeconds(mouseevent.xdata))
                 noteLoc = (xdata_trunc, mouseevent.ydata)
                 matchNote = None
                 for note in noteAnnSet:
@@ -1626,7 +1814,7 @@ def onpick(event):
                             noteText = matchNote.get_text()
                             #if args.debug:
                                 #print("Deleting existing note '%s'" % noteText)
-                            deleteNoteFromDb(UtcTimeToReceiverTime(mdates.num2date(matchNote.xy[0], tz=mytz)), noteText)
+                            deleteNoteFromDb(int(timeconv.NumToReceiverSeconds(matchNote.xy[0])), noteText)
                             try:
                                 notePlotList.remove(matchNote)
                             except ValueError as e:
@@ -1658,14 +1846,107 @@ def onpick(event):
             #elif mouseevent.button == 'down':
                 #print('Button down')
 
+#---------------------------------------------------------
+# Called by the change feed, on a device read thread, with the
+# records newly stored by a download. Any number of batches
+# arriving together are handled with a single new graph.
+def onNewRows(batch):
+    sqlWindows.invalidate(batch.dbPath, batch.firstSeconds, batch.lastSeconds)
+    decodedWindows.invalidate(batch.dbPath, batch.firstSeconds, batch.lastSeconds)
+    if batch.dbPath == sqlite_file:
+        if args.debug:
+            print('onNewRows() :', batch)
+        uiQueue.post('plot', plotGraph)
+
+#---------------------------------------------------------
+# The following functions are posted to uiQueue by the device
+# threads, so that they run on the main thread.
+def setStatusText(text, color):
+    if stat_text:
+        stat_text.set_text(text)
+        stat_text.set_backgroundcolor(color)
+
+def showDisconnectTime(disconMinutes):
+    global disconText
+    if disconText:
+        disconText.set_text('%d minutes' % disconMinutes)
+    else:
+        disconText = plt.figtext(.10, .10, '%d minutes' % disconMinutes,
+                                 size=largeFontSize, weight='bold')
+
+def fadeDisconnectTime():
+    if disconText:
+        disconText.set_alpha(0.5)
+
+def hideDisconnectTime():
+    global disconText
+    if disconText:
+        disconText.remove()
+        disconText = None
+
+def removeBatteryText():
+    global batt_text
+    global powerState
+    global powerLevel
+    global lastPowerState
+    global lastPowerLevel
+    if batt_text:
+        batt_text.remove()
+        batt_text = None
+        (powerState, powerLevel) = (None, 0)
+        (lastPowerState, lastPowerLevel) = (None, 0)
+
+def setWindowTitle(title):
+    try:
+        # During shutdown, set_window_title() can fail with
+        # "AttributeError: 'NoneType' object has no attribute 'wm_title'"
+        fig.canvas.manager.set_window_title(title)
+    except AttributeError as e:
+        #if args.debug:
+            #print('setWindowTitle() : Exception =', e)
+        if sys.version_info.major < 3:
+            sys.exc_clear()
+
+#---------------------------------------------------------
+def reportStartup():
+    print('Startup phase                              seconds  (total)')
+    lastSecs = 0.0
+    for (phase, secs) in startupPhases:
+        print('  %-40s %6.3f  (%6.3f)' % (phase, secs - lastSecs, secs))
+        lastSecs = secs
+    firstFrameSecs = startupPhases[-1][1]
+    if firstFrameSecs > startupBudget:
+        print('Time to first graph, %.3f seconds, is over the %.1f second budget' % (firstFrameSecs, startupBudget))
+    else:
+        print('Time to first graph = %.3f seconds' % firstFrameSecs)
+
+#---------------------------------------------------------
+# Called when the canvas is first drawn. The user can now see the graph,
+# so it's time to start looking for a receiver.
+def onFirstDraw(event):
+    fig.canvas.mpl_disconnect(firstDrawId)
+    markStartup('first frame drawn')
+    if args.startup or (args.debug and (startupPhases[-1][1] > startupBudget)):
+        reportStartup()
+    if not args.startup:
+        PerodicDeviceSeek()  # launch thread to check for device presence periodically
+
 #---------------------------------------------------------
 def onclose(event):
     global rthread
     global sthread
     global receiverInstance
     global closeInProgress
+    global uiConn
 
     closeInProgress = True
+    changefeed.defaultFeed.unsubscribe(onNewRows)
+    if alertEngine is not None:
+        alertEngine.detach()
+    uiQueue.stop()
+    sqlWindows.stop()
+    # Make any writes still waiting, before the database is left
+    writeBehind.stop()
 
     if args.debug:
         print('*****************')
@@ -1699,6 +1980,10 @@ def onclose(event):
     del receiverInstance
     receiverInstance = None
 
+    if uiConn is not None:
+        uiConn.close()
+        uiConn = None
+
     plt.close('all')
     sys.exit(0)
 
@@ -1814,23 +2099,21 @@ def ClearGraph():
     # erase all previously plotted regions
     while redRangePlottedSet:
         specRange = redRangePlottedSet.pop()
-        startRangeNum = mdates.date2num(specRange[0])
-        endRangeNum = mdates.date2num(specRange[1])
+        (startRangeNum, endRangeNum) = specRange
         stalePatch = redRangeDict.pop((startRangeNum, endRangeNum), None)   # returns None if key not found
         if stalePatch:
             if args.debug:
-                print('ClearGraph - Deleting out of calibration range', specRange[0], ' to', specRange[1])
+                print('ClearGraph - Deleting out of calibration range', mdates.num2date(startRangeNum, tz=mytz), ' to', mdates.num2date(endRangeNum, tz=mytz))
             stalePatch.remove()
 
     # erase all previously plotted in range for 24+ hour regions
     while inRangePlottedSet:
         specRange = inRangePlottedSet.pop()
-        startRangeNum = mdates.date2num(specRange[0])
-        endRangeNum = mdates.date2num(specRange[1])
+        (startRangeNum, endRangeNum) = specRange
         stalePatch = inRangeDict.pop((startRangeNum, endRangeNum), None)   # returns None if key not found
         if stalePatch:
             if args.debug:
-                print('ClearGraph - Deleting 24+ hour range section', specRange[0], 'to', specRange[1])
+                print('ClearGraph - Deleting 24+ hour range section', mdates.num2date(startRangeNum, tz=mytz), 'to', mdates.num2date(endRangeNum, tz=mytz))
             stalePatch[0].remove()  # inRange_patch
             stalePatch[1].remove()  # inRangeArrow1
             stalePatch[2].remove()  # inRangeArrow2
@@ -2252,6 +2535,11 @@ def plotInit():
     fig.canvas.mpl_connect('key_press_event', press)
     fig.canvas.mpl_connect("motion_notify_event", hover)
 
+    # The device threads post their display updates to uiQueue, which
+    # runs them on the main thread, from a canvas timer
+    uiQueue.start(fig.canvas)
+    changefeed.defaultFeed.subscribe(onNewRows)
+
     plt.gcf().autofmt_xdate()
 
     axNote = plt.axes([noteX, noteY, noteW, noteH], frameon=True, zorder=10)
@@ -2332,53 +2620,37 @@ def calcStats():
         displayEndSecs = lastTestSysSecs + futureSecs
 
     if sqlite_file:
+        conn = getUiConnection()
+        curs = conn.cursor()
         try:
-            conn = sqlite3.connect(sqlite_file)
-            curs = conn.cursor()
+            curs.execute('BEGIN')
 
             #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            # Find HbA1c. This is based on the average of glucose values over a 3 month period
+            # Gather glucose statistics over a 3 month period. Whole days come from the
+            # DailySummary table, so this reads about 90 rows, rather than about 26,000.
             #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            selectSql = 'SELECT AVG(glucose) FROM EgvRecord WHERE glucose > 12 AND sysSeconds >= ? AND sysSeconds <= ?'
             ninetyDaysBack = int(displayEndSecs - 60*60*24*30*3)
             #print('ninetyDaysBack =',ninetyDaysBack)
-            curs.execute(selectSql, (ninetyDaysBack, displayEndSecs))
-            sqlData = curs.fetchone()
-            if sqlData[0] is None:
+            stats = dailysummary.QueryRange(curs, ninetyDaysBack, displayEndSecs)
+
+            #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+            # Find HbA1c. This is based on the average of glucose values over a 3 month period
+            #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+            if stats.count == 0:
                 avgGlu = 0.0
                 hba1c = 0.0
             else:
-                avgGlu = sqlData[0]
-                hba1c = (sqlData[0] + 46.7) / 28.7
+                avgGlu = stats.mean()
+                hba1c = (avgGlu + 46.7) / 28.7
                 #if args.debug:
                     #print('Average glucose =', avgGlu,', HbA1c =',hba1c)
 
             #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
             # Find percentages of readings in High, Middle, and Low ranges over a 3 month period
             #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            selectSql = 'SELECT COUNT (*) FROM EgvRecord WHERE glucose > 12 AND glucose < ? AND sysSeconds >= ? AND sysSeconds <= ?'
-            curs.execute(selectSql, (displayLow, ninetyDaysBack, displayEndSecs))
-            sqlData = curs.fetchone()
-            if sqlData[0] is None:
-                lowCount = 0
-            else:
-                lowCount = sqlData[0]
-
-            selectSql = 'SELECT COUNT (*) FROM EgvRecord WHERE glucose >= ? AND glucose <= ? AND sysSeconds >= ? AND sysSeconds <= ?'
-            curs.execute(selectSql, (displayLow, displayHigh, ninetyDaysBack, displayEndSecs))
-            sqlData = curs.fetchone()
-            if sqlData[0] is None:
-                midCount = 0
-            else:
-                midCount = sqlData[0]
-
-            selectSql = 'SELECT COUNT (*) FROM EgvRecord WHERE glucose > ? AND sysSeconds >= ? AND sysSeconds <= ?'
-            curs.execute(selectSql, (displayHigh, ninetyDaysBack, displayEndSecs))
-            sqlData = curs.fetchone()
-            if sqlData[0] is None:
-                highCount = 0
-            else:
-                highCount = sqlData[0]
+            lowCount = stats.countBelow(displayLow)
+            midCount = stats.countBetween(displayLow, displayHigh)
+            highCount = stats.countAbove(displayHigh)
 
             lmhTotal = lowCount + midCount + highCount
             if lmhTotal > 0:
@@ -2393,39 +2665,19 @@ def calcStats():
                 #print('highPercent =', highPercent, ', midPercent =', midPercent, ', lowPercent =', lowPercent)
 
             #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            # Calculate the SampleVariance over a 3 month period
-            #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            selectSql = 'SELECT glucose FROM EgvRecord WHERE glucose > 12 AND sysSeconds >= ? AND sysSeconds <= ?'
-            curs.execute(selectSql, (ninetyDaysBack, displayEndSecs))
-            sqlData = curs.fetchall()
-            egvCount = len(sqlData)
-
-            if egvCount > 1:
-                selectSql = 'SELECT TOTAL((glucose - ?) * (glucose - ?)) FROM EgvRecord WHERE glucose > 12 AND sysSeconds >= ? AND sysSeconds <= ?'
-                curs.execute(selectSql, (avgGlu, avgGlu, ninetyDaysBack, displayEndSecs))
-                sqlData = curs.fetchone()
-                if sqlData[0] is None:
-                    egvSampleVariance = 0.0
-                else:
-                    # For a Sample Variance, divide by N - 1
-                    egvSampleVariance = sqlData[0] / (egvCount - 1)
-            else:
-                egvSampleVariance = 0.0
-            #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
             # The Standard Deviation is the square root of the SampleVariance
             #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            egvStdDev = math.sqrt(egvSampleVariance)
+            egvStdDev = stats.stdDev()
             #if args.debug:
-                #print('egvCount =',egvCount,', egvSampleVariance =',egvSampleVariance,', egvStdDev =',egvStdDev)
+                #print('egvCount =',stats.count,', egvSampleVariance =',stats.sampleVariance(),', egvStdDev =',egvStdDev)
 
-            del sqlData
             curs.close()
-            conn.close()
+            conn.commit()
 
         except sqlite3.Error as e:
             print('calcStats() : sql exception =', e)
             curs.close()
-            conn.close()
+            conn.rollback()
             avgGlu = 0.0
             hba1c = 0.0
             egvStdDev = 0.0
@@ -2457,41 +2709,98 @@ def calcStats():
             lowPercentText.set_text('%4.1f%%' %lowPercent)
 
 #---------------------------------------------------------
-def readConfigFromSql():
+def getUiConnection():
+    # The graph and statistics are read through one long lived, read-only
+    # connection, which is only used by the main thread. The database is in
+    # WAL mode, so a download never blocks these reads. Each reader runs
+    # 'BEGIN', so that all of its queries see the same snapshot, and then
+    # commit()s, to let the next reader see any newly downloaded records.
+    global uiConn
+    global uiConnFile
+    global uiDataVersion
+
+    if uiConnFile != sqlite_file:
+        if uiConn is not None:
+            uiConn.close()
+            uiConn = None
+        uiConnFile = None
+    if uiConn is None:
+        # Bring an older database up to date, the first time we see it.
+        # An old schema can still be displayed, so a failure is only
+        # reported here, and the migration is tried again next time.
+        try:
+            dbschema.MigrateOnce(sqlite_file, args.debug)
+        except sqlite3.Error as e:
+            print('getUiConnection() : Unable to update schema of', sqlite_file, ':', e)
+            if sys.version_info < (3, 0):
+                sys.exc_clear()
+        uiConn = dbschema.ReadOnlyConnection(sqlite_file)
+        uiConnFile = sqlite_file
+        # Anything cached from an earlier connection to this file may be stale
+        uiDataVersion = None
+    else:
+        # End any snapshot left open by a reader which failed part way
+        uiConn.rollback()
+    return uiConn
+
+#---------------------------------------------------------
+def getUiChanges(curs):
+    # Returns a count of the changes made to the database by other
+    # processes, such as dexcingest, for keying what's read through uiConn.
+    # Call it after 'BEGIN', so that it matches the snapshot being read.
+    # PRAGMA data_version moves whenever any other connection commits.
+    # Commits by this process are also counted by the change feed, which
+    # has already invalidated the windows they changed, so data_version
+    # only tells us about another process if that count hasn't moved.
+    global uiDataVersion
+    global uiChangeCount
+    global uiChanges
+
+    curs.execute('PRAGMA data_version')
+    dataVersion = curs.fetchone()[0]
+    changeCount = changefeed.ChangeCount(sqlite_file)
+    if dataVersion != uiDataVersion:
+        if (uiDataVersion is None) or (changeCount == uiChangeCount):
+            uiChanges += 1
+            # We don't know which records changed, so re-read every window
+            sqlWindows.invalidate(sqlite_file)
+            decodedWindows.invalidate(sqlite_file)
+        uiDataVersion = dataVersion
+    uiChangeCount = changeCount
+    return uiChanges
 
+#---------------------------------------------------------
+# Older versions of the database didn't have 'scale' or 'timeOffset' columns
+# in Config. Those are added by dbschema.MigrateOnce(), but if the migration
+# failed, read the other settings and use the default scale and offset.
+def selectConfigRow(curs):
+    try:
+        curs.execute("SELECT displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset FROM Config")
+        return curs.fetchone()
+    except sqlite3.Error as e:
+        print('selectConfigRow() : Using default scale and time offset, due to exception =', e)
+        if sys.version_info < (3, 0):
+            sys.exc_clear()
+    curs.execute("SELECT displayLow, displayHigh, legendX, legendY, glUnits FROM Config")
+    sqlData = curs.fetchone()
+    if sqlData is None:
+        return None
+    return tuple(sqlData) + (dbschema.DEFAULT_SCALE, 0)
+
+#---------------------------------------------------------
+def readConfigFromSql():
     if sqlite_file:
-        conn = sqlite3.connect(sqlite_file)
+        # A Config change may still be waiting to be written
+        writeBehind.flush()
+        conn = getUiConnection()
         curs = conn.cursor()
+        curs.execute('BEGIN')
 
         selectSql = "SELECT count(*) from sqlite_master where type='table' and name='Config'"
         curs.execute(selectSql)
         sqlData = curs.fetchone()
         if sqlData[0] > 0:
-            selectSql = "SELECT displayLow, displayHigh, legendX, legendY, glUnits, scale FROM Config"
-            try:
-                curs.execute(selectSql)
-            except sqlite3.Error as e:
-                # Older versions of the database didn't have a 'scale' column, so add it now.
-                if sys.version_info.major < 3:
-                    sys.exc_clear()
-                if args.debug:
-                    print('readConfigFromSql() : Adding \'scale\' column to Config table')
-                defScale = 100.0*(displayRange-displayRangeMin)/(displayRangeMax-displayRangeMin)
-                curs.execute("ALTER TABLE Config ADD COLUMN scale REAL DEFAULT %f" % defScale)
-
-            selectSql = "SELECT displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset FROM Config"
-            try:
-                curs.execute(selectSql)
-            except sqlite3.Error as e:
-                # Older versions of the database didn't have a 'timeOffset' column, so add it now.
-                if sys.version_info.major < 3:
-                    sys.exc_clear()
-                if args.debug:
-                    print('readConfigFromSql() : Adding \'timeOffset\' column to Config table')
-                curs.execute("ALTER TABLE Config ADD COLUMN timeOffset INTEGER DEFAULT 0")
-
-            curs.execute(selectSql)
-            sqlData = curs.fetchone()
+            sqlData = selectConfigRow(curs)
             if sqlData is not None:
                 myDisplayLow = sqlData[0]
                 myDisplayHigh = sqlData[1]
@@ -2501,11 +2810,11 @@ def readConfigFromSql():
                 myScale = sqlData[5]
                 myOffset = sqlData[6]
                 curs.close()
-                conn.close()
+                conn.commit()
                 return myDisplayLow, myDisplayHigh, myLegendX, myLegendY, myGluUnits, myScale, myOffset
 
         curs.close()
-        conn.close()
+        conn.commit()
     # Couldn't read from database, so return default values
     defScale = 100.0*(displayRange-displayRangeMin)/(displayRangeMax-displayRangeMin)
     return displayLow, displayHigh, legPosX, legPosY, cfgGluUnits, defScale, 0
@@ -2521,21 +2830,22 @@ def readRangeFromSql():
     lastTestSysSecs = 0
     lastTestGluc = 0
     if sqlite_file:
-        conn = sqlite3.connect(sqlite_file)
+        conn = getUiConnection()
         curs = conn.cursor()
+        curs.execute('BEGIN')
 
         selectSql = "SELECT count(*) from sqlite_master where type='table' and name='EgvRecord'"
         curs.execute(selectSql)
         sqlData = curs.fetchone()
         if sqlData[0] > 0:
             # get the first test info
-            curs.execute('SELECT sysSeconds,glucose FROM EgvRecord ORDER BY sysSeconds ASC LIMIT 1')
+            curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds = (SELECT MIN(sysSeconds) FROM EgvRecord)')
             sqlData = curs.fetchall()
             for row in sqlData:
                 firstTestSysSecs = row[0] + offsetSeconds
 
             # get the last test info
-            curs.execute('SELECT sysSeconds,glucose FROM EgvRecord ORDER BY sysSeconds DESC LIMIT 1')
+            curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds = (SELECT MAX(sysSeconds) FROM EgvRecord)')
             sqlData = curs.fetchall()
             for row in sqlData:
                 lastTestSysSecs = row[0] + offsetSeconds
@@ -2544,7 +2854,7 @@ def readRangeFromSql():
 
         del sqlData
         curs.close()
-        conn.close()
+        conn.commit()
 
 #---------------------------------------------------------
 def readDataFromSql(sqlMinTime, sqlMaxTime):
@@ -2552,6 +2862,8 @@ def readDataFromSql(sqlMinTime, sqlMaxTime):
     global sqlMaximumGluc
     global lastRealGluc
     global egvList
+    global egvSeconds
+    global specialZones
     global calibList
     global eventList
     global noteList
@@ -2575,15 +2887,20 @@ def readDataFromSql(sqlMinTime, sqlMaxTime):
         #print('readDataFromSql(%s, %s)' %(ReceiverTimeToUtcTime(sqlMinTime).astimezone(mytz), ReceiverTimeToUtcTime(sqlMaxTime).astimezone(mytz)))
     egvList = []
     calibList = []
-    uncalGluQueue = deque()
     eventList = []
     noteList = []
     calibFirst = None
     calibLast = None
+    specialZones = None
 
     if sqlite_file:
-        conn = sqlite3.connect(sqlite_file)
+        # Taken before the snapshot, so a window read from it isn't kept,
+        # if the change feed invalidates it before we're done
+        sqlGeneration = sqlWindows.generation()
+        decodedGeneration = decodedWindows.generation()
+        conn = getUiConnection()
         curs = conn.cursor()
+        curs.execute('BEGIN')
 
         # sysSeconds  dispSeconds  full_glucose  glucose     testNum     trend
         # ----------  -----------  ------------  ----------  ----------  ----------
@@ -2597,34 +2914,48 @@ def readDataFromSql(sqlMinTime, sqlMaxTime):
         # 289629059   289607458    16546         162         7134        20
         # 289629358   289607757    162           162         7135        20
 
+        # The decoded records in the range. Unless the database has changed, these
+        # are usually cached, or else read from a prefetched SQL window. Glucose
+        # units are applied when plotting, so they don't need a new window.
+        windowKey = (sqlite_file, sqlMinTime, sqlMaxTime, getUiChanges(curs))
+        window = decodedWindows.get(windowKey, offsetSeconds)
+        if window is None:
+            window = sqlwindow.DecodeWindow(sqlWindows.get(curs, sqlite_file, sqlMinTime, sqlMaxTime, sqlGeneration),
+                                            offsetSeconds)
+            decodedWindows.put(windowKey, window, decodedGeneration)
+        # Copy the lists, since plotGraph() may add to them
+        egvList = list(window.egvList)
+        calibList = list(window.calibList)
+        eventList = list(window.eventList)
+        noteList = list(window.noteList)
+        calibFirst = window.calibFirst
+        calibLast = window.calibLast
+        egvSeconds = window.egvSeconds
+        specialZones = window.specialZones
+
         selectSql = "SELECT count(*) from sqlite_master where type='table' and name='EgvRecord'"
         curs.execute(selectSql)
         sqlData = curs.fetchone()
         if sqlData[0] > 0:
 
-            selectSql = 'SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds <= ? AND glucose > 12 ORDER BY sysSeconds ASC LIMIT 1'
-            curs.execute(selectSql, (sqlMinTime, sqlMaxTime))
-            sqlData = curs.fetchall()
-            for row in sqlData:
-                sqlEarliestGluc = row[1]
+            if window.earliestGluc is not None:
+                sqlEarliestGluc = window.earliestGluc
 
-            selectSql = 'SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds <= ? AND glucose > 12 ORDER BY glucose DESC LIMIT 1'
-            curs.execute(selectSql, (sqlMinTime, sqlMaxTime))
-            sqlData = curs.fetchall()
-            for row in sqlData:
-                sqlMaximumGluc = row[1]
+            if window.maximumGluc is not None:
+                sqlMaximumGluc = window.maximumGluc
 
             if appendable_db:
                 # get the last real glucose reading
-                selectSql = 'SELECT glucose,trend FROM EgvRecord WHERE glucose > 12 ORDER BY sysSeconds DESC LIMIT 1'
+                selectSql = 'SELECT glucose,trend FROM EgvRecord WHERE sysSeconds = (SELECT MAX(sysSeconds) FROM EgvRecord WHERE glucose > 12)'
                 curs.execute(selectSql)
                 sqlData = curs.fetchall()
                 for row in sqlData:
                     lastRealGluc = row[0]
                     lastTrend = row[1] & constants.EGV_TREND_ARROW_MASK
             else:
-                if not receiverInstance:
-                    receiverInstance = getReceiverInstance()
+                # The receiver instance is created by the device threads, so
+                # the serial port stack isn't loaded, or probed, before the
+                # first graph is drawn.
                 if receiverInstance:
                     curGluc, curFullTrend, read_status = receiverInstance.GetCurrentGlucoseAndTrend()
                     if curGluc and curFullTrend and (read_status == 0):
@@ -2641,131 +2972,13 @@ def readDataFromSql(sqlMinTime, sqlMaxTime):
 
             #print('sqlMinTime =',sqlMinTime,', sqlMaxTime =',sqlMaxTime)
 
-            #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            # Check to see if we have any Calib records in the database
-            selectSql = "SELECT count(*) from sqlite_master where type='table' and name='Calib'"
-            curs.execute(selectSql)
-            sqlData = curs.fetchone()
-            haveCalib = (sqlData[0] > 0)
-
-            if haveCalib:
-                #                          0        1
-                selectCalSql = 'SELECT sysSeconds,glucose FROM Calib WHERE type=1 AND sysSeconds >= ? AND sysSeconds <= ?'
-                selectEgvSql = 'SELECT sysSeconds,glucose FROM EgvRecord WHERE glucose > 12 AND sysSeconds BETWEEN ?-300 AND ?+300 ORDER BY ABS(sysSeconds - ?) LIMIT 1'
-                curs.execute(selectCalSql, (sqlMinTime, sqlMaxTime))
-                sqlData = curs.fetchall()
-                #print('sql calibration results length =',len(sqlData))
-
-                for calibRow in sqlData:
-                    # Search for the closest EGV record within 5 minutes of the User Calibration entry
-                    curs.execute(selectEgvSql, (calibRow[0], calibRow[0], calibRow[0]))
-                    egvRow = curs.fetchone()
-                    if egvRow:
-                        #ctime = ReceiverTimeToUtcTime(egvRow[0])
-                        #print('New --> Calib @', ctime.astimezone(mytz), ', calib_gluc =', calibRow[1], ', timeDiff =', calibRow[0] - egvRow[0], ', cgmGluc =', egvRow[1], ', calibDiff =', calibRow[1] - egvRow[1])
-                        # calculate an errorbar offset
-                        calibList.append([ReceiverTimeToUtcTime(egvRow[0] + offsetSeconds), egvRow[1], calibRow[1] - egvRow[1], 0])
-                    else:
-                        # No egvRow was found (possibly due to this Calibration happening
-                        # within a Sensor Calibration period), so specify a 0 distance offset.
-                        # We'll end up plotting the User Calibration without an errorbar.
-                        # Flag this condition with a '1' in the 4th field.
-                        calibList.append([ReceiverTimeToUtcTime(calibRow[0] + offsetSeconds), calibRow[1], 0, 1])
-                        uncalGluQueue.append([calibRow[0], calibRow[1]])
-
-                try:
-                    calibFirst = calibList[0]
-                except IndexError:
-                    calibFirst = None
-                    if sys.version_info.major < 3:
-                        sys.exc_clear()
-                try:
-                    calibLast = calibList[-1]
-                except IndexError:
-                    calibLast = None
-                    if sys.version_info.major < 3:
-                        sys.exc_clear()
-
-            #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            # Read all of the Glucose Values in the current range
-
-            selectSql = 'SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds'
-
-            # Limit the range of the selection ...
-            curs.execute(selectSql, (sqlMinTime, sqlMaxTime))
-            sqlData = curs.fetchall()
-            #print('sql results length =',len(sqlData),'sqlMinTime =',sqlMinTime,'sqlMaxTime =',sqlMaxTime)
-
-            # Calculate the running mean
-            rowCount = 0
-            runMean = 0.0
-            # We want to insert manual data points for glucose values submitted by User
-            # Calibration events which occurred when there was no calibrated sensor.
-            uncalGluData = uncalGluQueue.popleft() if uncalGluQueue else None
-
-            for row in sqlData:
-                if uncalGluData and (uncalGluData[0] < row[0]):
-                    # Insert manual data point
-                    rowCount += 1
-                    runMean = float(uncalGluData[1] + (rowCount-1) * runMean) / rowCount
-                    egvList.append([ReceiverTimeToUtcTime(uncalGluData[0] + offsetSeconds), uncalGluData[1], runMean])
-                    uncalGluData = uncalGluQueue.popleft() if uncalGluQueue else None
-
-                # Only include real Glucose values. Values <= 12 are fake.
-                if row[1] > 12:
-                    rowCount += 1
-                    runMean = float(row[1] + (rowCount-1) * runMean) / rowCount
-
-                egvList.append([ReceiverTimeToUtcTime(row[0] + offsetSeconds), row[1], runMean])
-
-            while uncalGluData:
-                # Insert remaining manual data points
-                rowCount += 1
-                runMean = float(uncalGluData[1] + (rowCount-1) * runMean) / rowCount
-                egvList.append([ReceiverTimeToUtcTime(uncalGluData[0] + offsetSeconds), uncalGluData[1], runMean])
-                uncalGluData = uncalGluQueue.popleft() if uncalGluQueue else None
-
-        #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-        selectSql = "SELECT count(*) from sqlite_master where type='table' and name='UserEvent'"
-        curs.execute(selectSql)
-        sqlData = curs.fetchone()
-        if sqlData[0] > 0:
-            #                       0           1           2         3     4      5      6       7
-            selectSql = 'SELECT sysSeconds,dispSeconds,meterSeconds,type,subtype,value,xoffset,yoffset FROM UserEvent WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds-dispSeconds+meterSeconds'
-            curs.execute(selectSql, (sqlMinTime, sqlMaxTime))
-            sqlData = curs.fetchall()
-            for row in sqlData:
-                #print('Event: sysSeconds =',row[0],'type =',row[1],'subtype =',row[2],'value =',row[3],'xoffset =',row[4],'yoffset =',row[5])
-                #########################################################################################
-                # In older (G5) versions Receiver firmware, the current date and time is always assigned
-                # when a user enters an Event.  In newer (G6) releases of firmware, the user is allowed
-                # to specify an alternate date and time for the Event.
-                #    sysSeconds = event creation time in seconds since BASE_TIME in UTC timezone
-                #    dispSeconds = event creation time in seconds since BASE_TIME in Local timezone
-                #    meterSeconds = User entered Event time in seconds since BASE_TIME in Local timezone
-                # We need the User entered Event time in the UTC timezone.
-                #   Offset in seconds = sysSeconds - dispSeconds
-                #   Event time (in UTC)= (sysSeconds - dispSeconds) + meterSeconds
-                #########################################################################################
-                eventList.append([ReceiverTimeToUtcTime(row[0] - row[1] + row[2] + offsetSeconds), row[3], row[4], row[5], row[6], row[7]])
-        #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-        selectSql = "SELECT count(*) from sqlite_master where type='table' and name='UserNote'"
-        curs.execute(selectSql)
-        sqlData = curs.fetchone()
-        if sqlData[0] > 0:
-            selectSql = 'SELECT sysSeconds,message,xoffset,yoffset FROM UserNote WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds'
-            curs.execute(selectSql, (sqlMinTime, sqlMaxTime))
-            sqlData = curs.fetchall()
-            for row in sqlData:
-                #print('Note: sysSeconds =',row[0],'message =',row[1],'xoffset =',row[2],'yoffset =',row[3])
-                noteList.append([ReceiverTimeToUtcTime(row[0] + offsetSeconds), row[1], row[2], row[3]])
         #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
         selectSql = "SELECT count(*) from sqlite_master where type='table' and name='SensorInsert'"
         curs.execute(selectSql)
         sqlData = curs.fetchone()
         if sqlData[0] > 0:
-            selectSql = 'SELECT insertSeconds FROM SensorInsert WHERE state = 7 ORDER BY sysSeconds DESC LIMIT 1'
+            selectSql = 'SELECT insertSeconds FROM SensorInsert WHERE sysSeconds = (SELECT MAX(sysSeconds) FROM SensorInsert WHERE state = 7)'
             # get the latest sensor insertion Start (state == 7) time
             curs.execute(selectSql)
             sqlData = curs.fetchall()
@@ -2778,9 +2991,7 @@ def readDataFromSql(sqlMinTime, sqlMaxTime):
             curs.execute(selectSql)
             sqlData = curs.fetchone()
             if sqlData[0] > 0:
-                selectSql = "SELECT displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset FROM Config"
-                curs.execute(selectSql)
-                sqlData = curs.fetchone()
+                sqlData = selectConfigRow(curs)
                 if sqlData is not None:
                     cfgDisplayLow = sqlData[0]
                     cfgDisplayHigh = sqlData[1]
@@ -2804,105 +3015,94 @@ def readDataFromSql(sqlMinTime, sqlMaxTime):
         del sqlData
 
         curs.close()
-        conn.close()
+        conn.commit()
 
 #---------------------------------------------------------
+# Writes of annotation positions, notes and configuration are posted to
+# writeBehind, with the values they need read here on the main thread. The
+# SQL is run later, on the write-behind thread, by the _write* functions.
 def saveAnnToDb(ann):
-    conn = sqlite3.connect(sqlite_file)
-    try:
-        curs = conn.cursor()
-        curs.execute('CREATE TABLE IF NOT EXISTS UserNote( sysSeconds INT PRIMARY KEY, message TEXT, xoffset REAL, yoffset REAL);')
-        if ann.get_color() == 'black':
-            # We may have modified offsets, or modified message, or a completely new UserNote
-            #print('SELECT sysSeconds,message,xoffset,yoffset FROM UserNote WHERE sysSeconds=%u AND message=\'%s\';' % (UtcTimeToReceiverTime(mdates.num2date(ann.xy[0], tz=mytz)) - offsetSeconds, ann.get_text()))
-            selectSql = 'SELECT sysSeconds,message,xoffset,yoffset FROM UserNote WHERE sysSeconds=? AND message=?'
-            curs.execute(selectSql, (UtcTimeToReceiverTime(mdates.num2date(ann.xy[0], tz=mytz)) - offsetSeconds, '%s'%ann.get_text()))
-            sqlData = curs.fetchone()
-            if sqlData is None:
-                #print('SELECT sysSeconds,message,xoffset,yoffset FROM UserNote WHERE sysSeconds=%u AND xoffset=%f AND yoffset=%f;' % (UtcTimeToReceiverTime(mdates.num2date(ann.xy[0], tz=mytz)) - offsetSeconds, ann.xyann[0], ann.xyann[1]))
-                selectSql = 'SELECT sysSeconds,message,xoffset,yoffset FROM UserNote WHERE sysSeconds=? AND xoffset=? AND yoffset=?'
-                curs.execute(selectSql, (UtcTimeToReceiverTime(mdates.num2date(ann.xy[0], tz=mytz)) - offsetSeconds, ann.xyann[0], ann.xyann[1]))
-                sqlData = curs.fetchone()
-                if sqlData is None:
-                    # A completely new UserNote
-                    insert_note_sql = '''INSERT OR IGNORE INTO UserNote( sysSeconds, message, xoffset, yoffset) VALUES (?, ?, ?, ?);'''
-                    #print('INSERT OR IGNORE INTO UserNote( sysSeconds, message, xoffset, yoffset) VALUES (%u,%s,%f,%f);' %(UtcTimeToReceiverTime(mdates.num2date(ann.xy[0],tz=mytz)) - offsetSeconds,'%s'%ann.get_text(),ann.xyann[0],ann.xyann[1]))
-                    curs.execute(insert_note_sql, (UtcTimeToReceiverTime(mdates.num2date(ann.xy[0], tz=mytz)) - offsetSeconds, '%s'%ann.get_text(), ann.xyann[0], ann.xyann[1]))
-                else:
-                    # Modified message
-                    update_note_sql = '''UPDATE UserNote SET message=? WHERE sysSeconds=? AND xoffset=? AND yoffset=?;'''
-                    #print('UPDATE UserNote SET message=\'%s\' WHERE sysSeconds=%u AND xoffset=%f AND yoffset=%f;' %(ann.get_text(), UtcTimeToReceiverTime(mdates.num2date(ann.xy[0],tz=mytz)) - offsetSeconds, ann.xyann[0], ann.xyann[1]))
-                    curs.execute(update_note_sql, ('%s'%ann.get_text(), UtcTimeToReceiverTime(mdates.num2date(ann.xy[0], tz=mytz)) - offsetSeconds, ann.xyann[0], ann.xyann[1]))
-            else:
-                # Modified offsets
-                update_note_sql = '''UPDATE UserNote SET xoffset=?, yoffset=? WHERE sysSeconds=? AND message=?;'''
-                #print('UPDATE UserNote SET xoffset=%f, yoffset=%f WHERE sysSeconds=%u AND message=\'%s\';' %(ann.xyann[0], ann.xyann[1], UtcTimeToReceiverTime(mdates.num2date(ann.xy[0],tz=mytz)) - offsetSeconds, ann.get_text()))
-                curs.execute(update_note_sql, (ann.xyann[0], ann.xyann[1], UtcTimeToReceiverTime(mdates.num2date(ann.xy[0], tz=mytz)) - offsetSeconds, '%s'%ann.get_text()))
-            curs.close()
-            conn.commit()
-        else:
-            #print('SELECT sysSeconds,dispSeconds,meterSeconds,type,subtype,value,xoffset,yoffset FROM UserEvent WHERE sysSeconds=%u AND xoffset=%d AND yoffset=%d;' % (UtcTimeToReceiverTime(mdates.num2date(ann.xy[0])), ann.xyann[0], ann.xyann[1]))
-            selectSql = 'SELECT sysSeconds,dispSeconds,meterSeconds,type,subtype,value,xoffset,yoffset FROM UserEvent WHERE sysSeconds-dispSeconds+meterSeconds=?'
-            curs.execute(selectSql, (UtcTimeToReceiverTime(mdates.num2date(ann.xy[0])),))
-            sqlData = curs.fetchone()
-            if sqlData is None:
-                #print('saveAnnToDb() : No match for', ann)
-                pass
-            else:
-                update_evt_sql = '''UPDATE UserEvent SET xoffset=?, yoffset=? WHERE sysSeconds=? AND type=? AND subtype=? AND value=?;'''
-                #print('UPDATE UserEvent SET xoffset=%f, yoffset=%f WHERE sysSeconds=%u AND type=%u AND subtype=%u AND value=%u;'%(ann.xyann[0], ann.xyann[1], sqlData[0], sqlData[3], sqlData[4], sqlData[5]))
-                curs.execute(update_evt_sql, (ann.xyann[0], ann.xyann[1], sqlData[0],
-                                              sqlData[3], sqlData[4], sqlData[5]))
-            curs.close()
-            conn.commit()
-    except sqlite3.Error as e:
-        print('saveAnnToDb() : sql changes failed to exception =', e)
-        curs.close()
-    conn.close()
+    annSeconds = int(timeconv.NumToReceiverSeconds(ann.xy[0]))
+    if ann.get_color() == 'black':
+        noteSeconds = annSeconds - offsetSeconds
+        message = '%s'%ann.get_text()
+        # A note is identified by its time alone, and each write holds the
+        # note's whole state, so an edit followed by a move is merged into
+        # one write of both
+        writeBehind.post(sqlite_file, ('UserNote', noteSeconds), _writeNote,
+                         noteSeconds, message, ann.xyann[0], ann.xyann[1])
+    else:
+        writeBehind.post(sqlite_file, ('UserEvent', annSeconds), _writeEventOffsets,
+                         annSeconds, ann.xyann[0], ann.xyann[1])
+
+def _writeNote(curs, noteSeconds, message, xoffset, yoffset):
+    # A new UserNote, or modified offsets, or a modified message, or all of
+    # these. sysSeconds is the primary key, so this replaces any older version.
+    insert_note_sql = '''INSERT OR REPLACE INTO UserNote( sysSeconds, message, xoffset, yoffset) VALUES (?, ?, ?, ?);'''
+    #print('INSERT OR REPLACE INTO UserNote( sysSeconds, message, xoffset, yoffset) VALUES (%u,%s,%f,%f);' %(noteSeconds, message, xoffset, yoffset))
+    curs.execute(insert_note_sql, (noteSeconds, message, xoffset, yoffset))
+
+def _writeEventOffsets(curs, meterSeconds, xoffset, yoffset):
+    #print('SELECT sysSeconds,dispSeconds,meterSeconds,type,subtype,value,xoffset,yoffset FROM UserEvent WHERE sysSeconds=%u AND xoffset=%d AND yoffset=%d;' % (meterSeconds, xoffset, yoffset))
+    selectSql = 'SELECT sysSeconds,dispSeconds,meterSeconds,type,subtype,value,xoffset,yoffset FROM UserEvent WHERE sysSeconds-dispSeconds+meterSeconds=?'
+    curs.execute(selectSql, (meterSeconds,))
+    sqlData = curs.fetchone()
+    if sqlData is None:
+        #print('saveAnnToDb() : No match for', meterSeconds)
+        pass
+    else:
+        update_evt_sql = '''UPDATE UserEvent SET xoffset=?, yoffset=? WHERE sysSeconds=? AND type=? AND subtype=? AND value=?;'''
+        #print('UPDATE UserEvent SET xoffset=%f, yoffset=%f WHERE sysSeconds=%u AND type=%u AND subtype=%u AND value=%u;'%(xoffset, yoffset, sqlData[0], sqlData[3], sqlData[4], sqlData[5]))
+        curs.execute(update_evt_sql, (xoffset, yoffset, sqlData[0],
+                                      sqlData[3], sqlData[4], sqlData[5]))
 
 #---------------------------------------------------------
 def deleteNoteFromDb(sysSeconds, message):
-    conn = sqlite3.connect(sqlite_file)
-    try:
-        curs = conn.cursor()
-        #print('DELETE FROM UserNote WHERE sysSeconds=%u AND message=\'%s\';' %(sysSeconds,message))
-        deleteSql = 'DELETE FROM UserNote WHERE sysSeconds=? AND message=?'
-        curs.execute(deleteSql, (sysSeconds - offsetSeconds, '%s'%message))
-        curs.close()
-        conn.commit()
-    except sqlite3.Error as e:
-        print('deleteNoteFromDb() : sql changes failed to exception =', e)
-        curs.close()
-    conn.close()
+    noteSeconds = sysSeconds - offsetSeconds
+    message = '%s'%message
+    # Same key as saveAnnToDb(), so the delete replaces any waiting write of this note
+    writeBehind.post(sqlite_file, ('UserNote', noteSeconds), _deleteNote, noteSeconds)
+
+def _deleteNote(curs, noteSeconds):
+    #print('DELETE FROM UserNote WHERE sysSeconds=%u;' %(noteSeconds))
+    deleteSql = 'DELETE FROM UserNote WHERE sysSeconds=?'
+    curs.execute(deleteSql, (noteSeconds,))
 
 #---------------------------------------------------------
 def saveConfigToDb():
     if sqlite_file:
-        conn = sqlite3.connect(sqlite_file)
-        try:
-            curs = conn.cursor()
-
-            if leg:
-                lframe = leg.get_frame()
-                lx, ly = lframe.get_x(), lframe.get_y()
-                legx, legy = fig.transFigure.inverted().transform((lx, ly))
-                #print('legx, legy =',(legx, legy))
-            else:
-                legx, legy = legDefaultPosX, legDefaultPosY
+        if leg:
+            lframe = leg.get_frame()
+            lx, ly = lframe.get_x(), lframe.get_y()
+            legx, legy = fig.transFigure.inverted().transform((lx, ly))
+            #print('legx, legy =',(legx, legy))
+        else:
+            legx, legy = legDefaultPosX, legDefaultPosY
+        writeBehind.post(sqlite_file, ('Config',), _writeConfig,
+                         displayLow, displayHigh, float(legx), float(legy), cfgGluUnits, cfgScale, offsetSeconds)
 
-            #print('INSERT OR REPLACE INTO Config (id, displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset) VALUES (0,', displayLow, ',', displayHigh, ',', legx, ',', legy, ',\'%s\'' %cfgGluUnits, cfgScale, ',', offsetSeconds, ');')
-            insert_cfg_sql = '''INSERT OR REPLACE INTO Config( id, displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset) VALUES (0, ?, ?, ?, ?, ?, ?, ?);'''
-            curs.execute(insert_cfg_sql, (displayLow, displayHigh, legx, legy, cfgGluUnits, cfgScale, offsetSeconds))
+def _writeConfig(curs, low, high, legx, legy, gluUnits, scale, timeOffset):
+    #print('INSERT OR REPLACE INTO Config (id, displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset) VALUES (0,', low, ',', high, ',', legx, ',', legy, ',\'%s\'' %gluUnits, scale, ',', timeOffset, ');')
+    insert_cfg_sql = '''INSERT OR REPLACE INTO Config( id, displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset) VALUES (0, ?, ?, ?, ?, ?, ?, ?);'''
+    curs.execute(insert_cfg_sql, (low, high, legx, legy, gluUnits, scale, timeOffset))
 
-            curs.close()
-            conn.commit()
-        except sqlite3.Error as e:
-            print('saveConfigToDb() : Rolling back sql changes due to exception =', e)
-            curs.close()
-            conn.rollback()
-            if sys.version_info.major < 3:
-                sys.exc_clear()
-        conn.close()
+#---------------------------------------------------------
+def onDbWritten(dbPath, keys):
+    # Called on the write-behind thread, with the keys of the writes just
+    # committed. Notes and annotation positions are held in the SQL windows
+    # and the decoded windows, so the windows holding them have to be
+    # re-read. A note is keyed by its time. An event is keyed by the time
+    # it was entered for, which may be far from the time it was recorded,
+    # that windows are selected by, so any window may hold it. The Config
+    # isn't held in any window.
+    for key in keys:
+        if key[0] == 'UserNote':
+            sqlWindows.invalidate(dbPath, key[1], key[1])
+            decodedWindows.invalidate(dbPath, key[1], key[1])
+        elif key[0] == 'UserEvent':
+            sqlWindows.invalidate(dbPath)
+            decodedWindows.invalidate(dbPath)
+    changefeed.NoteChange(dbPath)
 
 #---------------------------------------------------------
 def getNearPos(ordArray, value):
@@ -2938,8 +3138,8 @@ def ShowOrHideEventsNotes():
     ax_width, ax_height = ax_bbox.width * fig.dpi, ax_bbox.height * fig.dpi
     #print('ax_width, ax_height =', (ax_width, ax_height))
 
-    begTime = ReceiverTimeToUtcTime(displayStartSecs)
-    endTime = ReceiverTimeToUtcTime(displayStartSecs + displayRange)
+    begTime = timeconv.ReceiverSecondsToNum(displayStartSecs)
+    endTime = timeconv.ReceiverSecondsToNum(displayStartSecs + displayRange)
     visibleAnnotCount = sum(1 for evtAn in eventList if ((evtAn[0] >= begTime) and (evtAn[0] < endTime))) \
                       + sum(1 for noteAn in noteList if ((noteAn[0] >= begTime) and (noteAn[0] < endTime)))
 
@@ -2974,17 +3174,18 @@ def ShowOrHideEventsNotes():
         #print('ShowOrHideEventsNotes() : Before events    count =', len(muppy.get_objects()))
 
     # Compare event annotations with previous iteration
-    minTod = ReceiverTimeToUtcTime(curSqlMinTime + offsetSeconds)
-    maxTod = ReceiverTimeToUtcTime(curSqlMaxTime + offsetSeconds)
-    #print('Annotation Range = %s - %s' % (minTod.astimezone(mytz), maxTod.astimezone(mytz)))
+    # Annotations are positioned by date number, so compare those directly
+    #print('Annotation Range = %s - %s' % (ReceiverTimeToUtcTime(curSqlMinTime + offsetSeconds).astimezone(mytz), ReceiverTimeToUtcTime(curSqlMaxTime + offsetSeconds).astimezone(mytz)))
+    minTodNum = timeconv.ReceiverSecondsToNum(curSqlMinTime + offsetSeconds)
+    maxTodNum = timeconv.ReceiverSecondsToNum(curSqlMaxTime + offsetSeconds)
 
     evtInScopeSet = set()
     inScopePlotList = []
     outScopePlotList = []
     for evtAnn in evtPlotList:
-        if mdates.num2date(evtAnn.xy[0], tz=mytz) >= minTod and mdates.num2date(evtAnn.xy[0], tz=mytz) <= maxTod:
+        if minTodNum <= evtAnn.xy[0] <= maxTodNum:
             # event in scope
-            evtInScopeSet.add(mdates.num2date(evtAnn.xy[0]))
+            evtInScopeSet.add(evtAnn.xy[0])
             inScopePlotList.append(evtAnn)
         else:
             # event out of scope
@@ -3081,7 +3282,7 @@ def ShowOrHideEventsNotes():
             #                            |                         |
             # 'F' (-2,-2)----------------+                     (2,-2) 'G'
             #
-            if (estime - last_etime) < datetime.timedelta(minutes=110):
+            if (estime - last_etime) < 110.0 / (24 * 60):   # 110 minutes, in days
                 #print('---> estime =',estime,'estime - last_etime =',estime - last_etime,', evtStr =',evtStr)
                 if annCloseCount & 3 == 0:
                     multX = annRotation
@@ -3133,12 +3334,12 @@ def ShowOrHideEventsNotes():
         # with a small offset.
         if exoffset < -ax_width / 2:
             if args.debug:
-                print('Event @ %s \'%s\' X offset %f < -half screen width (%f)' % (estime.astimezone(mytz), evtStr, exoffset, -ax_width / 2))
+                print('Event @ %s \'%s\' X offset %f < -half screen width (%f)' % (mdates.num2date(estime, tz=mytz), evtStr, exoffset, -ax_width / 2))
             exoffset = -60.0
             repositioned = True
         elif exoffset > ax_width / 2:
             if args.debug:
-                print('Event @ %s \'%s\' X offset %f > half screen width (%f)' % (estime.astimezone(mytz), evtStr, exoffset, ax_width / 2))
+                print('Event @ %s \'%s\' X offset %f > half screen width (%f)' % (mdates.num2date(estime, tz=mytz), evtStr, exoffset, ax_width / 2))
             exoffset = 60.0
             repositioned = True
 
@@ -3146,12 +3347,12 @@ def ShowOrHideEventsNotes():
         # it with a small offset.
         if eyoffset < -ax_height / 2:
             if args.debug:
-                print('Event @ %s \'%s\' Y offset %f < -half screen height (%f)' % (estime.astimezone(mytz), evtStr, eyoffset, -ax_height / 2))
+                print('Event @ %s \'%s\' Y offset %f < -half screen height (%f)' % (mdates.num2date(estime, tz=mytz), evtStr, eyoffset, -ax_height / 2))
             eyoffset = -60.0
             repositioned = True
         elif eyoffset > ax_height / 2:
             if args.debug:
-                print('Event @ %s \'%s\' Y offset %f > half screen height (%f)' % (estime.astimezone(mytz), evtStr, eyoffset, ax_height / 2))
+                print('Event @ %s \'%s\' Y offset %f > half screen height (%f)' % (mdates.num2date(estime, tz=mytz), evtStr, eyoffset, ax_height / 2))
             eyoffset = 60.0
             repositioned = True
 
@@ -3164,7 +3365,7 @@ def ShowOrHideEventsNotes():
         # recalculate the offset position.
         if (ynorm[timeIndex] + gluMult * eyoffset > maxDisplayHigh) or (ynorm[timeIndex] + gluMult * eyoffset < 0):
             if args.debug:
-                print('Event @ %s \'%s\' Y offset %f (%f + %f) is outside plotting area. Recalculating.' % (estime.astimezone(mytz), evtStr, ynorm[timeIndex] + gluMult * eyoffset, ynorm[timeIndex], gluMult * eyoffset))
+                print('Event @ %s \'%s\' Y offset %f (%f + %f) is outside plotting area. Recalculating.' % (mdates.num2date(estime, tz=mytz), evtStr, ynorm[timeIndex] + gluMult * eyoffset, ynorm[timeIndex], gluMult * eyoffset))
             strawY = multY*(75+longTextBump)
             if ((ynorm[timeIndex] + gluMult * strawY) > maxDisplayHigh) or ((ynorm[timeIndex] + gluMult * strawY) < 0):
                 eyoffset = -strawY
@@ -3173,7 +3374,7 @@ def ShowOrHideEventsNotes():
 
             if ((ynorm[timeIndex] + gluMult * eyoffset) > maxDisplayHigh) or (ynorm[timeIndex] + gluMult * eyoffset < 0):
                 if args.debug:
-                    print('Event @ %s \'%s\' recalculated Y offset %f (%f + %f) is outside plotting area.' % (estime.astimezone(mytz), evtStr, ynorm[timeIndex] + gluMult * eyoffset, ynorm[timeIndex], gluMult * eyoffset))
+                    print('Event @ %s \'%s\' recalculated Y offset %f (%f + %f) is outside plotting area.' % (mdates.num2date(estime, tz=mytz), evtStr, ynorm[timeIndex] + gluMult * eyoffset, ynorm[timeIndex], gluMult * eyoffset))
                 eyoffset *= -1.5
             repositioned = True
             if args.debug:
@@ -3181,7 +3382,7 @@ def ShowOrHideEventsNotes():
 
         # optionally add 'clip_on=True' to prevent string from extending out of graph axes
         evt_annot = ax.annotate(evtStr,
-                                xy=(mdates.date2num(estime), ynorm[timeIndex]), xycoords='data',
+                                xy=(estime, ynorm[timeIndex]), xycoords='data',
                                 xytext=(exoffset, eyoffset), textcoords='offset pixels',
                                 fontsize=eventFontSize, color=evt_color,
                                 arrowprops=dict(connectionstyle="arc3,rad=.3", facecolor=evt_color,
@@ -3212,9 +3413,9 @@ def ShowOrHideEventsNotes():
     outScopePlotList = []
     for note_Ann in notePlotList:
         #print('Note @ %s \'%s\'' % (mdates.num2date(note_Ann.xy[0], mytz), note_Ann.get_text()))
-        if mdates.num2date(note_Ann.xy[0], tz=mytz) >= minTod and mdates.num2date(note_Ann.xy[0], tz=mytz) <= maxTod:
+        if minTodNum <= note_Ann.xy[0] <= maxTodNum:
             # note in scope
-            inScopeNoteTimeSet.add(mdates.num2date(note_Ann.xy[0]))
+            inScopeNoteTimeSet.add(note_Ann.xy[0])
             inScopePlotList.append(note_Ann)
             inNoteSet.add(note_Ann)
         else:
@@ -3244,12 +3445,12 @@ def ShowOrHideEventsNotes():
         # with a small offset.
         if nxoffset < -ax_width / 2:
             if args.debug:
-                print('Note @ %s \'%s\' X offset %f < -half screen width (%f)' % (estime.astimezone(mytz), message, nxoffset, -ax_width / 2))
+                print('Note @ %s \'%s\' X offset %f < -half screen width (%f)' % (mdates.num2date(estime, tz=mytz), message, nxoffset, -ax_width / 2))
             nxoffset = -60.0
             repositioned = True
         elif nxoffset > ax_width / 2:
             if args.debug:
-                print('Note @ %s \'%s\' X offset %f > half screen width (%f)' % (estime.astimezone(mytz), message, nxoffset, ax_width / 2))
+                print('Note @ %s \'%s\' X offset %f > half screen width (%f)' % (mdates.num2date(estime, tz=mytz), message, nxoffset, ax_width / 2))
             nxoffset = 60.0
             repositioned = True
 
@@ -3257,12 +3458,12 @@ def ShowOrHideEventsNotes():
         # it with a small offset.
         if nyoffset < -ax_height / 2:
             if args.debug:
-                print('Note @ %s \'%s\' Y offset %f < -half screen height (%f)' % (estime.astimezone(mytz), message, nyoffset, -ax_height / 2))
+                print('Note @ %s \'%s\' Y offset %f < -half screen height (%f)' % (mdates.num2date(estime, tz=mytz), message, nyoffset, -ax_height / 2))
             nyoffset = -60.0
             repositioned = True
         elif nyoffset > ax_height / 2:
             if args.debug:
-                print('Note @ %s \'%s\' Y offset %f > half screen height (%f)' % (estime.astimezone(mytz), message, nyoffset, ax_height / 2))
+                print('Note @ %s \'%s\' Y offset %f > half screen height (%f)' % (mdates.num2date(estime, tz=mytz), message, nyoffset, ax_height / 2))
             nyoffset = 60.0
             repositioned = True
 
@@ -3275,7 +3476,7 @@ def ShowOrHideEventsNotes():
         # recalculate the offset position.
         if (ynorm[timeIndex] + gluMult * nyoffset > maxDisplayHigh) or (ynorm[timeIndex] + gluMult * nyoffset < 0):
             if args.debug:
-                print('Note @ %s \'%s\' Y offset %f (%f + %f) is outside plotting area. Recalculating.' % (estime.astimezone(mytz), message, ynorm[timeIndex] + gluMult * nyoffset, ynorm[timeIndex], gluMult * nyoffset))
+                print('Note @ %s \'%s\' Y offset %f (%f + %f) is outside plotting area. Recalculating.' % (mdates.num2date(estime, tz=mytz), message, ynorm[timeIndex] + gluMult * nyoffset, ynorm[timeIndex], gluMult * nyoffset))
             strawY = multY*(75+longTextBump)
             if ((ynorm[timeIndex] + strawY) > maxDisplayHigh) or ((ynorm[timeIndex] + strawY) < 0):
                 nyoffset = -strawY
@@ -3284,7 +3485,7 @@ def ShowOrHideEventsNotes():
 
             if ((ynorm[timeIndex] + gluMult * nyoffset) > maxDisplayHigh) or (ynorm[timeIndex] + gluMult * nyoffset < 0):
                 if args.debug:
-                    print('Note @ %s \'%s\' recalculated Y offset %f (%f + %f) is outside plotting area.' % (estime.astimezone(mytz), message, ynorm[timeIndex] + gluMult * nyoffset, ynorm[timeIndex], gluMult * nyoffset))
+                    print('Note @ %s \'%s\' recalculated Y offset %f (%f + %f) is outside plotting area.' % (mdates.num2date(estime, tz=mytz), message, ynorm[timeIndex] + gluMult * nyoffset, ynorm[timeIndex], gluMult * nyoffset))
                 nyoffset *= -1.5
             repositioned = True
             if args.debug:
@@ -3292,7 +3493,7 @@ def ShowOrHideEventsNotes():
 
         #print('Note: estime =', estime, ', gluc =', ynorm[timeIndex],'message =', message, 'xoffset =', nxoffset, 'yoffset =', nyoffset)
         noteAnn = ax.annotate(message,
-                              xy=(mdates.date2num(estime), ynorm[timeIndex]), xycoords='data',
+                              xy=(estime, ynorm[timeIndex]), xycoords='data',
                               xytext=(nxoffset, nyoffset), textcoords='offset pixels',
                               color='black', fontsize=eventFontSize,
                               arrowprops=dict(connectionstyle="arc3,rad=-0.3", facecolor='brown',
@@ -3321,6 +3522,7 @@ def plotGraph():
     global ax
     global xnorm
     global ynorm
+    global egvSeconds
     global calibScatter
     global egvScatter
     global desirableRange
@@ -3373,6 +3575,7 @@ def plotGraph():
     global tgtLowBox
     global tgtHighBox
     global futurePlot
+    global futureBand
     global future_patch
     global tgtDecDigits
     global submit_tgtLow_id
@@ -3429,8 +3632,8 @@ def plotGraph():
         setPropsFromScale(cfgScale)
 
         readRangeFromSql()
-        curSqlMaxTime = lastTestSysSecs - offsetSeconds + futureSecs
-        curSqlMinTime = max(lastTestSysSecs - offsetSeconds + futureSecs - ninetyDaysInSeconds - bufferSeconds, firstTestSysSecs - offsetSeconds)
+        curSqlMinTime, curSqlMaxTime = sqlwindow.WindowBounds(lastTestSysSecs - offsetSeconds + futureSecs, firstTestSysSecs - offsetSeconds,
+                                                              lastTestSysSecs - offsetSeconds + futureSecs)[1:]
 
         firstPlotGraph = 0
 
@@ -3463,8 +3666,7 @@ def plotGraph():
         # erase all previously plotted out of calibration regions
         while redRangePlottedSet:
             specRange = redRangePlottedSet.pop()
-            startRangeNum = mdates.date2num(specRange[0])
-            endRangeNum = mdates.date2num(specRange[1])
+            (startRangeNum, endRangeNum) = specRange
             stalePatch = redRangeDict.pop((startRangeNum, endRangeNum), None)   # returns None if key not found
             if stalePatch:
                 #if args.debug:
@@ -3474,8 +3676,7 @@ def plotGraph():
         # erase all previously plotted in range for 24+ hour regions
         while inRangePlottedSet:
             specRange = inRangePlottedSet.pop()
-            startRangeNum = mdates.date2num(specRange[0])
-            endRangeNum = mdates.date2num(specRange[1])
+            (startRangeNum, endRangeNum) = specRange
             stalePatch = inRangeDict.pop((startRangeNum, endRangeNum), None)   # returns None if key not found
             if stalePatch:
                 #if args.debug:
@@ -3510,9 +3711,10 @@ def plotGraph():
         # create a fake data point.
         #==================================================================================
         utcTime = datetime.datetime.now(pytz.UTC)
-        egvList.append([utcTime + datetime.timedelta(seconds=offsetSeconds), 130, 130.0])
-        # Set timing variables to the current time offset
         receiverSecs = UtcTimeToReceiverTime(utcTime)
+        egvSeconds = np.array([receiverSecs + offsetSeconds], dtype=np.int64)
+        egvList.append([timeconv.ReceiverSecondsToNum(receiverSecs + offsetSeconds), 130, 130.0])
+        # Set timing variables to the current time offset
         displayStartSecs = receiverSecs + offsetSeconds
         displayEndSecs = receiverSecs + offsetSeconds
         curSqlMinTime = receiverSecs
@@ -3629,31 +3831,36 @@ def plotGraph():
             sys.exc_clear()
 
     if egvList:
-        data = np.array(egvList)
-        dataNorm = np.array([_ for _ in data if _[1] > 12])   # filter out fake glucose values
+        # Times are matplotlib date numbers, so this is an array of floats
+        data = np.array(egvList, dtype=np.float64)
+        normMask = data[:, 1] > 12   # filter out fake glucose values
+        dataNorm = data[normMask]
         #print('sizeof(data) =', len(data), 'sizeof(dataNorm) =', len(dataNorm))
-        xx = data[:, 0] # ReceiverTimeToUtcTime(sysSeconds)
+        xx = data[:, 0] # time
         yy = data[:, 1] # glucose
         #print('sizeof(data) =',len(data),'sizeof(xx) =',len(xx),'sizeof(yy) =',len(yy))
-        xnorm = dataNorm[:, 0]  # sysSeconds
+        xnorm = dataNorm[:, 0]  # time
+        xnormNum = xnorm
         ynorm = dataNorm[:, 1] * gluMult # glucose
         runningMean = dataNorm[:, 2] * gluMult
 
         # create subset of normal (non-calib) data points
         # and a subset of calibration data points
         cxnorm = []
+        cxnormNum = []
         cynorm = []
         cznorm = []
 
-        calibdata = np.array([_ for _ in calibList if _[1] > 12])
+        calibdata = np.array([_ for _ in calibList if _[1] > 12], dtype=np.float64)
         if calibdata.size != 0:
-            cxnorm = calibdata[:, 0] # sysSeconds
+            cxnorm = calibdata[:, 0] # time
+            cxnormNum = cxnorm
             cynorm = calibdata[:, 1] * gluMult # glucose
             cznorm = calibdata[:, 2] * gluMult # calibration
             #print('sizeof(xnorm) =',len(xnorm),'sizeof(cxnorm) =',len(cxnorm),'sizeof(cynorm) =',len(cynorm))
 
         # Find User Calibration data input when Sensor was missing or not yet calibrated.
-        uncalDataPoints = np.array([_ for _ in calibList if _[3] == 1])
+        uncalDataPoints = np.array([_ for _ in calibList if _[3] == 1], dtype=np.float64)
 
         #-----------------------------------------------------
         # Find ranges where we're out of calibration.
@@ -3663,38 +3870,44 @@ def plotGraph():
         #-----------------------------------------------------
         calibZoneList = []
         outOfCalZoneSet = set()
-        lastx = ReceiverTimeToUtcTime(curSqlMinTime + offsetSeconds)
-        lasty = sqlEarliestGluc
-        startOfZone = lastx
-        for pointx, pointy in zip(xx, yy):
-            # Check if the specified data point came from a User Calibration entered
-            # while the Sensor was uncalibrated.
-            if uncalDataPoints.size != 0:
-                isManualGluc = np.any(uncalDataPoints[:, 0] == pointx)
-            else:
-                isManualGluc = False
-            if (lasty <= 12) and (pointy > 12) and not isManualGluc:
-                # we've transitioned out of a calib zone
-                #print('calibZoneList[] adding ',startOfZone,'to',pointx)
-                calibZoneList.append([startOfZone, pointx])
-                outOfCalZoneSet.add((startOfZone, pointx))
-            elif (lasty > 12) and ((pointy <= 12) or isManualGluc):
-                # we've transitioned into a calib zone
-                startOfZone = pointx
-            if not isManualGluc:
-                lastx = pointx
-                lasty = pointy
+        if specialZones is not None:
+            # The ranges were found when the readings were downloaded
+            for (startOfZone, endOfZone) in specialZones:
+                calibZoneList.append([startOfZone, endOfZone])
+                outOfCalZoneSet.add((startOfZone, endOfZone))
+        else:
+            lastx = timeconv.ReceiverSecondsToNum(curSqlMinTime + offsetSeconds)
+            lasty = sqlEarliestGluc
+            startOfZone = lastx
+            for pointx, pointy in zip(xx.tolist(), yy.tolist()):
+                # Check if the specified data point came from a User Calibration entered
+                # while the Sensor was uncalibrated.
+                if uncalDataPoints.size != 0:
+                    isManualGluc = np.any(uncalDataPoints[:, 0] == pointx)
+                else:
+                    isManualGluc = False
+                if (lasty <= 12) and (pointy > 12) and not isManualGluc:
+                    # we've transitioned out of a calib zone
+                    #print('calibZoneList[] adding ',startOfZone,'to',pointx)
+                    calibZoneList.append([startOfZone, pointx])
+                    outOfCalZoneSet.add((startOfZone, pointx))
+                elif (lasty > 12) and ((pointy <= 12) or isManualGluc):
+                    # we've transitioned into a calib zone
+                    startOfZone = pointx
+                if not isManualGluc:
+                    lastx = pointx
+                    lasty = pointy
 
-        #if args.debug:
-            #print('plotGraph() :  After calibZoneList() count =', len(muppy.get_objects()))
-            #print('++++++++++++++++++++++++++++++++++++++++++++++++\n')
-            #memory_tracker.print_diff()
+            #if args.debug:
+                #print('plotGraph() :  After calibZoneList() count =', len(muppy.get_objects()))
+                #print('++++++++++++++++++++++++++++++++++++++++++++++++\n')
+                #memory_tracker.print_diff()
 
-        # Check for SENSOR_NOT_CALIBRATED or SENSOR_NOT_ACTIVE at the end
-        # of the SQL selection.
-        if lasty in (5, 1):
-            calibZoneList.append([startOfZone, lastx])
-            outOfCalZoneSet.add((startOfZone, lastx))
+            # Check for SENSOR_NOT_CALIBRATED or SENSOR_NOT_ACTIVE at the end
+            # of the SQL selection.
+            if lasty in (5, 1):
+                calibZoneList.append([startOfZone, lastx])
+                outOfCalZoneSet.add((startOfZone, lastx))
 
         # Check for SENSOR_NOT_CALIBRATED or SENSOR_NOT_ACTIVE as the latest value
         if lastTestGluc in (5, 1):
@@ -3763,8 +3976,7 @@ def plotGraph():
 
         # Remove any descoped out-of-calibration ranges
         for specRange in descopedRangeSet:
-            startRangeNum = mdates.date2num(specRange[0])
-            endRangeNum = mdates.date2num(specRange[1])
+            (startRangeNum, endRangeNum) = specRange
             stalePatch = redRangeDict.pop((startRangeNum, endRangeNum), None)   # returns None if key not found
             if stalePatch:
                 #if args.debug:
@@ -3774,8 +3986,7 @@ def plotGraph():
 
         # Add any new out-of-calibration ranges
         for specRange in newRangeSet:
-            startRangeNum = mdates.date2num(specRange[0])
-            endRangeNum = mdates.date2num(specRange[1])
+            (startRangeNum, endRangeNum) = specRange
 
             #if args.debug:
                 #print('Highlighting out of calibration range', specRange[0], 'to', specRange[1])
@@ -3798,13 +4009,14 @@ def plotGraph():
         # partial region which is increasing in size.
         #-----------------------------------------------------------
         inRangeSet = set()
-        lastx = ReceiverTimeToUtcTime(curSqlMinTime + offsetSeconds)
+        lastx = timeconv.ReceiverSecondsToNum(curSqlMinTime + offsetSeconds)
         lasty = sqlEarliestGluc
         startOfZone = lastx
-        for pointx, pointy in zip(xnorm, ynorm):
+        # Plain floats, since glucInRange() results are compared with 'is'
+        for pointx, pointy in zip(xnorm.tolist(), ynorm.tolist()):
             if (glucInRange(lasty) is True) and (glucInRange(pointy) is False):
                 # we've transitioned out desirable range
-                if pointx - startOfZone >= datetime.timedelta(hours=24):
+                if pointx - startOfZone >= 1.0:    # date numbers are in days
                     inRangeSet.add((startOfZone, pointx))
             elif (glucInRange(lasty) is False) and (glucInRange(pointy) is True):
                 # we've transitioned into desirable range
@@ -3815,7 +4027,7 @@ def plotGraph():
         if glucInRange(lasty) is True:
             # We reached the end of the data points while still in
             # range, so add this final range.
-            if lastx - startOfZone >= datetime.timedelta(hours=24):
+            if lastx - startOfZone >= 1.0:
                 #print('inRangeSet[] adding ',startOfZone,'to',lastx)
                 inRangeSet.add((startOfZone, lastx))
 
@@ -3828,8 +4040,7 @@ def plotGraph():
 
         # Remove any descoped 24 hour ranges
         for specRange in descopedRangeSet:
-            startRangeNum = mdates.date2num(specRange[0])
-            endRangeNum = mdates.date2num(specRange[1])
+            (startRangeNum, endRangeNum) = specRange
             stalePatch = inRangeDict.pop((startRangeNum, endRangeNum), None)   # returns None if key not found
             if stalePatch:
                 #if args.debug:
@@ -3845,8 +4056,7 @@ def plotGraph():
             #if args.debug:
                 #print('Highlighting 24+ hour range', specRange[0], 'to', specRange[1])
 
-            startRangeNum = mdates.date2num(specRange[0])
-            endRangeNum = mdates.date2num(specRange[1])
+            (startRangeNum, endRangeNum) = specRange
             inRange_patch = ax.axvspan(startRangeNum,
                                        endRangeNum,
                                        0.0, 1.0, color='lightsteelblue',
@@ -3865,8 +4075,8 @@ def plotGraph():
 
             xcenter = startRangeNum + (endRangeNum - startRangeNum)/2
 
-            inRangeDelta = specRange[1] - specRange[0]
-            inRangeHours = inRangeDelta.days * 24 + inRangeDelta.seconds // 3600
+            inRangeSeconds = int(round((endRangeNum - startRangeNum) * timeconv.SECONDS_PER_DAY))
+            inRangeHours = inRangeSeconds // 3600
             inRangeArrow3 = ax.annotate('%u hours in Target Range!' % inRangeHours,
                                         xy=(xcenter, gluMult * sqlMaximumGluc * 0.94), ha='center',
                                         va='center', fontsize=inRangeFontSize, annotation_clip=False)
@@ -3890,7 +4100,7 @@ def plotGraph():
             egvScatter.remove()
             #if args.debug:
                 #print('plotGraph() : After egvScatter remove      count =', len(muppy.get_objects()))
-        egvScatter = ax.scatter([mdates.date2num(jj) for jj in xnorm], ynorm, s=15, c=kcolor, zorder=8, marker='o', picker=True)
+        egvScatter = ax.scatter(xnormNum, ynorm, s=15, c=kcolor, zorder=8, marker='o', picker=True)
         #if args.debug:
             #print('plotGraph() : After egvScatter             count =', len(muppy.get_objects()))
 
@@ -3928,7 +4138,7 @@ def plotGraph():
 
                 #if args.debug:
                     #print('plotGraph() : Before calibScatter          count =', len(muppy.get_objects()))
-                calibScatter = ax.errorbar([mdates.date2num(jj) for jj in cxnorm], cynorm,
+                calibScatter = ax.errorbar(cxnormNum, cynorm,
                                            yerr=absSlice, lolims=lowerLims, uplims=upperLims,
                                            marker='D', linestyle='None', color='black',
                                            elinewidth=2, ecolor='deeppink', picker=True, zorder=10)
@@ -3936,9 +4146,9 @@ def plotGraph():
                     #print('plotGraph() : After calibScatter           count =', len(muppy.get_objects()))
 
                 if sys.version_info.major > 2:
-                    calibZip = list(zip(cxnorm, cynorm, cznorm))
+                    calibZip = list(zip(cxnorm, cynorm, cznorm, cxnormNum))
                 else:
-                    calibZip = zip(cxnorm, cynorm, cznorm)
+                    calibZip = zip(cxnorm, cynorm, cznorm, cxnormNum)
                 #if args.debug:
                     #print('plotGraph() : After calibZip               count =', len(muppy.get_objects()))
                 for qq in calibZip:
@@ -3951,11 +4161,11 @@ def plotGraph():
                             heightOffset = -14 * gluMult
                         # Save the reference to ax.text in a dictionary
                         if dispGluUnits == 'mmol/L':
-                            calibDict[qq[0]] = ax.text(mdates.date2num(qq[0]), qq[1] + qq[2] + heightOffset,
+                            calibDict[qq[0]] = ax.text(qq[3], qq[1] + qq[2] + heightOffset,
                                                        '%5.2f' % (qq[1] + qq[2]), color='black', ha='center',
                                                        fontsize=calibFontSize, clip_on=True, zorder=18)
                         else:
-                            calibDict[qq[0]] = ax.text(mdates.date2num(qq[0]), qq[1] + qq[2] + heightOffset,
+                            calibDict[qq[0]] = ax.text(qq[3], qq[1] + qq[2] + heightOffset,
                                                        '%d' % (qq[1] + qq[2]), color='black', ha='center',
                                                        fontsize=calibFontSize, clip_on=True, zorder=18)
                         #if args.debug:
@@ -3972,7 +4182,7 @@ def plotGraph():
             #if args.debug:
                 #print('plotGraph() : After linePlot remove        count =', len(muppy.get_objects()))
                 #memory_tracker.print_diff()
-        linePlot = ax.plot(xnorm, ynorm, color='cornflowerblue', zorder=7)
+        linePlot = ax.plot(xnormNum, ynorm, color='cornflowerblue', zorder=7)
         #if args.debug:
             #print('plotGraph() : After linePlot               count =', len(muppy.get_objects()))
             #memory_tracker.print_diff()
@@ -3981,102 +4191,52 @@ def plotGraph():
         # Plot a running mean as a dashed line
         if meanPlot:
             meanPlot.pop(0).remove()
-        meanPlot = ax.plot(xnorm, runningMean, color='firebrick', linewidth=1.0, linestyle='dashed', zorder=6, alpha=0.6)
+        meanPlot = ax.plot(xnormNum, runningMean, color='firebrick', linewidth=1.0, linestyle='dashed', zorder=6, alpha=0.6)
+
+        #========================================================================================
+        # Draw the Ambulatory Glucose Profile behind the readings, if it's turned on
+        plotAgpOverlay()
 
         #if args.debug:
             #print('plotGraph() : After running mean           count =', len(muppy.get_objects()))
         #========================================================================================
 
-        # We're going to predict future values base on the last 6
-        # data points, but don't do this until we have at least
-        # that much data to analyze.
-        if len(dataNorm) > 6:
+        # Predict future values from Kalman filters, which only take in the
+        # readings they haven't seen before. Don't do this until they've had
+        # at least 6 readings to analyze.
+        trendTracker.sync(egvSeconds[normMask], dataNorm[:, 1].astype(np.float64))
+        if trendTracker.count() > 6:
             #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-            # Use recent data to find polynomials to predict future values.
-            recentData = dataNorm[-6:]  # base predictions on last 6 values
-            recentDates = recentData[:, 0]  # datetime
-            recentDays = mdates.date2num(recentData[:, 0])  # time, in days
-            recentGluc = recentData[:, 1].astype(np.float32)  # glucose
-
-            # We don't want to use large X values (e.g. 737648.9121412) because
-            # this will quickly cause overflows when raised to higher exponents. We don't
-            # want really small X values (e.g. .00003) because they will quickly cause underflows
-            # when raised to higher exponents. We want something nicely sized, in the middle,
-            # preferably greater than 1, but not too much greater than 1.
-            #
-            # The numbers in 'recentDays' are roughly in units of days since year 1. The data
-            # samples are acquired in 5 minutes intervals, which is just a fraction of a day.
-            #
-            #       5 minutes = 5/60/24 = 0.003472222 days
-            #
-            # To convert this interval to a reasonable step value, multiply by 300.
-            #
-            # Time values look like this, in days:
-            #       737646.1967476852,
-            #       737646.2002199073,  (+ 0.003472222 from previous)
-            #       737646.2036921296,
-            #       737646.2071643518,
-            #
-            # If we multiply by 300, we get:
-            #       221293859.02430556,
-            #       221293860.06597219, (+ 1.04166663 from previous)
-            #       221293861.10763888,
-            #       221293862.14930554
-            #
-            # Now subtract the integer value of the first entry (221293859):
-            #               0.02430556,
-            #               1.06597219,
-            #               2.10763888,
-            #               3.14930554
-            #
-            # This gives us a nicely sized, slowly advancing step of 1.04166663
-            # to feed into the polyfit() routine.
-
-            # Convert the X-dimension data using this scheme
-            daysX300 = recentDays * 300.0
-            shiftX = daysX300 - int(daysX300[0])
-            # degrees:       1       2        3        4
-            futureColor = ['red', 'green', 'blue', 'orange']
-
-            # Note: 'polyf' must be defined before this can be invoked
-            def predictFunc(daysFloat):
-                multDays = daysFloat * 300.0
-                shiftDays = multDays - int(multDays[0])
-                return np.clip(polyf(shiftDays), 40.0, sqlMaximumGluc)
-
-            # A range of (1, 3) will display 1 and 2 degree polynomials
-            # Set range to (1, 5) to add 3 and, 4 degree polynomials
-            dash_offset = 0
-            fut_range_start = 1
-            fut_range_end = 3
-            for coefCount in range(fut_range_start, fut_range_end):
-                if futurePlot[coefCount-1]:
-                    futurePlot[coefCount-1].pop(0).remove()
-                    futurePlot[coefCount-1] = None
-
-                coefficients = np.polyfit(shiftX, recentGluc, coefCount)
-                polyf = np.poly1d(coefficients)
-                if args.debug:
-                    print(coefCount, 'degree polynomial =\n', polyf)
-
-                # calculate future data points (1 hour forward)
-                x_new = np.linspace(recentDays[0], recentDays[-1] + 1.0/24, 20)
-                y_new = predictFunc(x_new) * gluMult
-                futurePlot[coefCount-1] = ax.plot(x_new, y_new, \
-                                                  linestyle=(dash_offset, (2, fut_range_end-fut_range_start+1)), \
-                                                  color=futureColor[coefCount-1], linewidth=2, zorder=3)
-                dash_offset += 2
-                if args.debug:
-                    print('1 hour prediction : at', mdates.num2date(x_new[-1], tz=mytz), 'glucose = %g' % round((y_new[-1]), tgtDecDigits))
-                    #xPlusTwo = np.array([recentDays[0], recentDays[-1] + float(2/24)])
-                    #yTwoHour = predictFunc(xPlusTwo)
-                    #print('2 hour prediction : at', mdates.num2date(xPlusTwo[1], tz=mytz), 'glucose = %g' % round(yTwoHour[1], tgtDecDigits)
-                    print('\n')
+            # Predict values up to 1 hour past the latest reading
+            horizons = np.linspace(0.0, futureSecs, 20)
+            x_new = timeconv.ReceiverSecondsToNum(trendTracker.lastSeconds + horizons)
+
+            (predicted, low, high) = trendTracker.predict(1, horizons)
+            y_new = np.clip(predicted, 40.0, sqlMaximumGluc) * gluMult
+            y_low = np.clip(low, 40.0, sqlMaximumGluc) * gluMult
+            y_high = np.clip(high, 40.0, sqlMaximumGluc) * gluMult
+            if futurePlot:
+                # Move the existing line
+                futurePlot.set_data(x_new, y_new)
+                futurePlot.set_visible(True)
+            else:
+                futurePlot, = ax.plot(x_new, y_new, linestyle=(0, (2, 2)),
+                                      color='red', linewidth=2, zorder=3)
+            # A filled band can't be moved, so draw a new one
+            if futureBand:
+                futureBand.remove()
+            futureBand = ax.fill_between(x_new, y_low, y_high, color='red', alpha=0.15,
+                                         linewidth=0, zorder=3)
+            if args.debug:
+                print('1 hour prediction : at', mdates.num2date(x_new[-1], tz=mytz),
+                      'glucose = %g (95%% band %g - %g)' % (round(y_new[-1], tgtDecDigits),
+                                                           round(y_low[-1], tgtDecDigits),
+                                                           round(y_high[-1], tgtDecDigits)))
 
             #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
             # Shade the background of the future range in grey
-            startFutureRangeNum = mdates.date2num(ReceiverTimeToUtcTime(lastTestSysSecs).astimezone(mytz))
-            endFutureRangeNum = mdates.date2num(ReceiverTimeToUtcTime(lastTestSysSecs + futureSecs).astimezone(mytz))
+            startFutureRangeNum = timeconv.ReceiverSecondsToNum(lastTestSysSecs)
+            endFutureRangeNum = timeconv.ReceiverSecondsToNum(lastTestSysSecs + futureSecs)
             if future_patch:
                 # Update the existing patch
                 if mpl_vt >= versiontuple('3.9.0'):
@@ -4097,6 +4257,13 @@ def plotGraph():
                                           0.0, 1.0, color='lightgrey',
                                           alpha=1.0, zorder=2)
             #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+        else:
+            # Not enough recent readings, so hide any old prediction
+            if futurePlot:
+                futurePlot.set_visible(False)
+            if futureBand:
+                futureBand.remove()
+                futureBand = None
 
         #if args.debug:
             #print('plotGraph() :  After plots count =', len(muppy.get_objects()))
@@ -4290,7 +4457,9 @@ fig.canvas.mpl_connect('axes_leave_event', leave_axes)
 sqlite_file = getSqlFileName(None)
 if args.debug:
     print('sqlite_file =', sqlite_file)
+markStartup('module setup')
 plotInit()
+markStartup('plotInit()')
 # We need to call plotGraph() before launching the device seek thread because
 # that thread could also end up calling plotGraph(). If the seek thread calls
 # it first, matplotlib will generate error or warning messages, such as:
@@ -4298,7 +4467,13 @@ plotInit()
 # same arguments as a previous axes currently reuses the earlier instance.
 # In a future version, a new instance will always be created and returned.'
 plotGraph()
-PerodicDeviceSeek()  # launch thread to check for device presence periodically
+markStartup('plotGraph()')
+firstDrawId = fig.canvas.mpl_connect('draw_event', onFirstDraw)
+
+if args.startup:
+    # Render the first frame now, report on it, and exit
+    fig.canvas.draw()
+    sys.exit(0)
 
 plt.show()  # This hangs until the user closes the window
 #print('returned from plt.show()')
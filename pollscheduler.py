@@ -0,0 +1,158 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# A receiver records a new glucose reading about every 5 minutes. Rather
+# than polling 5 minutes after our previous poll, which can land almost 5
+# minutes after new data appeared, PollScheduler learns when readings are
+# made, from their sysSeconds timestamps and the receiver's clock, and
+# schedules each poll a few seconds after the next reading is due.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import math
+import random
+import time
+
+
+class PollScheduler(object):
+    """Decide when to poll a receiver next.
+
+    At each poll, pass the newest reading times to learn(), which says
+    whether there's new data. Once the poll has been handled, call done(),
+    or failed() if anything went wrong, so a reading isn't treated as seen
+    until it has been stored. Then call schedule() to find how long to wait.
+
+    Args:
+        period: the nominal time between readings, in seconds
+        guard: how long after a reading is due to poll for it, allowing for
+               the receiver's processing and small clock errors
+        minRetry: the first delay after a failure. Delays double with each
+                  consecutive failure, up to 'period'.
+        lateRetry: the delay before checking again for a reading which
+                   was due, but hadn't appeared
+        maxLateRetries: how many times to check for an overdue reading
+                        before waiting for the next one instead
+    """
+
+    def __init__(self, period=300.0, guard=8.0, minRetry=5.0, lateRetry=20.0, maxLateRetries=3):
+        self.nominalPeriod = float(period)
+        self.period = float(period)
+        self.guard = guard
+        self.minRetry = minRetry
+        self.lateRetry = lateRetry
+        self.maxLateRetries = maxLateRetries
+        self.lastReading = None     # receiver sysSeconds of the newest stored reading
+        self.newestReading = None   # newest reading seen by learn()
+        self.clockOffset = None     # local time minus receiver system time
+        self.failures = 0
+        self.lateRetries = 0
+
+    def learn(self, readingTimes, receiverNow=None, localNow=None):
+        """Update the schedule from the newest readings.
+
+        Args:
+            readingTimes: sysSeconds of the most recent readings, oldest first
+            receiverNow: the receiver's current system time, in sysSeconds
+            localNow: the local time.time() when receiverNow was read
+
+        Returns:
+            True if the newest reading hasn't been seen before
+        """
+        if localNow is None:
+            localNow = time.time()
+        if receiverNow is not None:
+            self.clockOffset = localNow - receiverNow
+
+        # Estimate the period from gaps between consecutive readings,
+        # ignoring gaps caused by missed readings
+        diffs = sorted(b - a for a, b in zip(readingTimes, readingTimes[1:])
+                       if 0 < b - a < 1.5 * self.nominalPeriod)
+        if diffs:
+            median = diffs[len(diffs) // 2]
+            # Smooth the estimate, and keep it close to the nominal period
+            self.period = 0.75 * self.period + 0.25 * median
+            self.period = min(max(self.period, 0.9 * self.nominalPeriod), 1.1 * self.nominalPeriod)
+
+        if not readingTimes:
+            # No readings to compare, so we can't rule out new data
+            return self.lastReading is None
+        self.newestReading = readingTimes[-1]
+        return (self.lastReading is None) or (self.newestReading > self.lastReading)
+
+    def done(self):
+        self.failures = 0
+        if (self.newestReading is not None) and \
+           ((self.lastReading is None) or (self.newestReading > self.lastReading)):
+            self.lastReading = self.newestReading
+            self.lateRetries = 0
+
+    def failed(self):
+        self.failures += 1
+
+    def schedule(self, localNow=None):
+        """Returns the number of seconds to wait before the next poll"""
+        if localNow is None:
+            localNow = time.time()
+
+        if self.failures:
+            delay = min(self.minRetry * 2 ** (self.failures - 1), self.period)
+            # Add jitter, so that retries don't fall into lock step with anything
+            return delay * random.uniform(0.75, 1.0)
+
+        if (self.lastReading is None) or (self.clockOffset is None):
+            return self.period
+
+        due = self.lastReading + self.clockOffset + self.period
+        if due + self.guard <= localNow:
+            # The next reading is overdue. Check a few more times, in case it
+            # is only late, before assuming it was missed.
+            if self.lateRetries < self.maxLateRetries:
+                self.lateRetries += 1
+                return self.lateRetry
+            missed = math.floor((localNow - due - self.guard) / self.period) + 1
+            due += missed * self.period
+        return max(due + self.guard - localNow, 1.0)
+
+
+if __name__ == '__main__':
+    # Simulate a receiver making readings every 299 seconds, from a clock
+    # offset by 1000 seconds, and show how stale each poll's data is.
+    sched = PollScheduler()
+    readingPeriod = 299.0
+    offset = 1000.0
+    now = 50000.0
+    first = now - 123.0
+    lags = []
+    polls = 0
+    while now < 50000.0 + 24 * 3600:
+        polls += 1
+        receiverNow = now - offset
+        count = int((receiverNow - (first - offset)) // readingPeriod) + 1
+        times = [first - offset + readingPeriod * i for i in range(max(count - 12, 0), count)]
+        if sched.learn(times, receiverNow, now):
+            lags.append(now - (times[-1] + offset))
+        sched.done()
+        now += sched.schedule(now)
+    lags.sort()
+    print('polls =', polls, ': new readings =', len(lags))
+    print('lag from reading to poll : median = %.1f s, max = %.1f s' %
+          (lags[len(lags) // 2], lags[-1]))
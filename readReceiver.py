@@ -25,13 +25,85 @@ import sys
 import sqlite3
 import threading
 import serial
+import changefeed
+import constants
+import dailysummary
+import sensorsession
+import signalgaps
+import dbschema
 import readdata
 import database_records
 #from traceback import print_exc
 
 
+#-------------------------------------------------------------------------
+class PortLock(object):
+    """A lock serializing access to one serial port.
+
+    The lock is reentrant, so a thread holding it for a multi-command
+    operation can also take it for each command/response transaction.
+    Long downloads take it once per transaction, rather than for the
+    whole download, and a waiter who asks for priority is served ahead
+    of ordinary waiters. So a quick query, such as for the latest glucose
+    reading, slips in between the page reads of a long download.
+    """
+    _ports = {}
+    _portsLock = threading.Lock()
+
+    @classmethod
+    def ForPort(cls, port_name):
+        with cls._portsLock:
+            lock = cls._ports.get(port_name)
+            if lock is None:
+                lock = cls()
+                cls._ports[port_name] = lock
+            return lock
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._count = 0
+        self._priorityWaiters = 0
+
+    def acquire(self, priority=False):
+        me = threading.current_thread()
+        with self._cond:
+            if self._owner is me:
+                self._count += 1
+                return True
+            if priority:
+                self._priorityWaiters += 1
+            try:
+                while (self._owner is not None) or ((not priority) and (self._priorityWaiters > 0)):
+                    self._cond.wait()
+            finally:
+                if priority:
+                    self._priorityWaiters -= 1
+            self._owner = me
+            self._count = 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._owner is not threading.current_thread():
+                raise RuntimeError('PortLock released by a thread which does not own it')
+            self._count -= 1
+            if self._count == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+#-------------------------------------------------------------------------
 class readReceiverBase(readdata.Dexcom):
-    _lock = threading.Lock()
+    # Newly stored records are published here after each download
+    changeFeed = changefeed.defaultFeed
 
     # We don't want to try to re-open a port which has already been opened,
     # so we include an optional 'port' argument, which can
@@ -41,9 +113,15 @@ class readReceiverBase(readdata.Dexcom):
         readdata.Dexcom.__init__(self, portname, port, dbg)
         #print ('readReceiverBase() __init__ running. _port =', self._port, ', _port_name =', self._port_name, ', port =', port)
 
+    # Each command/response exchange with the receiver holds the lock for
+    # its port. Nothing else, such as SQL work, should be done under it.
+    def Transaction(self):
+        return PortLock.ForPort(self._port_name)
+
     def GetSerialNumber(self):
         #print ('readReceiverBase() GetSerialNumber running')
-        self._lock.acquire()
+        portLock = self.Transaction()
+        portLock.acquire()
         try:
             #print ('readReceiverBase.GetSerialNumber() : self._port_name =', self._port_name)
             if not self._port_name:
@@ -53,26 +131,30 @@ class readReceiverBase(readdata.Dexcom):
             sernum = None
             if self._port_name:
                 sernum = self.ReadManufacturingData().get('SerialNumber')
-            self._lock.release()
+            portLock.release()
             return sernum
 
         except Exception as e:
             #print ('GetSerialNumber() : Exception =', e)
             self.Disconnect()
             self._port_name = None
-            self._lock.release()
+            portLock.release()
             if sys.version_info < (3, 0):
                 sys.exc_clear()
             return None
 
     def GetCurrentGlucoseAndTrend(self):
         db_read_status = 0
-        self._lock.acquire()
-        if not self._port_name:
-            dport = self.FindDevice()
-            self._port_name = dport
+        portLock = self.Transaction()
+        respList = []
+        # Finding the device is done under the lock too, and any failure
+        # must still release it
+        portLock.acquire(priority=True)
         try:
-            respList = self.ReadRecords('EGV_DATA')
+            if not self._port_name:
+                dport = self.FindDevice()
+                self._port_name = dport
+            respList = self.ReadLastRecords('EGV_DATA')
         except serial.SerialException as e:
             db_read_status = 2
             if self._debug_mode:
@@ -94,23 +176,68 @@ class readReceiverBase(readdata.Dexcom):
                 #print_exc()
             if sys.version_info < (3, 0):
                 sys.exc_clear()
+        finally:
+            portLock.release()
 
         if respList:
             currentEgv = respList[-1]
-            self._lock.release()
             return (currentEgv.glucose, currentEgv.full_trend, db_read_status)
         else:
-            self._lock.release()
             return (None, None, db_read_status)
 
+    def GetRecentEgvTimes(self, count=1):
+        # Returns (sysSeconds of the newest 'count' EGV records, oldest first,
+        #          the receiver's current system time in sysSeconds,
+        #          status)
+        # This costs just a few small transactions, so it can be used to decide
+        # whether a full download is worthwhile.
+        db_read_status = 0
+        egvTimes = []
+        receiverNow = None
+        portLock = self.Transaction()
+        portLock.acquire(priority=True)
+        try:
+            if not self._port_name:
+                dport = self.FindDevice()
+                self._port_name = dport
+            egvTimes = [egv.system_secs for egv in self.ReadLastRecords('EGV_DATA', count)]
+            sysTime = self.ReadSystemTime()
+            if sysTime is None:
+                db_read_status = 2
+            else:
+                receiverNow = (sysTime - constants.BASE_TIME).total_seconds()
+        except serial.SerialException as e:
+            db_read_status = 2
+            if self._debug_mode:
+                print ('GetRecentEgvTimes() : SerialException =', e)
+            if sys.version_info < (3, 0):
+                sys.exc_clear()
+        except ValueError as e:
+            db_read_status = 3
+            if self._debug_mode:
+                print ('GetRecentEgvTimes() : ValueError Exception =', e)
+            if sys.version_info < (3, 0):
+                sys.exc_clear()
+        except Exception as e:
+            db_read_status = 4
+            if self._debug_mode:
+                print ('GetRecentEgvTimes() : Exception =', e)
+            if sys.version_info < (3, 0):
+                sys.exc_clear()
+        finally:
+            portLock.release()
+        return (egvTimes, receiverNow, db_read_status)
+
     def GetCurrentUserSettings(self):
         db_read_status = 0
-        self._lock.acquire()
-        if not self._port_name:
-            dport = self.FindDevice()
-            self._port_name = dport
+        portLock = self.Transaction()
+        respList = []
+        portLock.acquire(priority=True)
         try:
-            respList = self.ReadRecords('USER_SETTING_DATA')
+            if not self._port_name:
+                dport = self.FindDevice()
+                self._port_name = dport
+            respList = self.ReadLastRecords('USER_SETTING_DATA')
         except serial.SerialException as e:
             db_read_status = 2
             if self._debug_mode:
@@ -132,19 +259,20 @@ class readReceiverBase(readdata.Dexcom):
                 #print_exc()
             if sys.version_info < (3, 0):
                 sys.exc_clear()
+        finally:
+            portLock.release()
 
         if respList:
             # The current User Settings are held in the last list element
             currentUserSettings = respList[-1]
-            self._lock.release()
             return (currentUserSettings.transmitterPaired, currentUserSettings.highAlert, currentUserSettings.lowAlert, currentUserSettings.riseRate, currentUserSettings.fallRate, currentUserSettings.outOfRangeAlert, db_read_status)
         else:
-            self._lock.release()
             return (None, None, None, None, None, None, db_read_status)
 
     def GetPowerInfo(self):
         #print ('readReceiverBase() GetPowerInfo running')
-        self._lock.acquire()
+        portLock = self.Transaction()
+        portLock.acquire()
         try:
             #print ('readReceiverBase.GetPowerInfo() : self._port_name =', self._port_name)
             if not self._port_name:
@@ -158,7 +286,7 @@ class readReceiverBase(readdata.Dexcom):
                 if powerState is not None:
                     powerLevel = self.ReadBatteryLevel()
 
-            self._lock.release()
+            portLock.release()
             return (powerState, powerLevel)
 
         except Exception as e:
@@ -166,7 +294,7 @@ class readReceiverBase(readdata.Dexcom):
                 print ('GetPowerInfo() : Exception =', e)
             self.Disconnect()
             self._port_name = None
-            self._lock.release()
+            portLock.release()
             if sys.version_info < (3, 0):
                 sys.exc_clear()
             return (None, 0)
@@ -174,83 +302,22 @@ class readReceiverBase(readdata.Dexcom):
 
     def DownloadToDb(self, dbPath):
         db_read_status = 0  # 0 = success, non-zero = failure
-        self._lock.acquire()
+        # Each page read takes the port lock for itself, so other requests
+        # can be served between them. The SQL work is done without the lock.
         if self._port_name is not None:
             #now = datetime.datetime.now()
             #print ('readReceiver.py : DownloadToDb() : Reading device at', str(now))
-            conn = sqlite3.connect(dbPath)
             try:
-                curs = conn.cursor()
-
-                # Earlier releases had a UserSettings table, but it sucked up a huge amount of storage space,
-                # and didn't provide anything useful. So, if that table exists, we'll drop it and run
-                # vacuum to free up 97% of the disk space.
-                usCheckReq = "SELECT count(*) from sqlite_master where type='table' and name='UserSettings'"
-                curs.execute(usCheckReq)
-                sqlData = curs.fetchone()
-                if sqlData[0] > 0:
-                    print ('Deleting UserSettings table from database')
-                    curs.execute('DROP TABLE IF EXISTS UserSettings;')
-                    curs.execute('VACUUM;')
-
-                curs.execute('CREATE TABLE IF NOT EXISTS EgvRecord( sysSeconds INT PRIMARY KEY, dispSeconds INT, full_glucose INT, glucose INT, testNum INT, trend INT);')
-                insert_egv_sql = '''INSERT OR IGNORE INTO EgvRecord( sysSeconds, dispSeconds, full_glucose, glucose, testNum, trend) VALUES (?, ?, ?, ?, ?, ?);'''
-
-                respList = self.ReadRecords('EGV_DATA')
-                #printJustOne = True
-                for cgm_rec in respList:
-                    #if printJustOne:
-                        #print ('EGV_DATA : raw_data =', ' '.join(' %02x' % ord(c) for c in cgm_rec.raw_data))
-                        #printJustOne = False
-                    curs.execute(insert_egv_sql, (cgm_rec.system_secs, cgm_rec.display_secs, cgm_rec.full_glucose, cgm_rec.glucose, cgm_rec.testNum, cgm_rec.full_trend))
-
-                curs.execute('CREATE TABLE IF NOT EXISTS UserEvent( sysSeconds INT PRIMARY KEY, dispSeconds INT, meterSeconds INT, type INT, subtype INT, value INT, xoffset REAL, yoffset REAL);')
-                insert_evt_sql = '''INSERT OR IGNORE INTO UserEvent( sysSeconds, dispSeconds, meterSeconds, type, subtype, value, xoffset, yoffset) VALUES (?, ?, ?, ?, ?, ?, ?, ?);'''
-
-                respList = self.ReadRecords('USER_EVENT_DATA')
-                for evt_rec in respList:
-                    #print ('raw_data =',' '.join(' %02x' % ord(c) for c in evt_rec.raw_data))
-                    #print ('UserEvent(', evt_rec.system_secs, ',', evt_rec.display_secs, ', ', evt_rec.meter_secs, ', ', evt_rec.event_type, ', ', evt_rec.event_sub_type, ',', evt_rec.event_value)
-                    curs.execute(insert_evt_sql, (evt_rec.system_secs, evt_rec.display_secs, evt_rec.meter_secs, evt_rec.int_type, evt_rec.int_sub_type, evt_rec.int_value, 0.0, 0.0))
-
-                curs.execute('CREATE TABLE IF NOT EXISTS Config( id INT PRIMARY KEY CHECK (id = 0), displayLow REAL, displayHigh REAL, legendX REAL, legendY REAL, glUnits STR, scale REAL, timeOffset INTEGER);')
-                insert_cfg_sql = '''INSERT OR IGNORE INTO Config( id, displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset) VALUES (0, ?, ?, ?, ?, ?, ?, ?);'''
-                # If no instance exists, set default values. Otherwise, do nothing.
-                curs.execute(insert_cfg_sql, (75.0, 200.0, 0.01, 0.99, 'mg/dL', 100.0*(24-4)/(14*24-4), 0))
-
-                respList = self.ReadGlucoseUnit()
-                #print ('self.ReadGlucoseUnit() =', respList)
-                if respList is not None:
-                    update_cfg_sql = '''UPDATE Config SET glUnits = ? WHERE id = ?;'''
-                    curs.execute(update_cfg_sql, ('%s'%respList, 0))
-
-                curs.execute('CREATE TABLE IF NOT EXISTS SensorInsert( sysSeconds INT PRIMARY KEY, dispSeconds INT, insertSeconds INT, state INT, number INT, transmitter STR);')
-                insert_ins_sql = '''INSERT OR IGNORE INTO SensorInsert( sysSeconds, dispSeconds, insertSeconds, state, number, transmitter) VALUES (?, ?, ?, ?, ?, ?);'''
-
-                respList = self.ReadRecords('INSERTION_TIME')
-                for ins_rec in respList:
-                    if (self.rr_version == 'g5') or (self.rr_version == 'g6'):
-                        curs.execute(insert_ins_sql, (ins_rec.system_secs, ins_rec.display_secs, ins_rec.insertion_secs, ins_rec.state_value, ins_rec.number, ins_rec.transmitterPaired))
-                    else:
-                        curs.execute(insert_ins_sql, (ins_rec.system_secs, ins_rec.display_secs, ins_rec.insertion_secs, ins_rec.state_value, 0, ''))
-
-                curs.execute('CREATE TABLE IF NOT EXISTS Calib( sysSeconds INT PRIMARY KEY, dispSeconds INT, meterSeconds INT, type INT, glucose INT, testNum INT, xx INT);')
-                insert_cal_sql = '''INSERT OR IGNORE INTO Calib( sysSeconds, dispSeconds, meterSeconds, type, glucose, testNum, xx) VALUES (?, ?, ?, ?, ?, ?, ?);'''
-
-                respList = self.ReadRecords('METER_DATA')
-                for cal_rec in respList:
-                    #print ('raw_data =',' '.join(' %02x' % ord(c) for c in cal_rec.raw_data))
-                    #print ('Calib(', cal_rec.system_secs, ',', cal_rec.display_secs, ', ', cal_rec.meter_secs, ', ', cal_rec.record_type, ', ', cal_rec.calib_gluc, ',', cal_rec.testNum)
-                    curs.execute(insert_cal_sql, (cal_rec.system_secs, cal_rec.display_secs, cal_rec.meter_secs, cal_rec.record_type, cal_rec.calib_gluc, cal_rec.testNum, cal_rec.xx))
-
-                del respList
-                curs.close()
-                conn.commit()
+                records = {}
+                for record_type in DOWNLOAD_RECORD_TYPES:
+                    records[record_type] = self.ReadRecords(record_type)
+                glUnits = self.ReadGlucoseUnit()
+                # Each committed batch is published as soon as it's stored
+                WriteRecordsToDb(dbPath, records, glUnits, self.rr_version, self.changeFeed)
+                del records
             except sqlite3.Error as e:
                 print ('DownloadToDb() : Rolling back SQL changes due to exception =', e)
                 db_read_status = 1
-                curs.close()
-                conn.rollback()
                 if sys.version_info < (3, 0):
                     sys.exc_clear()
             except serial.SerialException as e:
@@ -274,10 +341,141 @@ class readReceiverBase(readdata.Dexcom):
                     #print_exc()
                 if sys.version_info < (3, 0):
                     sys.exc_clear()
-            conn.close()
-        self._lock.release()
         return db_read_status
 
+#-------------------------------------------------------------------------
+# The record types which DownloadToDb() copies into the database
+DOWNLOAD_RECORD_TYPES = ('EGV_DATA', 'USER_EVENT_DATA', 'INSERTION_TIME', 'METER_DATA')
+# The most glucose readings stored by one transaction. A full receiver holds
+# about 26,000, which would otherwise hold the write lock for a long time.
+WRITE_BATCH_SIZE = 2000
+
+def WriteRecordsToDb(dbPath, records, glUnits, rr_version, changeFeed=None):
+    """Store records read from a receiver in an SQL database.
+
+    Changes are committed in short transactions, of at most WRITE_BATCH_SIZE
+    glucose readings, or one table of other records. So, even during the
+    first download from a receiver, the display sees new readings early, and
+    other writers, such as saving a note, only wait briefly. Records already
+    in the database are ignored, so if an SQL operation fails, its
+    transaction is rolled back, and the next download fills in whatever is
+    missing.
+
+    Args:
+        dbPath: the SQL database file
+        records: a dictionary, mapping each of DOWNLOAD_RECORD_TYPES to
+                 a list of records read from the receiver
+        glUnits: the receiver's glucose unit ('mg/dL' or 'mmol/L'), or None
+        rr_version: 'g4', 'g5' or 'g6'
+        changeFeed: if given, each transaction's newly inserted rows are
+                    published here, as soon as they're committed
+
+    Returns:
+        A list of changefeed.ChangeBatch, holding the newly inserted rows
+
+    Raises:
+        sqlite3.Error
+    """
+    allBatches = []
+    inserted = {}
+    def insertRow(curs, table, sql, row):
+        curs.execute(sql, row)
+        if curs.rowcount == 1:
+            inserted.setdefault(table, []).append(row)
+
+    def commit(conn):
+        conn.commit()
+        if inserted:
+            changefeed.NoteChange(dbPath)
+        batches = [changefeed.ChangeBatch(dbPath, table, rows, newestSeconds.get(table))
+                   for (table, rows) in inserted.items()]
+        inserted.clear()
+        allBatches.extend(batches)
+        if changeFeed is not None:
+            changeFeed.publish(batches)
+
+    # Large downloads are published over several batches, so subscribers
+    # are told the newest record of the whole download, to tell fresh
+    # records from history
+    newestSeconds = {}
+    for (recordType, table) in (('EGV_DATA', 'EgvRecord'), ('USER_EVENT_DATA', 'UserEvent'),
+                                ('INSERTION_TIME', 'SensorInsert'), ('METER_DATA', 'Calib')):
+        if records.get(recordType):
+            newestSeconds[table] = max(rec.system_secs for rec in records[recordType])
+
+    # The tables are created, or brought up to date, when the database
+    # is first opened, rather than being checked on every download.
+    dbschema.MigrateOnce(dbPath)
+    conn = sqlite3.connect(dbPath)
+    try:
+        curs = conn.cursor()
+
+        insert_egv_sql = '''INSERT OR IGNORE INTO EgvRecord( sysSeconds, dispSeconds, full_glucose, glucose, testNum, trend) VALUES (?, ?, ?, ?, ?, ?);'''
+
+        egvRecords = records['EGV_DATA']
+        for first in range(0, len(egvRecords), WRITE_BATCH_SIZE):
+            #printJustOne = True
+            for cgm_rec in egvRecords[first:first + WRITE_BATCH_SIZE]:
+                #if printJustOne:
+                    #print ('EGV_DATA : raw_data =', ' '.join(' %02x' % ord(c) for c in cgm_rec.raw_data))
+                    #printJustOne = False
+                insertRow(curs, 'EgvRecord', insert_egv_sql, (cgm_rec.system_secs, cgm_rec.display_secs, cgm_rec.full_glucose, cgm_rec.glucose, cgm_rec.testNum, cgm_rec.full_trend))
+
+            # Bring the daily summaries up to date for the days we've added to,
+            # in the same transaction, so readers never see them disagree.
+            newRows = inserted.get('EgvRecord', [])
+            newSeconds = [row[0] for row in newRows]
+            dailysummary.UpdateForReadings(curs, newSeconds)
+            sensorsession.UpdateForReadings(curs, [(row[0], row[3]) for row in newRows])
+            signalgaps.UpdateForReadings(curs, newSeconds)
+            commit(conn)
+
+        insert_evt_sql = '''INSERT OR IGNORE INTO UserEvent( sysSeconds, dispSeconds, meterSeconds, type, subtype, value, xoffset, yoffset) VALUES (?, ?, ?, ?, ?, ?, ?, ?);'''
+
+        for evt_rec in records['USER_EVENT_DATA']:
+            #print ('raw_data =',' '.join(' %02x' % ord(c) for c in evt_rec.raw_data))
+            #print ('UserEvent(', evt_rec.system_secs, ',', evt_rec.display_secs, ', ', evt_rec.meter_secs, ', ', evt_rec.event_type, ', ', evt_rec.event_sub_type, ',', evt_rec.event_value)
+            insertRow(curs, 'UserEvent', insert_evt_sql, (evt_rec.system_secs, evt_rec.display_secs, evt_rec.meter_secs, evt_rec.int_type, evt_rec.int_sub_type, evt_rec.int_value, 0.0, 0.0))
+        commit(conn)
+
+        insert_cfg_sql = '''INSERT OR IGNORE INTO Config( id, displayLow, displayHigh, legendX, legendY, glUnits, scale, timeOffset) VALUES (0, ?, ?, ?, ?, ?, ?, ?);'''
+        # If no instance exists, set default values. Otherwise, do nothing.
+        curs.execute(insert_cfg_sql, (75.0, 200.0, 0.01, 0.99, 'mg/dL', 100.0*(24-4)/(14*24-4), 0))
+
+        #print ('glUnits =', glUnits)
+        if glUnits is not None:
+            update_cfg_sql = '''UPDATE Config SET glUnits = ? WHERE id = ?;'''
+            curs.execute(update_cfg_sql, ('%s'%glUnits, 0))
+        commit(conn)
+
+        insert_ins_sql = '''INSERT OR IGNORE INTO SensorInsert( sysSeconds, dispSeconds, insertSeconds, state, number, transmitter) VALUES (?, ?, ?, ?, ?, ?);'''
+
+        for ins_rec in records['INSERTION_TIME']:
+            if (rr_version == 'g5') or (rr_version == 'g6'):
+                insertRow(curs, 'SensorInsert', insert_ins_sql, (ins_rec.system_secs, ins_rec.display_secs, ins_rec.insertion_secs, ins_rec.state_value, ins_rec.number, ins_rec.transmitterPaired))
+            else:
+                insertRow(curs, 'SensorInsert', insert_ins_sql, (ins_rec.system_secs, ins_rec.display_secs, ins_rec.insertion_secs, ins_rec.state_value, 0, ''))
+        # New sensor starts or stops change the sessions, and their reading
+        # counts, from the earliest of them onward
+        sensorsession.UpdateForInserts(curs, [row[0] for row in inserted.get('SensorInsert', [])])
+        commit(conn)
+
+        insert_cal_sql = '''INSERT OR IGNORE INTO Calib( sysSeconds, dispSeconds, meterSeconds, type, glucose, testNum, xx) VALUES (?, ?, ?, ?, ?, ?, ?);'''
+
+        for cal_rec in records['METER_DATA']:
+            #print ('raw_data =',' '.join(' %02x' % ord(c) for c in cal_rec.raw_data))
+            #print ('Calib(', cal_rec.system_secs, ',', cal_rec.display_secs, ', ', cal_rec.meter_secs, ', ', cal_rec.record_type, ', ', cal_rec.calib_gluc, ',', cal_rec.testNum)
+            insertRow(curs, 'Calib', insert_cal_sql, (cal_rec.system_secs, cal_rec.display_secs, cal_rec.meter_secs, cal_rec.record_type, cal_rec.calib_gluc, cal_rec.testNum, cal_rec.xx))
+        commit(conn)
+
+        curs.close()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return allBatches
+
 #-------------------------------------------------------------------------
 class readReceiver(readReceiverBase):
     # The G4 version of this class uses the default PARSER_MAP
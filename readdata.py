@@ -37,6 +37,15 @@
 #   - Added ReadAllManufacturingData()
 #   - Added USER_SETTING_DATA for G5 & G6.
 #   - Added import of print_function
+#   - Replaced the fixed 4.3 second serial timeout with per-command
+#     timeouts sized to the expected response, and the 18 second
+#     Connect() retry sleep with exponential backoff plus jitter.
+#   - Cache the firmware header and manufacturing data for each port.
+#   - Split DeviceTypeFromFirmware() and DecodePage() out, so the
+#     asyncio client in asyncreceiver.py can share them.
+#   - Each command/response exchange runs inside Transaction(), which
+#     subclasses may use to lock the port.
+#   - Added ReadLastRecords()
 #
 #########################################################################
 
@@ -44,9 +53,12 @@
 from __future__ import print_function
 
 import datetime
+import errno
+import random
 import sys
 import time
 import struct
+import threading
 import xml.etree.ElementTree as ET
 from traceback import print_exc
 import serial
@@ -66,6 +78,77 @@ if sys.platform == "linux" or sys.platform == "linux2" or sys.platform == "darwi
 if sys.version_info.major > 2:
     xrange = range
 
+BAUD_RATE = 115200
+# At 8N1 framing, each byte costs 10 bits on the wire
+BYTES_PER_SECOND = BAUD_RATE / 10.0
+# Time allowed for the receiver to start answering any command
+RESPONSE_LATENCY = 1.0
+# Expected response sizes, in bytes, for commands which return more than a
+# small packet. Unlisted commands are assumed to fit in SMALL_RESPONSE_SIZE.
+SMALL_RESPONSE_SIZE = 64
+RESPONSE_SIZES = {
+    constants.READ_FIRMWARE_HEADER: 512,
+    constants.READ_FIRMWARE_SETTINGS: 512,
+    constants.READ_DATABASE_PARTITION_INFO: 1590,
+    constants.READ_DATABASE_PAGES: 1590,
+}
+
+# Connect() retries with exponential backoff, starting at CONNECT_BASE_DELAY
+# seconds and doubling up to CONNECT_MAX_DELAY, for at most CONNECT_ATTEMPTS.
+CONNECT_ATTEMPTS = 6
+CONNECT_BASE_DELAY = 0.25
+CONNECT_MAX_DELAY = 4.0
+
+# A receiver's identity (firmware header, manufacturing data) can't change
+# while it stays connected, so these are cached for each port name, rather
+# than re-read over serial on every poll. The entry for a port is dropped
+# on Disconnect(), or after a serial error on that port.
+_identityCache = {}
+_identityLock = threading.Lock()
+
+
+def CommandTimeout(command_id):
+    """Find how long to wait for the response to a command.
+
+    Args:
+        command_id: the command being sent, or None for the default
+
+    Returns:
+        The read timeout in seconds. This allows the receiver's latency plus
+        twice the time it takes to transfer the expected response.
+    """
+    size = RESPONSE_SIZES.get(command_id, SMALL_RESPONSE_SIZE)
+    return RESPONSE_LATENCY + 2.0 * size / BYTES_PER_SECOND
+
+
+class NoLock(object):
+  # The default Transaction() context, which does no locking
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    return False
+
+
+def DeviceTypeFromFirmware(fw_ver):
+    """Map a FirmwareVersion string onto a device type.
+
+    Returns:
+        'g4', 'g5' or 'g6', or the firmware version itself if unrecognized
+    """
+    if fw_ver.startswith("2."):   # G4 firmware versions
+        return 'g4'
+    elif fw_ver.startswith("3."):
+        return 'g4'
+    elif fw_ver.startswith("4."):
+        return 'g4'
+    elif fw_ver.startswith("5.0."): # 5.0.1.043 = G5 Receiver Firmware
+        return 'g5'
+    elif fw_ver.startswith("5."):   # 5.1.1.022 = G6 Receiver Firmware
+        return 'g6'
+    else: # unrecognized firmware version
+        return fw_ver
+
 
 class ReadPacket(object):
 
@@ -98,7 +181,7 @@ class Dexcom(object):
 
   def GetDeviceType(self):
     try:
-        device = self.FindDevice()
+        device = self._port_name or self.FindDevice()
         if not device:
           sys.stderr.write('Could not find Dexcom Receiver!\n')
           return None
@@ -107,19 +190,7 @@ class Dexcom(object):
           #print ('GetFirmwareHeader =', fwh)
           if fwh is None:
               return None
-          fw_ver = fwh.get('FirmwareVersion')
-          if fw_ver.startswith("2."):   # G4 firmware versions
-              return 'g4'
-          elif fw_ver.startswith("3."):
-              return 'g4'
-          elif fw_ver.startswith("4."):
-              return 'g4'
-          elif fw_ver.startswith("5.0."): # 5.0.1.043 = G5 Receiver Firmware
-              return 'g5'
-          elif fw_ver.startswith("5."):   # 5.1.1.022 = G6 Receiver Firmware
-              return 'g6'
-          else: # unrecognized firmware version
-              return fw_ver
+          return DeviceTypeFromFirmware(fwh.get('FirmwareVersion'))
     except Exception as e:
         print ('GetDeviceType() : Exception =', e)
         print_exc()
@@ -253,36 +324,45 @@ class Dexcom(object):
     self._debug_mode = dbg
 
   def Connect(self):
-    try:
-        if self._port is None:
-            self._port = serial.Serial(port=self._port_name, baudrate=115200, timeout=4.3)
-    except serial.SerialException as e:
-        if sys.version_info < (3, 0):
-            sys.exc_clear()
+    delay = CONNECT_BASE_DELAY
+    denied = False
+    for attempt in xrange(CONNECT_ATTEMPTS):
+        if self._port is not None:
+            break
         try:
-            if self._port is None:
-                #print ('First attempt failed')
-                if sys.platform == "linux" or sys.platform == "linux2" or sys.platform == "darwin":
-                    # Trying to access the port file may help make it visible.
-                    # For example, on Linux, running 'ls <self._port_name>' helps make
-                    # a subsequent serial port access work.
-                    try:
-                        stat_info = os.stat(self._port_name)
-                    except OSError as e:
-                        if self._debug_mode:
-                            print ('Connect() - os.stat() : Exception =', e)
-                            print_exc()
-                        if sys.version_info < (3, 0):
-                            sys.exc_clear()
-                time.sleep(18)
-                self._port = serial.Serial(port=self._port_name, baudrate=115200, timeout=4.3)
-
+            self._port = serial.Serial(port=self._port_name, baudrate=BAUD_RATE,
+                                       timeout=CommandTimeout(None))
+            break
         except serial.SerialException as e:
             if sys.version_info < (3, 0):
                 sys.exc_clear()
             if self._debug_mode:
-                print ('Connect() : Exception =', e)
+                print ('Connect() attempt', attempt + 1, ': Exception =', e)
+            # Retrying won't help if we lack permission to open the port
+            if getattr(e, 'errno', None) in (errno.EACCES, errno.EPERM):
+                denied = True
+                break
             if sys.platform == "linux" or sys.platform == "linux2" or sys.platform == "darwin":
+                # Trying to access the port file may help make it visible.
+                # For example, on Linux, running 'ls <self._port_name>' helps make
+                # a subsequent serial port access work. If the file is gone, the
+                # device has been unplugged, so fail fast rather than retrying.
+                try:
+                    stat_info = os.stat(self._port_name)
+                except OSError as e:
+                    if self._debug_mode:
+                        print ('Connect() - os.stat() : Exception =', e)
+                    if sys.version_info < (3, 0):
+                        sys.exc_clear()
+                    break
+            if attempt + 1 < CONNECT_ATTEMPTS:
+                # Add jitter, so that several waiting clients don't retry in lock step
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, CONNECT_MAX_DELAY)
+
+    if self._port is None and denied:
+        if sys.platform == "linux" or sys.platform == "linux2" or sys.platform == "darwin":
+            try:
                 stat_info = os.stat(self._port_name)
                 port_gid = stat_info.st_gid
                 port_group = grp.getgrgid(port_gid)[0]
@@ -304,6 +384,9 @@ class Dexcom(object):
                         print ('\n   su -', username)
                     print ('\nFor a short term solution, run ...')
                     print ('\n   sudo chmod 666', self._port_name, '\n')
+            except (OSError, KeyError) as e:
+                if sys.version_info < (3, 0):
+                    sys.exc_clear()
     if self._port is not None:
         try:
             self.clear()
@@ -350,6 +433,21 @@ class Dexcom(object):
               sys.exc_clear()
       self._port.close()
     self._port = None
+    self.InvalidateIdentity()
+
+  def CachedIdentity(self, key, reader):
+    with _identityLock:
+        value = _identityCache.get(self._port_name, {}).get(key)
+    if value is None:
+        value = reader()
+        if (value is not None) and self._port_name:
+            with _identityLock:
+                _identityCache.setdefault(self._port_name, {})[key] = value
+    return value
+
+  def InvalidateIdentity(self):
+    with _identityLock:
+        _identityCache.pop(self._port_name, None)
 
   @property
   def port(self):
@@ -399,9 +497,10 @@ class Dexcom(object):
     return None
 
   def Ping(self):
-    self.WriteCommand(constants.PING)
     try:
-        packet = self.readpacket()
+        with self.Transaction():
+            self.WriteCommand(constants.PING)
+            packet = self.readpacket()
     except Exception as e:
         if self._debug_mode:
             print ('Ping() Exception =', e)
@@ -423,6 +522,16 @@ class Dexcom(object):
     self.flush()
     self.write(packet)
 
+  def Transaction(self):
+    # Returns a context manager held around each command and its response
+    return NoLock()
+
+  def SetTimeout(self, timeout):
+    # Reconfiguring the port costs a system call, so only do it on a change
+    port = self.port
+    if port is not None and port.timeout != timeout:
+        port.timeout = timeout
+
   def WriteCommand(self, command_id, *args, **kwargs):
     #if command_id in constants.COMMAND_STRINGS:
         #print ('WriteCommand(', constants.COMMAND_STRINGS[command_id], ') : args =', args, ', kwargs =', kwargs)
@@ -430,12 +539,14 @@ class Dexcom(object):
         #print ('WriteCommand(', command_id, ') : args =', args, ', kwargs =', kwargs)
     p = packetwriter.PacketWriter()
     p.ComposePacket(command_id, *args, **kwargs)
+    self.SetTimeout(CommandTimeout(command_id))
     self.WritePacket(p.PacketBytes())
 
   def GenericReadCommand(self, command_id):
     try:
-        self.WriteCommand(command_id)
-        return self.readpacket()
+        with self.Transaction():
+            self.WriteCommand(command_id)
+            return self.readpacket()
     except (serial.SerialTimeoutException, serial.SerialException) as e:
         if self._debug_mode:
             if command_id in constants.COMMAND_STRINGS:
@@ -445,6 +556,7 @@ class Dexcom(object):
             #print_exc()
         if sys.version_info < (3, 0):
             sys.exc_clear()
+        self.InvalidateIdentity()
         return None
     except Exception as e:
         if self._debug_mode:
@@ -514,9 +626,10 @@ class Dexcom(object):
 
   def WriteDisplayTimeOffset(self, offset=None):
     payload = struct.pack('i', offset)
-    self.WriteCommand(constants.WRITE_DISPLAY_TIME_OFFSET, payload)
     try:
-        packet = self.readpacket()
+        with self.Transaction():
+            self.WriteCommand(constants.WRITE_DISPLAY_TIME_OFFSET, payload)
+            packet = self.readpacket()
     except Exception as e:
         if self._debug_mode:
             print ('WriteDisplayTimeOffset() Exception =', e)
@@ -589,9 +702,10 @@ class Dexcom(object):
   def WriteChargerCurrentSetting (self, status):
     MAP = ( 'Off', 'Power100mA', 'Power500mA', 'PowerMax', 'PowerSuspended' )
     payload = str(bytearray([MAP.index(status)]))
-    self.WriteCommand(constants.WRITE_CHARGER_CURRENT_SETTING, payload)
     try:
-        packet = self.readpacket()
+        with self.Transaction():
+            self.WriteCommand(constants.WRITE_CHARGER_CURRENT_SETTING, payload)
+            packet = self.readpacket()
     except Exception as e:
         if self._debug_mode:
             print ('WriteChargerCurrentSetting() Exception =', e)
@@ -615,6 +729,9 @@ class Dexcom(object):
 
   # ManufacturingParameters: SerialNumber, HardwarePartNumber, HardwareRevision, DateTimeCreated, HardwareId
   def ReadManufacturingData(self):
+    return self.CachedIdentity('ManufacturingData', self._ReadManufacturingData)
+
+  def _ReadManufacturingData(self):
     md = self.ReadRecords('MANUFACTURING_DATA')
     if md:
         #print ('ReadManufacturingData() : MANUFACTURING_DATA =', md[0].xmldata)
@@ -637,6 +754,9 @@ class Dexcom(object):
         self.port.flushOutput()
 
   def GetFirmwareHeader(self):
+    return self.CachedIdentity('FirmwareHeader', self._ReadFirmwareHeader)
+
+  def _ReadFirmwareHeader(self):
     i = self.GenericReadCommand(constants.READ_FIRMWARE_HEADER)
     if i is None:
         return None
@@ -657,20 +777,26 @@ class Dexcom(object):
 
   def ReadDatabasePageRange(self, record_type):
     record_type_index = constants.RECORD_TYPES.index(record_type)
-    self.WriteCommand(constants.READ_DATABASE_PAGE_RANGE,
-                      chr(record_type_index))
-    packet = self.readpacket()
+    with self.Transaction():
+        self.WriteCommand(constants.READ_DATABASE_PAGE_RANGE,
+                          chr(record_type_index))
+        packet = self.readpacket()
     if packet is None:
         return []
     return struct.unpack('II', packet.data)
 
   def ReadDatabasePage(self, record_type, page):
     record_type_index = constants.RECORD_TYPES.index(record_type)
-    self.WriteCommand(constants.READ_DATABASE_PAGES,
-                      (chr(record_type_index), struct.pack('I', page), chr(1)))
-    packet = self.readpacket()
+    with self.Transaction():
+        self.WriteCommand(constants.READ_DATABASE_PAGES,
+                          (chr(record_type_index), struct.pack('I', page), chr(1)))
+        packet = self.readpacket()
     if packet is None:
         return []
+    return self.DecodePage(record_type, page, packet)
+
+  def DecodePage(self, record_type, page, packet):
+    record_type_index = constants.RECORD_TYPES.index(record_type)
     if sys.version_info.major > 2:
         assert packet.command == 1
     else:
@@ -704,7 +830,8 @@ class Dexcom(object):
   def ParsePage(self, header, data):
     record_type = constants.RECORD_TYPES[ord(header[2])]
     revision = int(header[3])
-    generic_parser_map = self.PARSER_MAP
+    # Work on a copy, so the revision overrides don't leak into PARSER_MAP
+    generic_parser_map = dict(self.PARSER_MAP)
     if revision > 4 and record_type == 'EGV_DATA':
       generic_parser_map.update(EGV_DATA=database_records.G6EGVRecord)
     if revision > 1 and record_type == 'INSERTION_TIME':
@@ -726,6 +853,8 @@ class Dexcom(object):
   def iter_records (self, record_type):
     assert record_type in constants.RECORD_TYPES
     page_range = self.ReadDatabasePageRange(record_type)
+    if page_range == []:
+      return
     start, end = page_range
     if start != end or not end:
       end += 1
@@ -753,6 +882,23 @@ class Dexcom(object):
           records.extend(page_range)
     return records
 
+  def ReadLastRecords(self, record_type, count=1):
+    """Read just the newest records of a given type. Pages are read from the
+    last one backwards, only until 'count' records have been found, so the
+    latest record takes a single page read.
+
+    Returns:
+        A list of at most 'count' records, oldest first
+    """
+    records = []
+    if count > 0:
+      for record in self.iter_records(record_type):
+        records.append(record)
+        if len(records) >= count:
+          break
+    records.reverse()
+    return records
+
 class DexcomG5 (Dexcom):
   PARSER_MAP = {
       'USER_EVENT_DATA': database_records.EventRecord,
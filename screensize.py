@@ -1,6 +1,15 @@
 # This file provides a function to retrieve the screen size, with
 # different implementations for different backends.
 #
+# Probing can be slow, and may flash a window on screen, so each result
+# is cached on disk, keyed by the display, the backend and a cheap
+# signature of the attached monitors. The probe is only repeated when
+# one of those changes.
+#
+# Non-interactive backends, like Agg, never touch a display. They use the
+# size given by set_screen_size(), or the DEXCTRACK_SCREEN_SIZE environment
+# variable (for example, DEXCTRACK_SCREEN_SIZE=1920x1080), or a default.
+#
 # License: Creative Commons CC-BY-SA
 #          https://creativecommons.org/licenses/by-sa/4.0/
 #
@@ -9,22 +18,133 @@
 # Support python3 print syntax in python2
 from __future__ import print_function
 
+import glob
+import json
 import os
 import sys
 import matplotlib.pyplot as plt
 
-def get_screen_size():
+# The size used when there's no display to measure
+DEFAULT_SIZE = (1280, 1024)
+# Backends which only render to files or memory
+NON_INTERACTIVE_BACKENDS = ('agg', 'cairo', 'pdf', 'pgf', 'ps', 'svg', 'template')
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.dexctrack_screensize.json')
+OVERRIDE_ENV = 'DEXCTRACK_SCREEN_SIZE'
+
+_override = None
+
+def set_screen_size(width, height):
+    """Use the given size, rather than measuring the screen. Pass None
+    to go back to measuring it."""
+    global _override
+    if width is None:
+        _override = None
+    else:
+        _override = (int(width), int(height))
+
+def _env_override():
+    try:
+        width_s, height_s = os.environ[OVERRIDE_ENV].lower().split('x')
+        return (int(width_s), int(height_s))
+    except KeyError:
+        if sys.version_info < (3, 0):
+            sys.exc_clear()
+    except ValueError:
+        print ('Ignoring %s=%s. The format is <width>x<height>' % (OVERRIDE_ENV, os.environ[OVERRIDE_ENV]))
+        if sys.version_info < (3, 0):
+            sys.exc_clear()
+    return None
+
+def _monitor_signature():
+    # Something which changes when monitors are attached, removed or
+    # have their resolution changed, but which is much cheaper to find
+    # than the screen size itself.
+    if sys.platform.startswith('linux'):
+        connectors = []
+        for statusPath in sorted(glob.glob('/sys/class/drm/card*-*/status')):
+            try:
+                folder = os.path.dirname(statusPath)
+                with open(statusPath) as f:
+                    status = f.read().strip()
+                mode = ''
+                if status == 'connected':
+                    with open(os.path.join(folder, 'modes')) as f:
+                        mode = f.readline().strip()
+                connectors.append('%s:%s:%s' % (os.path.basename(folder), status, mode))
+            except (IOError, OSError):
+                if sys.version_info < (3, 0):
+                    sys.exc_clear()
+        return ','.join(connectors)
+    if sys.platform == 'win32':
+        import ctypes
+        user32 = ctypes.windll.user32
+        # SM_CMONITORS, SM_CXVIRTUALSCREEN, SM_CYVIRTUALSCREEN
+        return '%d:%dx%d' % (user32.GetSystemMetrics(80), user32.GetSystemMetrics(78),
+                             user32.GetSystemMetrics(79))
+    return ''
+
+def _cache_key(backend):
+    display = os.environ.get('WAYLAND_DISPLAY') or os.environ.get('DISPLAY') or sys.platform
+    return '%s|%s|%s' % (display, backend, _monitor_signature())
+
+def _read_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            cache = json.load(f)
+        if isinstance(cache, dict):
+            return cache
+    except (IOError, OSError, ValueError):
+        if sys.version_info < (3, 0):
+            sys.exc_clear()
+    return {}
+
+def _write_cache(cache):
+    try:
+        with open(CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except (IOError, OSError) as e:
+        print ('Unable to save screen size to', CACHE_FILE, ':', e)
+        if sys.version_info < (3, 0):
+            sys.exc_clear()
+
+def clear_screen_size_cache():
+    try:
+        os.remove(CACHE_FILE)
+    except OSError:
+        if sys.version_info < (3, 0):
+            sys.exc_clear()
+
+def get_screen_size(useCache=True):
     """This function finds the width and height of the screen. This will be
     for a single monitor in a multi-monitor set-up.
 
     Args:
-        None
+        useCache: if False, measure the screen even if a size was cached
+                  for the current display, backend and monitors
 
     Returns:
         A list of numbers (width-in-pixels, height-in-pixels)
     """
+    override = _override or _env_override()
+    if override:
+        return override
+
     backend = plt.get_backend()
+    if backend.lower() in NON_INTERACTIVE_BACKENDS:
+        return DEFAULT_SIZE
+
+    key = _cache_key(backend)
+    cache = _read_cache()
+    if useCache and (key in cache):
+        width, height = cache[key]
+        return (width, height)
+
+    width, height = _probe_screen_size(backend)
+    cache[key] = (width, height)
+    _write_cache(cache)
+    return (width, height)
 
+def _probe_screen_size(backend):
     # Linux distributions using Wayland and a GTK or GTK3 backend
     # get us into trouble. For those backends, the code below grabs
     # the Active Window. This works well under X11, but Wayland refuses
@@ -152,10 +272,17 @@ def get_screen_size():
 
     else:
         print ('Solution not implemented yet for backend =', backend)
-        width, height = (1280, 1024)
+        width, height = DEFAULT_SIZE
 
     return (width, height)
 
 if __name__ == "__main__":
-    w, h = get_screen_size()
+    import time
+    startTime = time.time()
+    w, h = get_screen_size(useCache=False)
+    probeTime = time.time() - startTime
+    startTime = time.time()
+    get_screen_size()
+    cachedTime = time.time() - startTime
     print ('Backend = %s, Screen size = (%d, %d)' % (plt.get_backend(), w, h))
+    print ('Measured in %.4f seconds, read from cache in %.4f seconds' % (probeTime, cachedTime))
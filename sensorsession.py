@@ -0,0 +1,356 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file maintains the SensorSession table, which holds one row for each
+# sensor that was started : when it was inserted, when its warm-up ended,
+# when it stopped, the state it stopped in (REMOVED, EXPIRED, ...), its
+# transmitter, and counts of its readings, status codes and gaps.
+#
+# Sessions are found from the SensorInsert table. A STARTED row (state 7)
+# begins a session, at its insertSeconds, and the next row with any other
+# state, or the next start of a different sensor, ends it. The latest
+# session has no end until the sensor is stopped.
+#
+# The table is created by a dbschema migration, and then updated by
+# readReceiver.WriteRecordsToDb(), for just the sessions touched by each
+# download. SessionStats() then finds how one sensor performed, with time
+# in range from the DailySummary table, and the difference between each
+# calibration and the sensor's reading, all from indexed lookups.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import dailysummary
+import signalgaps
+
+# SensorInsert states, as in database_records.InsertionRecord.session_state
+STATE_NAMES = [None, 'REMOVED', 'EXPIRED', 'RESIDUAL_DEVIATION',
+               'COUNTS_DEVIATION', 'SECOND_SESSION', 'OFF_TIME_LOSS',
+               'STARTED', 'BAD_TRANSMITTER', 'MANUFACTURING_MODE']
+STATE_STARTED = 7
+# insertSeconds holds this when the receiver didn't know the insertion time
+UNKNOWN_INSERT_TIME = 0xFFFFFFFF
+# Readings aren't reliable until a new sensor has warmed up
+WARMUP_SECONDS = 60 * 60 * 2
+# Gaps are counted the same way as in the SignalGap table
+GAP_SECONDS = signalgaps.GAP_SECONDS
+# The most a calibration's time may differ from the reading it's compared with
+CALIB_MATCH_SECONDS = 300
+
+CREATE_TABLE_SQL = ('CREATE TABLE IF NOT EXISTS SensorSession( startSeconds INTEGER PRIMARY KEY, endSeconds INT,'
+                    ' endState INT, transmitter STR, warmupEndSeconds INT, readingCount INT, specialCount INT,'
+                    ' gapCount INT, firstSeconds INT, lastSeconds INT);')
+# Sessions which hadn't ended, when last updated, have a NULL endSeconds
+SESSION_COLUMNS = ('startSeconds', 'endSeconds', 'endState', 'transmitter', 'warmupEndSeconds',
+                   'readingCount', 'specialCount', 'gapCount', 'firstSeconds', 'lastSeconds')
+
+
+class Session(object):
+    """One row of the SensorSession table"""
+
+    def __init__(self, row):
+        (self.startSeconds, self.endSeconds, self.endState, self.transmitter, self.warmupEndSeconds,
+         self.readingCount, self.specialCount, self.gapCount, self.firstSeconds, self.lastSeconds) = row
+
+    def endStateName(self):
+        if self.endState is None:
+            return None
+        if self.endState < len(STATE_NAMES):
+            return STATE_NAMES[self.endState]
+        return 'UNKNOWN%d' % self.endState
+
+    def __repr__(self):
+        return 'Session(start %d, end %s (%s), transmitter %s, %d readings, %d status codes, %d gaps)' % (
+            self.startSeconds, self.endSeconds, self.endStateName(), self.transmitter,
+            self.readingCount, self.specialCount, self.gapCount)
+
+
+class SessionStatistics(object):
+    """How one sensor performed.
+
+    Attributes:
+        session: the Session
+        stats: a dailysummary.RangeStats of its readings after warm-up
+        inRangePercent, lowPercent, highPercent: percentages of those
+                readings within, below and above the range asked for
+        calibrations: a list of (sysSeconds, meterGlucose, sensorGlucose),
+                for each calibration with a reading within CALIB_MATCH_SECONDS
+        meanAbsDelta: mean of |sensor - meter|, in mg/dL, or None
+        mard: mean absolute relative difference, as a percentage, or None
+        quality: a signalgaps.SignalQuality, for the whole session
+    """
+
+    def __init__(self, session, stats, low, high, calibrations, quality):
+        self.session = session
+        self.stats = stats
+        self.calibrations = calibrations
+        self.quality = quality
+        if stats.count:
+            self.lowPercent = 100.0 * stats.countBelow(low) / stats.count
+            self.inRangePercent = 100.0 * stats.countBetween(low, high) / stats.count
+            self.highPercent = 100.0 * stats.countAbove(high) / stats.count
+        else:
+            self.lowPercent = self.inRangePercent = self.highPercent = 0.0
+        if calibrations:
+            deltas = [abs(sensor - meter) for (secs, meter, sensor) in calibrations]
+            self.meanAbsDelta = float(sum(deltas)) / len(deltas)
+            self.mard = 100.0 * sum(float(d) / meter for (d, (secs, meter, sensor)) in zip(deltas, calibrations)) / len(deltas)
+        else:
+            self.meanAbsDelta = None
+            self.mard = None
+
+
+def CreateTable(curs):
+    """Create the SensorSession table, if necessary.
+
+    Returns:
+        True if the table had to be created
+    """
+    curs.execute("SELECT count(*) from sqlite_master where type='table' and name='SensorSession'")
+    exists = curs.fetchone()[0] > 0
+    if not exists:
+        curs.execute(CREATE_TABLE_SQL)
+    return not exists
+
+
+def _findSessions(curs, fromSeconds):
+    # Returns (startSeconds, endSeconds, endState, transmitter) for each
+    # session which starts at or after fromSeconds, from SensorInsert
+    curs.execute('SELECT sysSeconds, insertSeconds, state, transmitter FROM SensorInsert'
+                 ' WHERE sysSeconds >= ? ORDER BY sysSeconds', (fromSeconds,))
+    sessions = []
+    current = None
+    for (sysSeconds, insertSeconds, state, transmitter) in curs.fetchall():
+        if state == STATE_STARTED:
+            if (insertSeconds is None) or (insertSeconds == UNKNOWN_INSERT_TIME):
+                insertSeconds = sysSeconds
+            if (current is not None) and (current[0] == insertSeconds):
+                # Another record of the same sensor start
+                continue
+            if current is not None:
+                # Started again, without a record of the old sensor stopping
+                current[1] = max(current[0] + 1, min(sysSeconds, insertSeconds))
+                sessions.append(current)
+            current = [insertSeconds, None, None, transmitter]
+        elif current is not None:
+            current[1] = sysSeconds
+            current[2] = state
+            sessions.append(current)
+            current = None
+    if current is not None:
+        sessions.append(current)
+    return sessions
+
+
+def _countReadings(curs, startSeconds, endSeconds):
+    # Returns (readingCount, specialCount, gapCount, firstSeconds, lastSeconds)
+    # for the EgvRecord rows from startSeconds up to endSeconds
+    if endSeconds is None:
+        curs.execute('SELECT sysSeconds, glucose FROM EgvRecord WHERE sysSeconds >= ? ORDER BY sysSeconds',
+                     (startSeconds,))
+    else:
+        curs.execute('SELECT sysSeconds, glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds < ? ORDER BY sysSeconds',
+                     (startSeconds, endSeconds))
+    readingCount = 0
+    specialCount = 0
+    gapCount = 0
+    firstSeconds = None
+    lastSeconds = None
+    for (sysSeconds, glucose) in curs.fetchall():
+        if glucose > 12:
+            readingCount += 1
+        else:
+            specialCount += 1
+        if firstSeconds is None:
+            firstSeconds = sysSeconds
+        elif sysSeconds - lastSeconds > GAP_SECONDS:
+            gapCount += 1
+        lastSeconds = sysSeconds
+    return (readingCount, specialCount, gapCount, firstSeconds, lastSeconds)
+
+
+def _writeSession(curs, startSeconds, endSeconds, endState, transmitter):
+    counts = _countReadings(curs, startSeconds, endSeconds)
+    curs.execute('INSERT OR REPLACE INTO SensorSession( startSeconds, endSeconds, endState, transmitter,'
+                 ' warmupEndSeconds, readingCount, specialCount, gapCount, firstSeconds, lastSeconds)'
+                 ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                 (startSeconds, endSeconds, endState, transmitter, startSeconds + WARMUP_SECONDS) + counts)
+
+
+def UpdateForInserts(curs, sysSecondsList):
+    """Rebuild the sessions from the one holding the earliest of the given
+    new SensorInsert rows onward"""
+    if not sysSecondsList:
+        return
+    earliest = min(sysSecondsList)
+    # Sessions are keyed by insertion time, which comes before the
+    # SensorInsert row that records it
+    curs.execute('SELECT MAX(startSeconds) FROM SensorSession WHERE startSeconds <= ?', (earliest,))
+    row = curs.fetchone()
+    fromSeconds = earliest if row[0] is None else min(row[0], earliest)
+    curs.execute('DELETE FROM SensorSession WHERE startSeconds >= ?', (fromSeconds,))
+    for (startSeconds, endSeconds, endState, transmitter) in _findSessions(curs, fromSeconds):
+        _writeSession(curs, startSeconds, endSeconds, endState, transmitter)
+
+
+def UpdateForReadings(curs, readings):
+    """Add new readings to the counts of the sessions holding them.
+
+    Args:
+        readings: (sysSeconds, glucose) of each newly inserted reading
+
+    Readings which come after the latest one a session has counted, as they
+    do in each download, are added to its counts. A session which gets a
+    reading earlier than that is counted again from EgvRecord.
+    """
+    if not readings:
+        return
+    readings = sorted(readings)
+    curs.execute('SELECT %s FROM SensorSession WHERE startSeconds <= ? AND (endSeconds IS NULL OR endSeconds > ?)'
+                 % ','.join(SESSION_COLUMNS), (readings[-1][0], readings[0][0]))
+    for session in [Session(row) for row in curs.fetchall()]:
+        added = [(sysSeconds, glucose) for (sysSeconds, glucose) in readings
+                 if (sysSeconds >= session.startSeconds)
+                 and ((session.endSeconds is None) or (sysSeconds < session.endSeconds))]
+        if not added:
+            continue
+        if (session.lastSeconds is not None) and (added[0][0] <= session.lastSeconds):
+            _writeSession(curs, session.startSeconds, session.endSeconds, session.endState, session.transmitter)
+            continue
+        readingCount = session.readingCount
+        specialCount = session.specialCount
+        gapCount = session.gapCount
+        firstSeconds = session.firstSeconds
+        lastSeconds = session.lastSeconds
+        for (sysSeconds, glucose) in added:
+            if glucose > 12:
+                readingCount += 1
+            else:
+                specialCount += 1
+            if firstSeconds is None:
+                firstSeconds = sysSeconds
+            elif sysSeconds - lastSeconds > GAP_SECONDS:
+                gapCount += 1
+            lastSeconds = sysSeconds
+        curs.execute('UPDATE SensorSession SET readingCount=?, specialCount=?, gapCount=?, firstSeconds=?, lastSeconds=?'
+                     ' WHERE startSeconds=?',
+                     (readingCount, specialCount, gapCount, firstSeconds, lastSeconds, session.startSeconds))
+
+
+def Rebuild(curs):
+    """Recreate every session from SensorInsert"""
+    curs.execute('DELETE FROM SensorSession')
+    for (startSeconds, endSeconds, endState, transmitter) in _findSessions(curs, 0):
+        _writeSession(curs, startSeconds, endSeconds, endState, transmitter)
+
+
+def ListSessions(curs):
+    """Returns a list of every Session, oldest first"""
+    curs.execute('SELECT %s FROM SensorSession ORDER BY startSeconds' % ','.join(SESSION_COLUMNS))
+    return [Session(row) for row in curs.fetchall()]
+
+
+def SessionAt(curs, sysSeconds):
+    """Returns the Session which was running at sysSeconds, or None"""
+    curs.execute('SELECT %s FROM SensorSession WHERE startSeconds <= ? ORDER BY startSeconds DESC LIMIT 1'
+                 % ','.join(SESSION_COLUMNS), (sysSeconds,))
+    row = curs.fetchone()
+    if row is None:
+        return None
+    session = Session(row)
+    if (session.endSeconds is not None) and (session.endSeconds <= sysSeconds):
+        return None
+    return session
+
+
+def SessionStats(curs, session, low, high):
+    """Find how a sensor performed, from the end of its warm-up until it
+    stopped, or its latest reading.
+
+    Args:
+        session: a Session
+        low, high: the target range, in mg/dL
+
+    Returns:
+        A SessionStatistics
+    """
+    startSecs = session.warmupEndSeconds
+    endSecs = session.endSeconds - 1 if session.endSeconds is not None else session.lastSeconds
+    if (endSecs is None) or (endSecs < startSecs):
+        stats = dailysummary.RangeStats()
+    else:
+        stats = dailysummary.QueryRange(curs, startSecs, endSecs)
+
+    calibrations = []
+    curs.execute('SELECT sysSeconds,glucose FROM Calib WHERE type=1 AND sysSeconds >= ? AND sysSeconds <= ?',
+                 (session.startSeconds, endSecs if endSecs is not None else session.startSeconds))
+    for (calSeconds, meterGlucose) in curs.fetchall():
+        curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE glucose > 12 AND sysSeconds BETWEEN ?-? AND ?+?'
+                     ' ORDER BY ABS(sysSeconds - ?) LIMIT 1',
+                     (calSeconds, CALIB_MATCH_SECONDS, calSeconds, CALIB_MATCH_SECONDS, calSeconds))
+        row = curs.fetchone()
+        if row is not None:
+            calibrations.append((calSeconds, meterGlucose, row[1]))
+    quality = signalgaps.QueryQuality(curs, session.startSeconds,
+                                      endSecs if endSecs is not None else session.startSeconds)
+    return SessionStatistics(session, stats, low, high, calibrations, quality)
+
+
+if __name__ == '__main__':
+    # List the sessions of a database given on the command line, with the
+    # statistics of each, and compare the time taken against finding the
+    # same statistics by scanning SensorInsert and EgvRecord.
+    import sqlite3
+    import sys
+    import time
+
+    if len(sys.argv) < 2:
+        print('Usage: %s <database file>' % sys.argv[0])
+        sys.exit(1)
+    import dbschema
+    conn = sqlite3.connect(sys.argv[1])
+    dbschema.Migrate(conn)
+    curs = conn.cursor()
+
+    sessions = ListSessions(curs)
+    startTime = time.time()
+    allStats = [SessionStats(curs, session, 70, 180) for session in sessions]
+    indexedTime = time.time() - startTime
+
+    startTime = time.time()
+    scanned = []
+    for (startSeconds, endSeconds, endState, transmitter) in _findSessions(curs, 0):
+        scanned.append(_countReadings(curs, startSeconds, endSeconds))
+    scanTime = time.time() - startTime
+
+    for (session, sessionStats) in zip(sessions, allStats):
+        print(session)
+        if sessionStats.stats.count:
+            print('    mean %.1f, in range %.1f%%, low %.1f%%, high %.1f%%, %d calibrations, MARD %s, %.1f%% without readings' % (
+                sessionStats.stats.mean(), sessionStats.inRangePercent, sessionStats.lowPercent,
+                sessionStats.highPercent, len(sessionStats.calibrations),
+                'n/a' if sessionStats.mard is None else '%.1f%%' % sessionStats.mard,
+                sessionStats.quality.lostPercent()))
+    agree = [tuple(getattr(s, c) for c in SESSION_COLUMNS[5:]) for s in sessions] == scanned
+    print('%d sessions : statistics %.4f s, counting by scan %.4f s, stored counts agree = %s' %
+          (len(sessions), indexedTime, scanTime, agree))
+    conn.close()
+    sys.exit(0 if agree else 1)
@@ -0,0 +1,302 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file maintains the SignalGap table, which holds the intervals where
+# the sensor gave no usable glucose value. There are two kinds:
+#
+#   MISSING : readings are made every 5 minutes, so a longer wait than
+#             GAP_SECONDS between two rows of EgvRecord means readings were
+#             lost. The interval runs from the row before the gap to the
+#             row after it.
+#   SPECIAL : a run of rows holding the same special glucose value (12 or
+#             less, see constants.SPECIAL_GLUCOSE_VALUES), such as
+#             SENSOR_NOT_ACTIVE or SENSOR_NOT_CALIBRATED. The interval runs
+#             from the first row of the run to the next row with a different
+#             value. If the run is still going at the latest reading, it
+#             ends at that reading, and isn't marked as ended.
+#
+# plotGraph() used to find the uncalibrated ranges by walking every reading
+# of the SQL window on every redraw. The intervals are found once, when the
+# readings are downloaded, by readReceiver.WriteRecordsToDb(), which only
+# rescans from the reading before the earliest new one.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import constants
+
+KIND_MISSING = 1
+KIND_SPECIAL = 2
+# Readings are made every 5 minutes, so a longer wait than this means at
+# least two readings were missed
+READING_SECONDS = 300
+GAP_SECONDS = 60 * 15
+# Glucose values at or below this are special values, not readings
+MAX_SPECIAL_GLUCOSE = 12
+
+CREATE_TABLE_SQL = ('CREATE TABLE IF NOT EXISTS SignalGap( kind INT, startSeconds INT, endSeconds INT,'
+                    ' glucose INT, count INT, ended INT, PRIMARY KEY(kind, startSeconds));')
+CREATE_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS SignalGapEnd ON SignalGap(endSeconds);'
+INTERVAL_COLUMNS = ('kind', 'startSeconds', 'endSeconds', 'glucose', 'count', 'ended')
+
+
+class Interval(object):
+    """One row of the SignalGap table.
+
+    Attributes:
+        kind: KIND_MISSING or KIND_SPECIAL
+        startSeconds, endSeconds: the interval, in receiver seconds
+        glucose: the special value of a SPECIAL run, or None
+        count: the number of rows in a SPECIAL run, or the number of
+               readings missed in a MISSING gap
+        ended: False for a SPECIAL run which was still going at the latest reading
+    """
+
+    def __init__(self, row):
+        (self.kind, self.startSeconds, self.endSeconds, self.glucose, count, ended) = row
+        self.count = count
+        self.ended = bool(ended)
+
+    def name(self):
+        if self.kind == KIND_MISSING:
+            return 'MISSING'
+        return constants.SPECIAL_GLUCOSE_VALUES.get(self.glucose) or 'SPECIAL_%s' % self.glucose
+
+    def __repr__(self):
+        return 'Interval(%s, %d - %d, count %d%s)' % (self.name(), self.startSeconds, self.endSeconds,
+                                                       self.count, '' if self.ended else ', ongoing')
+
+
+class SignalQuality(object):
+    """Time without usable readings, over a range.
+
+    Attributes:
+        seconds: the length of the range
+        missingSeconds: time within MISSING gaps
+        missingReadings: readings missed, in gaps which start within the range
+        specialSeconds: time within SPECIAL runs, as a dict by special value
+        gapCount: the number of MISSING gaps which start within the range
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.missingSeconds = 0
+        self.missingReadings = 0
+        self.specialSeconds = {}
+        self.gapCount = 0
+
+    def lostSeconds(self):
+        return self.missingSeconds + sum(self.specialSeconds.values())
+
+    def lostPercent(self):
+        if self.seconds <= 0:
+            return 0.0
+        return 100.0 * self.lostSeconds() / self.seconds
+
+
+def CreateTable(curs):
+    """Create the SignalGap table and its index, if necessary.
+
+    Returns:
+        True if the table had to be created
+    """
+    curs.execute("SELECT count(*) from sqlite_master where type='table' and name='SignalGap'")
+    exists = curs.fetchone()[0] > 0
+    if not exists:
+        curs.execute(CREATE_TABLE_SQL)
+    curs.execute(CREATE_INDEX_SQL)
+    return not exists
+
+
+def _findIntervals(rows):
+    # Returns the SignalGap rows for a list of (sysSeconds, glucose), in
+    # time order. The first row must not be part of a run or gap which
+    # started earlier.
+    intervals = []
+    run = None      # [startSeconds, glucose, count]
+    lastSeconds = None
+    for (sysSeconds, glucose) in rows:
+        if (lastSeconds is not None) and (sysSeconds - lastSeconds > GAP_SECONDS):
+            missed = (sysSeconds - lastSeconds + READING_SECONDS // 2) // READING_SECONDS - 1
+            intervals.append((KIND_MISSING, lastSeconds, sysSeconds, None, missed, 1))
+        if (run is not None) and (glucose != run[1]):
+            intervals.append((KIND_SPECIAL, run[0], sysSeconds, run[1], run[2], 1))
+            run = None
+        if glucose <= MAX_SPECIAL_GLUCOSE:
+            if run is None:
+                run = [sysSeconds, glucose, 0]
+            run[2] += 1
+        lastSeconds = sysSeconds
+    if run is not None:
+        intervals.append((KIND_SPECIAL, run[0], lastSeconds, run[1], run[2], 0))
+    return intervals
+
+
+def _rescan(curs, fromSeconds):
+    curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? ORDER BY sysSeconds', (fromSeconds,))
+    curs.executemany('INSERT OR REPLACE INTO SignalGap( kind, startSeconds, endSeconds, glucose, count, ended)'
+                     ' VALUES (?, ?, ?, ?, ?, ?);', _findIntervals(curs.fetchall()))
+
+
+def UpdateForReadings(curs, sysSecondsList):
+    """Find the intervals again, from the reading before the earliest of
+    the given new readings. The table is created and filled by a dbschema
+    migration."""
+    if not sysSecondsList:
+        return
+    earliest = min(sysSecondsList)
+    curs.execute('SELECT MAX(sysSeconds) FROM EgvRecord WHERE sysSeconds < ?', (earliest,))
+    row = curs.fetchone()
+    fromSeconds = earliest if row[0] is None else row[0]
+    # Any interval reaching the previous reading may change, so start from
+    # the earliest of those. Runs and gaps which end where that one starts
+    # have to be found again too.
+    while True:
+        curs.execute('SELECT MIN(startSeconds) FROM SignalGap WHERE endSeconds >= ?', (fromSeconds,))
+        row = curs.fetchone()
+        if (row[0] is None) or (row[0] >= fromSeconds):
+            break
+        fromSeconds = row[0]
+    curs.execute('DELETE FROM SignalGap WHERE endSeconds >= ?', (fromSeconds,))
+    _rescan(curs, fromSeconds)
+
+
+def Rebuild(curs):
+    """Find every interval in EgvRecord"""
+    curs.execute('DELETE FROM SignalGap')
+    _rescan(curs, 0)
+
+
+def QueryIntervals(curs, startSecs, endSecs, kind=None):
+    """Returns a list of the Intervals which overlap startSecs through
+    endSecs, in order of their start. If kind is given, only intervals of
+    that kind are returned."""
+    sql = 'SELECT %s FROM SignalGap WHERE endSeconds >= ? AND startSeconds <= ?' % ','.join(INTERVAL_COLUMNS)
+    params = (int(startSecs), int(endSecs))
+    if kind is not None:
+        sql += ' AND kind = ?'
+        params += (kind,)
+    curs.execute(sql + ' ORDER BY startSeconds', params)
+    return [Interval(row) for row in curs.fetchall()]
+
+
+def SpecialZones(intervals, ongoingValues=(1, 5)):
+    """Join SPECIAL runs which follow directly on from each other into
+    zones, in the way plotGraph() shades uncalibrated ranges. A run which
+    is still going is only included if its value is in ongoingValues, which
+    by default are SENSOR_NOT_ACTIVE and SENSOR_NOT_CALIBRATED.
+
+    Args:
+        intervals: Intervals, in order of their start, as from QueryIntervals()
+
+    Returns:
+        A list of (startSeconds, endSeconds)
+    """
+    zones = []
+    for interval in intervals:
+        if interval.kind != KIND_SPECIAL:
+            continue
+        if not interval.ended and interval.glucose not in ongoingValues:
+            continue
+        if zones and (zones[-1][1] == interval.startSeconds):
+            zones[-1][1] = interval.endSeconds
+        else:
+            zones.append([interval.startSeconds, interval.endSeconds])
+    return [tuple(zone) for zone in zones]
+
+
+def QueryQuality(curs, startSecs, endSecs):
+    """Find how much of startSecs through endSecs had no usable readings.
+
+    Returns:
+        A SignalQuality
+    """
+    startSecs = int(startSecs)
+    endSecs = int(endSecs)
+    quality = SignalQuality(max(0, endSecs - startSecs))
+    for interval in QueryIntervals(curs, startSecs, endSecs):
+        seconds = max(0, min(interval.endSeconds, endSecs) - max(interval.startSeconds, startSecs))
+        if interval.kind == KIND_MISSING:
+            quality.missingSeconds += seconds
+            if interval.startSeconds >= startSecs:
+                quality.gapCount += 1
+                quality.missingReadings += interval.count
+        else:
+            quality.specialSeconds[interval.glucose] = quality.specialSeconds.get(interval.glucose, 0) + seconds
+    return quality
+
+
+if __name__ == '__main__':
+    # Check that updating the intervals a batch of readings at a time gives
+    # the same table as finding them all at once, and time a 90 day quality
+    # query against finding the same thing by scanning EgvRecord, using a
+    # database given on the command line.
+    import sqlite3
+    import sys
+    import time
+
+    if len(sys.argv) < 2:
+        print('Usage: %s <database file>' % sys.argv[0])
+        sys.exit(1)
+    import dbschema
+    conn = sqlite3.connect(sys.argv[1])
+    dbschema.Migrate(conn)
+    curs = conn.cursor()
+    curs.execute('SELECT %s FROM SignalGap ORDER BY kind, startSeconds' % ','.join(INTERVAL_COLUMNS))
+    stored = curs.fetchall()
+
+    # Replay the readings into an empty copy, in download sized batches
+    curs.execute('SELECT sysSeconds,glucose FROM EgvRecord ORDER BY sysSeconds')
+    readings = curs.fetchall()
+    replay = sqlite3.connect(':memory:')
+    replayCurs = replay.cursor()
+    replayCurs.execute('CREATE TABLE EgvRecord( sysSeconds INTEGER PRIMARY KEY, glucose INT)')
+    CreateTable(replayCurs)
+    startTime = time.time()
+    for first in range(0, len(readings), 1000):
+        batch = readings[first:first + 1000]
+        replayCurs.executemany('INSERT INTO EgvRecord( sysSeconds, glucose) VALUES (?, ?)', batch)
+        UpdateForReadings(replayCurs, [row[0] for row in batch])
+    replayTime = time.time() - startTime
+    replayCurs.execute('SELECT %s FROM SignalGap ORDER BY kind, startSeconds' % ','.join(INTERVAL_COLUMNS))
+    agree = replayCurs.fetchall() == stored
+    replay.close()
+
+    endSecs = readings[-1][0] if readings else 0
+    startSecs = endSecs - 90 * 24 * 60 * 60
+    startTime = time.time()
+    quality = QueryQuality(curs, startSecs, endSecs)
+    indexTime = time.time() - startTime
+
+    startTime = time.time()
+    curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds',
+                 (startSecs, endSecs))
+    scanned = _findIntervals(curs.fetchall())
+    scanTime = time.time() - startTime
+
+    print('%d intervals, replayed in batches in %.3f s, agree with a rebuild = %s' % (len(stored), replayTime, agree))
+    print('Last 90 days : %d gaps (%d readings missed), %.1f%% of the time without readings' %
+          (quality.gapCount, quality.missingReadings, quality.lostPercent()))
+    for (glucose, seconds) in sorted(quality.specialSeconds.items()):
+        print('    %-22s %8.1f hours' % (constants.SPECIAL_GLUCOSE_VALUES.get(glucose), seconds / 3600.0))
+    print('SignalGap query %.4f s, EgvRecord scan %.4f s (%d intervals)' % (indexTime, scanTime, len(scanned)))
+    conn.close()
+    sys.exit(0 if agree else 1)
@@ -0,0 +1,677 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# The graph reads records from SQL a window at a time, where a window
+# covers WINDOW_SECONDS (105 days). Reading a window takes long enough that
+# doing it when the display first crosses out of the current window makes
+# the position slider, or the arrow keys, stall.
+#
+# Windows are laid out on a fixed grid, each one starting STEP_SECONDS after
+# the one before, so they overlap by WINDOW_SECONDS - STEP_SECONDS. That is
+# more than the widest display range, so any display fits inside a single
+# window, and the windows next to the current one are known in advance.
+#
+# WindowManager watches the direction and speed at which the display moves,
+# and reads the windows ahead of it on a background thread, each with its
+# own read-only connection. When the display crosses into the next window,
+# that window is usually already waiting. The most recently used windows
+# are kept, up to a fixed number.
+#
+# Windows are then decoded into the lists which the graph is drawn from,
+# with times as matplotlib date numbers, converted a whole list at a time.
+# DecodedCache keeps decoded windows, up to a memory budget, keyed by the
+# window and a count of the database's changes. Glucose values are kept in
+# mg/dL, since the display units are applied when drawing, and a different
+# time offset is applied by shifting a decoded window, rather than
+# re-reading it.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections import deque
+from traceback import print_exc
+import numpy as np
+import dailysummary
+import dbschema
+import signalgaps
+import timeconv
+
+# The span of records read at a time, and the distance between the
+# starts of neighboring windows
+WINDOW_SECONDS = 60*60*24*105
+STEP_SECONDS = 60*60*24*90
+# How many windows to keep, including the one being displayed
+DEFAULT_MAX_WINDOWS = 4
+# Prefetch far enough ahead to cover this many seconds of scrolling at the
+# current speed, but no more than MAX_AHEAD windows
+PREFETCH_SECONDS = 2.0
+MAX_AHEAD = 2
+# Weight given to the newest speed measurement, in the smoothed scroll speed
+SPEED_SMOOTHING = 0.5
+# A pause in scrolling longer than this starts a new speed measurement
+SPEED_RESET_SECONDS = 1.0
+# Memory budget for decoded windows, and the approximate size of one decoded
+# row, which is a short list holding a few numbers
+DEFAULT_DECODED_BYTES = 32 * 1024 * 1024
+DECODED_ROW_BYTES = 200
+
+
+def WindowBounds(displayEndSecs, firstSecs, lastSecs):
+    """Find the grid window holding a display which ends at displayEndSecs.
+
+    Args:
+        displayEndSecs: the end of the display range
+        firstSecs: the time of the earliest record
+        lastSecs: the latest time which may be displayed
+
+    All times are in receiver system seconds.
+
+    Returns:
+        (index, minTime, maxTime), where index is the window's position on
+        the grid, and minTime, maxTime are the range of records to read, which
+        is clipped to firstSecs - lastSecs.
+    """
+    index = int(displayEndSecs) // STEP_SECONDS
+    return (index,) + _clippedBounds(index, firstSecs, lastSecs)
+
+
+def _clippedBounds(index, firstSecs, lastSecs):
+    maxTime = (index + 1) * STEP_SECONDS
+    minTime = max(maxTime - WINDOW_SECONDS, firstSecs)
+    # If we're clipped at the start, make the most of the window's length
+    maxTime = min(max(maxTime, minTime + WINDOW_SECONDS), lastSecs)
+    return (minTime, maxTime)
+
+
+class SqlWindow(object):
+    """The records in one window of a database, as read from SQL.
+    Rows hold receiver system seconds, without any display offset applied.
+
+    Attributes:
+        minTime, maxTime: the range of sysSeconds read
+        earliestGluc: the first real glucose reading in the range, or None
+        maximumGluc: the highest real glucose reading in the range, or None
+        calibRows: (sysSeconds, glucose, egvRow) for each user calibration,
+                   where egvRow is the (sysSeconds, glucose) of the closest
+                   real reading within 5 minutes, or None
+        egvRows: (sysSeconds, glucose) for every reading, oldest first
+        eventRows: (sysSeconds, dispSeconds, meterSeconds, type, subtype,
+                   value, xoffset, yoffset) for every user event
+        noteRows: (sysSeconds, message, xoffset, yoffset) for every note
+        specialZones: (startSeconds, endSeconds) of each range of special
+                   glucose values, from the SignalGap table, clipped to the
+                   window, or None in a database without that table
+    """
+
+    def __init__(self, minTime, maxTime):
+        self.minTime = minTime
+        self.maxTime = maxTime
+        self.earliestGluc = None
+        self.maximumGluc = None
+        self.calibRows = []
+        self.egvRows = []
+        self.eventRows = []
+        self.noteRows = []
+        self.specialZones = None
+
+
+def ReadWindow(curs, minTime, maxTime):
+    """Read the records with sysSeconds from minTime through maxTime.
+    For a consistent result, the caller should hold a transaction open.
+
+    Returns:
+        A SqlWindow
+
+    Raises:
+        sqlite3.Error
+    """
+    window = SqlWindow(minTime, maxTime)
+    curs.execute("SELECT name from sqlite_master where type='table'")
+    tables = set(row[0] for row in curs.fetchall())
+
+    if 'EgvRecord' in tables:
+        curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds <= ? AND glucose > 12 ORDER BY sysSeconds ASC LIMIT 1',
+                     (minTime, maxTime))
+        for row in curs.fetchall():
+            window.earliestGluc = row[1]
+
+        window.maximumGluc = dailysummary.QueryRange(curs, minTime, maxTime).maximum
+
+        if 'Calib' in tables:
+            selectCalSql = 'SELECT sysSeconds,glucose FROM Calib WHERE type=1 AND sysSeconds >= ? AND sysSeconds <= ?'
+            selectEgvSql = 'SELECT sysSeconds,glucose FROM EgvRecord WHERE glucose > 12 AND sysSeconds BETWEEN ?-300 AND ?+300 ORDER BY ABS(sysSeconds - ?) LIMIT 1'
+            curs.execute(selectCalSql, (minTime, maxTime))
+            for calibRow in curs.fetchall():
+                # Search for the closest EGV record within 5 minutes of the User Calibration entry
+                curs.execute(selectEgvSql, (calibRow[0], calibRow[0], calibRow[0]))
+                window.calibRows.append((calibRow[0], calibRow[1], curs.fetchone()))
+
+        curs.execute('SELECT sysSeconds,glucose FROM EgvRecord WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds',
+                     (minTime, maxTime))
+        window.egvRows = curs.fetchall()
+
+        if 'SignalGap' in tables:
+            window.specialZones = [(max(start, minTime), min(end, maxTime)) for (start, end) in
+                                   signalgaps.SpecialZones(signalgaps.QueryIntervals(curs, minTime, maxTime, signalgaps.KIND_SPECIAL))]
+
+    if 'UserEvent' in tables:
+        curs.execute('SELECT sysSeconds,dispSeconds,meterSeconds,type,subtype,value,xoffset,yoffset FROM UserEvent WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds-dispSeconds+meterSeconds',
+                     (minTime, maxTime))
+        window.eventRows = curs.fetchall()
+
+    if 'UserNote' in tables:
+        curs.execute('SELECT sysSeconds,message,xoffset,yoffset FROM UserNote WHERE sysSeconds >= ? AND sysSeconds <= ? ORDER BY sysSeconds',
+                     (minTime, maxTime))
+        window.noteRows = curs.fetchall()
+    return window
+
+
+class DecodedWindow(object):
+    """The lists which the graph is drawn from, decoded from a SqlWindow,
+    with times as matplotlib date numbers, shifted by offsetSeconds.
+
+    Attributes:
+        egvList: [time, glucose, running mean] for each reading, with a
+                 reading added for each calibration made while the sensor
+                 was uncalibrated
+        calibList: [time, glucose, errorbar offset, uncalibrated flag]
+        eventList: [time, type, subtype, value, xoffset, yoffset]
+        noteList: [time, message, xoffset, yoffset]
+        calibFirst, calibLast: the first and last of calibList, or None
+        earliestGluc, maximumGluc: as in SqlWindow
+        egvSeconds, calibSeconds, eventSeconds, noteSeconds: numpy arrays
+                 of the times in each list, as receiver seconds plus
+                 offsetSeconds
+        specialZones: [start time, end time] of each range of special
+                 glucose values, or None, as in SqlWindow
+    """
+
+    def __init__(self, offsetSeconds):
+        self.offsetSeconds = offsetSeconds
+        self.egvList = []
+        self.calibList = []
+        self.eventList = []
+        self.noteList = []
+        self.calibFirst = None
+        self.calibLast = None
+        self.earliestGluc = None
+        self.maximumGluc = None
+        self.egvSeconds = np.zeros(0, dtype=np.int64)
+        self.calibSeconds = np.zeros(0, dtype=np.int64)
+        self.eventSeconds = np.zeros(0, dtype=np.int64)
+        self.noteSeconds = np.zeros(0, dtype=np.int64)
+        self.specialZones = None
+        self.zoneSeconds = None
+
+    def rowCount(self):
+        return len(self.egvList) + len(self.calibList) + len(self.eventList) + len(self.noteList)
+
+    def shifted(self, offsetSeconds):
+        """Returns a copy of this window, for a different time offset"""
+        delta = offsetSeconds - self.offsetSeconds
+        other = DecodedWindow(offsetSeconds)
+        other.earliestGluc = self.earliestGluc
+        other.maximumGluc = self.maximumGluc
+        other._setRows(self.egvSeconds + delta, [row[1:] for row in self.egvList],
+                       self.calibSeconds + delta, [row[1:] for row in self.calibList],
+                       self.eventSeconds + delta, [row[1:] for row in self.eventList],
+                       self.noteSeconds + delta, [row[1:] for row in self.noteList])
+        if self.zoneSeconds is not None:
+            other._setZones(self.zoneSeconds + delta)
+        return other
+
+    def _setRows(self, egvSeconds, egvRows, calibSeconds, calibRows, eventSeconds, eventRows,
+                 noteSeconds, noteRows):
+        # Put each row's time in front of the rest of its fields, converting
+        # the times of each list with one array operation
+        def timedRows(seconds, rows):
+            seconds = np.asarray(seconds, dtype=np.int64)
+            return (seconds, [[num] + row for (num, row) in zip(timeconv.ReceiverSecondsToNum(seconds).tolist(), rows)])
+
+        (self.egvSeconds, self.egvList) = timedRows(egvSeconds, egvRows)
+        (self.calibSeconds, self.calibList) = timedRows(calibSeconds, calibRows)
+        (self.eventSeconds, self.eventList) = timedRows(eventSeconds, eventRows)
+        (self.noteSeconds, self.noteList) = timedRows(noteSeconds, noteRows)
+        self.calibFirst = self.calibList[0] if self.calibList else None
+        self.calibLast = self.calibList[-1] if self.calibList else None
+
+    def _setZones(self, zoneSeconds):
+        self.zoneSeconds = np.asarray(zoneSeconds, dtype=np.int64).reshape(-1, 2)
+        self.specialZones = timeconv.ReceiverSecondsToNum(self.zoneSeconds).tolist()
+
+
+def DecodeWindow(window, offsetSeconds):
+    """Decode a SqlWindow.
+
+    Args:
+        window: a SqlWindow
+        offsetSeconds: the display's time offset, added to every time
+
+    Returns:
+        A DecodedWindow
+    """
+    decoded = DecodedWindow(offsetSeconds)
+    decoded.earliestGluc = window.earliestGluc
+    decoded.maximumGluc = window.maximumGluc
+    uncalGluQueue = deque()
+    # The fields after the time of each row, and the times, in receiver seconds
+    egvRows = []
+    egvSeconds = []
+    calibRows = []
+    calibSeconds = []
+
+    for calibRow in window.calibRows:
+        egvRow = calibRow[2]
+        if egvRow:
+            # calculate an errorbar offset
+            calibRows.append([egvRow[1], calibRow[1] - egvRow[1], 0])
+            calibSeconds.append(egvRow[0] + offsetSeconds)
+        else:
+            # No egvRow was found (possibly due to this Calibration happening
+            # within a Sensor Calibration period), so specify a 0 distance offset.
+            # We'll end up plotting the User Calibration without an errorbar.
+            # Flag this condition with a '1' in the 4th field.
+            calibRows.append([calibRow[1], 0, 1])
+            calibSeconds.append(calibRow[0] + offsetSeconds)
+            uncalGluQueue.append([calibRow[0], calibRow[1]])
+
+    # Calculate the running mean
+    rowCount = 0
+    runMean = 0.0
+    # We want to insert manual data points for glucose values submitted by User
+    # Calibration events which occurred when there was no calibrated sensor.
+    uncalGluData = uncalGluQueue.popleft() if uncalGluQueue else None
+
+    for row in window.egvRows:
+        if uncalGluData and (uncalGluData[0] < row[0]):
+            # Insert manual data point
+            rowCount += 1
+            runMean = float(uncalGluData[1] + (rowCount-1) * runMean) / rowCount
+            egvRows.append([uncalGluData[1], runMean])
+            egvSeconds.append(uncalGluData[0] + offsetSeconds)
+            uncalGluData = uncalGluQueue.popleft() if uncalGluQueue else None
+
+        # Only include real Glucose values. Values <= 12 are fake.
+        if row[1] > 12:
+            rowCount += 1
+            runMean = float(row[1] + (rowCount-1) * runMean) / rowCount
+
+        egvRows.append([row[1], runMean])
+        egvSeconds.append(row[0] + offsetSeconds)
+
+    while uncalGluData:
+        # Insert remaining manual data points
+        rowCount += 1
+        runMean = float(uncalGluData[1] + (rowCount-1) * runMean) / rowCount
+        egvRows.append([uncalGluData[1], runMean])
+        egvSeconds.append(uncalGluData[0] + offsetSeconds)
+        uncalGluData = uncalGluQueue.popleft() if uncalGluQueue else None
+
+    #########################################################################################
+    # In older (G5) versions Receiver firmware, the current date and time is always assigned
+    # when a user enters an Event.  In newer (G6) releases of firmware, the user is allowed
+    # to specify an alternate date and time for the Event.
+    #    sysSeconds = event creation time in seconds since BASE_TIME in UTC timezone
+    #    dispSeconds = event creation time in seconds since BASE_TIME in Local timezone
+    #    meterSeconds = User entered Event time in seconds since BASE_TIME in Local timezone
+    # We need the User entered Event time in the UTC timezone.
+    #   Offset in seconds = sysSeconds - dispSeconds
+    #   Event time (in UTC)= (sysSeconds - dispSeconds) + meterSeconds
+    #########################################################################################
+    eventSeconds = [row[0] - row[1] + row[2] + offsetSeconds for row in window.eventRows]
+    eventRows = [list(row[3:8]) for row in window.eventRows]
+    noteSeconds = [row[0] + offsetSeconds for row in window.noteRows]
+    noteRows = [list(row[1:4]) for row in window.noteRows]
+
+    decoded._setRows(egvSeconds, egvRows, calibSeconds, calibRows, eventSeconds, eventRows,
+                     noteSeconds, noteRows)
+    if window.specialZones is not None:
+        decoded._setZones([(start + offsetSeconds, end + offsetSeconds) for (start, end) in window.specialZones])
+    return decoded
+
+
+class DecodedCache(object):
+    """A least recently used cache of DecodedWindows, limited by their
+    approximate size. get() and put() are called from the main thread,
+    and invalidate() from any thread.
+
+    Keys are (dbPath, minTime, maxTime, changes), where changes is
+    anything which differs after a change to the database which hasn't
+    been passed to invalidate(). Each key may be held for several time
+    offsets.
+    """
+
+    def __init__(self, maxBytes=DEFAULT_DECODED_BYTES):
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (key, offsetSeconds) -> DecodedWindow
+        self._bytes = 0
+        self._generation = 0
+        self.hits = 0
+        self.shifts = 0
+        self.misses = 0
+
+    def generation(self):
+        """Returns a count of invalidations, to pass to put()"""
+        with self._lock:
+            return self._generation
+
+    def get(self, key, offsetSeconds):
+        """Returns the DecodedWindow for a key and time offset, shifting one
+        cached for another offset if necessary, or None if there's none"""
+        with self._lock:
+            decoded = self._entries.pop((key, offsetSeconds), None)
+            if decoded is not None:
+                self._entries[(key, offsetSeconds)] = decoded
+                self.hits += 1
+                return decoded
+            other = None
+            for ((otherKey, otherOffset), entry) in self._entries.items():
+                if otherKey == key:
+                    other = entry
+                    break
+            generation = self._generation
+        if other is not None:
+            self.shifts += 1
+            decoded = other.shifted(offsetSeconds)
+            self.put(key, decoded, generation)
+            return decoded
+        self.misses += 1
+        return None
+
+    def put(self, key, decoded, generation=None):
+        """Keep a DecodedWindow. If generation is given, and invalidate()
+        has been called since it was read, the window may be stale, so
+        it isn't kept."""
+        with self._lock:
+            if (generation is not None) and (generation != self._generation):
+                return
+            # Anything read from the same window before the latest change is stale
+            for entryKey in [k for k in self._entries if (k[0][:3] == key[:3]) and (k[0] != key)]:
+                self._remove(entryKey)
+            self._remove((key, decoded.offsetSeconds))
+            self._entries[(key, decoded.offsetSeconds)] = decoded
+            self._bytes += decoded.rowCount() * DECODED_ROW_BYTES
+            while (self._bytes > self.maxBytes) and (len(self._entries) > 1):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, dbPath=None, firstSecs=None, lastSecs=None):
+        """Forget windows which overlap a changed range of a database.
+        By default, every window is forgotten."""
+        with self._lock:
+            for entryKey in list(self._entries.keys()):
+                key = entryKey[0]
+                if (dbPath is not None) and (key[0] != dbPath):
+                    continue
+                if (firstSecs is not None) and (key[2] < firstSecs):
+                    continue
+                if (lastSecs is not None) and (key[1] > lastSecs):
+                    continue
+                self._remove(entryKey)
+            self._generation += 1
+
+    def clear(self):
+        self.invalidate()
+
+    def _remove(self, entryKey):
+        # Called with the lock held
+        decoded = self._entries.pop(entryKey, None)
+        if decoded is not None:
+            self._bytes -= decoded.rowCount() * DECODED_ROW_BYTES
+
+
+class WindowManager(object):
+    """Keep recently used SqlWindows, and prefetch the ones the display
+    is heading towards.
+
+    get() and track() are called from the main thread. Prefetching runs
+    on a daemon thread, which is started when first needed.
+    """
+
+    def __init__(self, maxWindows=DEFAULT_MAX_WINDOWS, dbg=False):
+        self.maxWindows = maxWindows
+        self._debug_mode = dbg
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._windows = OrderedDict()   # (dbPath, minTime, maxTime) -> SqlWindow
+        self._inFlight = {}             # key -> threading.Event
+        self._wanted = []               # keys to prefetch, most urgent first
+        self._generation = 0
+        self._thread = None
+        self._stopping = False
+        self._lastEnd = None
+        self._lastTime = None
+        self.speed = 0.0                # smoothed, in receiver seconds per second
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self):
+        """Returns a count of invalidations, to pass to get()"""
+        with self._lock:
+            return self._generation
+
+    def get(self, curs, dbPath, minTime, maxTime, generation=None):
+        """Return the window for minTime - maxTime, from the cache, from a
+        prefetch which is under way, or by reading it with curs. If
+        generation is given, and invalidate() has been called since, a
+        window read with curs may be stale, so it isn't kept."""
+        key = (dbPath, minTime, maxTime)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None:
+                self._windows.pop(key)
+                self._windows[key] = window
+                self.hits += 1
+                return window
+            pending = self._inFlight.get(key)
+        if pending is not None:
+            # Almost there, so it's quicker to wait than to start again
+            pending.wait()
+            with self._lock:
+                window = self._windows.get(key)
+                if window is not None:
+                    self.hits += 1
+                    return window
+
+        self.misses += 1
+        window = ReadWindow(curs, minTime, maxTime)
+        with self._lock:
+            if (generation is None) or (generation == self._generation):
+                self._store(key, window)
+        return window
+
+    def track(self, dbPath, displayEndSecs, firstSecs, lastSecs):
+        """Note where the display now ends, and queue prefetches of the
+        windows ahead of it, in the direction it's moving."""
+        now = time.time()
+        if (self._lastEnd is not None) and (now - self._lastTime < SPEED_RESET_SECONDS):
+            if now > self._lastTime:
+                newSpeed = (displayEndSecs - self._lastEnd) / (now - self._lastTime)
+                self.speed = SPEED_SMOOTHING * newSpeed + (1.0 - SPEED_SMOOTHING) * self.speed
+        else:
+            self.speed = 0.0
+        direction = displayEndSecs - self._lastEnd if self._lastEnd is not None else 0
+        self._lastEnd = displayEndSecs
+        self._lastTime = now
+        if direction == 0:
+            return
+
+        index = WindowBounds(displayEndSecs, firstSecs, lastSecs)[0]
+        ahead = 1 + int(abs(self.speed) * PREFETCH_SECONDS / STEP_SECONDS)
+        step = 1 if direction > 0 else -1
+        wanted = []
+        for count in range(1, min(ahead, MAX_AHEAD, self.maxWindows - 1) + 1):
+            (minTime, maxTime) = _clippedBounds(index + step * count, firstSecs, lastSecs)
+            if minTime < maxTime:
+                wanted.append((dbPath, minTime, maxTime))
+        self.prefetch(wanted)
+
+    def prefetch(self, keys):
+        # Replace any queued prefetches, since the display has moved on
+        with self._lock:
+            self._wanted = [key for key in keys
+                            if (key not in self._windows) and (key not in self._inFlight)]
+            if not self._wanted:
+                return
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='SqlWindowPrefetch')
+                self._thread.daemon = True
+                self._thread.start()
+            self._wake.notify()
+
+    def invalidate(self, dbPath=None, firstSecs=None, lastSecs=None):
+        """Forget windows which overlap a changed range of a database.
+        By default, every window is forgotten."""
+        with self._lock:
+            for key in list(self._windows.keys()):
+                if (dbPath is not None) and (key[0] != dbPath):
+                    continue
+                if (firstSecs is not None) and (key[2] < firstSecs):
+                    continue
+                if (lastSecs is not None) and (key[1] > lastSecs):
+                    continue
+                del self._windows[key]
+            # Anything being read now may have missed the change
+            self._generation += 1
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._wanted = []
+            self._wake.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+
+    def _store(self, key, window):
+        # Called with the lock held
+        self._windows.pop(key, None)
+        self._windows[key] = window
+        while len(self._windows) > self.maxWindows:
+            self._windows.popitem(last=False)
+
+    def _run(self):
+        connections = {}
+        try:
+            while True:
+                with self._lock:
+                    while (not self._wanted) and (not self._stopping):
+                        self._wake.wait()
+                    if self._stopping:
+                        return
+                    key = self._wanted.pop(0)
+                    done = threading.Event()
+                    self._inFlight[key] = done
+                    generation = self._generation
+                try:
+                    (dbPath, minTime, maxTime) = key
+                    conn = connections.get(dbPath)
+                    if conn is None:
+                        conn = dbschema.ReadOnlyConnection(dbPath)
+                        connections[dbPath] = conn
+                    curs = conn.cursor()
+                    curs.execute('BEGIN')
+                    startTime = time.time()
+                    window = ReadWindow(curs, minTime, maxTime)
+                    curs.close()
+                    conn.commit()
+                    if self._debug_mode:
+                        print('SqlWindow prefetch of', len(window.egvRows), 'readings took %.3f seconds' % (time.time() - startTime))
+                    with self._lock:
+                        if generation == self._generation:
+                            self._store(key, window)
+                except Exception as e:
+                    print('WindowManager prefetch of', key, 'failed :', e)
+                    print_exc()
+                    if sys.version_info < (3, 0):
+                        sys.exc_clear()
+                finally:
+                    with self._lock:
+                        del self._inFlight[key]
+                    done.set()
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+
+if __name__ == '__main__':
+    # Time a scroll through a database given on the command line, from the
+    # newest window to the oldest, with and without prefetching.
+    if len(sys.argv) < 2:
+        print('Usage: %s <database file>' % sys.argv[0])
+        sys.exit(1)
+    dbPath = sys.argv[1]
+    dbschema.MigrateOnce(dbPath)
+    conn = dbschema.ReadOnlyConnection(dbPath)
+    curs = conn.cursor()
+    curs.execute('SELECT MIN(sysSeconds), MAX(sysSeconds) FROM EgvRecord')
+    (firstSecs, lastSecs) = curs.fetchone()
+    dayStep = 60*60*24
+
+    for usePrefetch in (False, True):
+        manager = WindowManager()
+        worst = 0.0
+        total = 0.0
+        displayEnd = lastSecs
+        while displayEnd > firstSecs:
+            if usePrefetch:
+                manager.track(dbPath, displayEnd, firstSecs, lastSecs)
+            (index, minTime, maxTime) = WindowBounds(displayEnd, firstSecs, lastSecs)
+            startTime = time.time()
+            curs.execute('BEGIN')
+            manager.get(curs, dbPath, minTime, maxTime)
+            conn.commit()
+            elapsed = time.time() - startTime
+            worst = max(worst, elapsed)
+            total += elapsed
+            # Scroll back a day, at about the speed of holding down an arrow key
+            time.sleep(0.02)
+            displayEnd -= dayStep
+        manager.stop()
+        print('Prefetch %-5s : %d hits, %d misses, worst step %.4f s, total %.4f s' %
+              (usePrefetch, manager.hits, manager.misses, worst, total))
+
+    # Compare decoding the newest window with finding it in a DecodedCache,
+    # for the same time offset, and for a different one
+    (index, minTime, maxTime) = WindowBounds(lastSecs, firstSecs, lastSecs)
+    curs.execute('BEGIN')
+    window = ReadWindow(curs, minTime, maxTime)
+    conn.commit()
+    cache = DecodedCache()
+    key = (dbPath, minTime, maxTime, 0)
+    startTime = time.time()
+    cache.put(key, DecodeWindow(window, 0))
+    decodeTime = time.time() - startTime
+    startTime = time.time()
+    cache.get(key, 0)
+    hitTime = time.time() - startTime
+    startTime = time.time()
+    cache.get(key, 3600)
+    shiftTime = time.time() - startTime
+    print('Decode %d readings %.4f s, cached %.6f s, new time offset %.4f s' %
+          (len(window.egvRows), decodeTime, hitTime, shiftTime))
+    conn.close()
@@ -0,0 +1,96 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# This file converts whole arrays of receiver times, in seconds since
+# constants.BASE_TIME (UTC), into matplotlib date numbers or numpy
+# datetime64 values, with one vectorized operation per array.
+#
+# Calling mdates.date2num() on one datetime at a time costs about 35
+# microseconds, so converting a 30,000 reading window that way takes over a
+# second. The same conversion of a numpy array takes about a millisecond.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import numpy as np
+import matplotlib.dates as mdates
+import constants
+
+SECONDS_PER_DAY = 60 * 60 * 24
+# The receiver's time base, which is always in UTC
+RECEIVER_EPOCH = np.datetime64(constants.BASE_TIME, 's')
+
+
+def ReceiverSecondsToDatetime64(secs):
+    """Convert receiver seconds, as a scalar or array, to datetime64[s] in UTC"""
+    return RECEIVER_EPOCH + np.asarray(secs).astype('timedelta64[s]')
+
+
+def _epochNum():
+    # The matplotlib date number of the receiver epoch. This is found on each
+    # call, since matplotlib's own epoch may be changed by mdates.set_epoch().
+    return mdates.date2num(RECEIVER_EPOCH)
+
+
+def ReceiverSecondsToNum(secs):
+    """Convert receiver seconds, as a scalar or array, to matplotlib date numbers"""
+    return _epochNum() + np.asarray(secs, dtype=np.float64) / SECONDS_PER_DAY
+
+
+def NumToReceiverSeconds(nums):
+    """Convert matplotlib date numbers, as a scalar or array, to receiver seconds,
+    rounded to the nearest second"""
+    return np.rint((np.asarray(nums, dtype=np.float64) - _epochNum()) * SECONDS_PER_DAY).astype(np.int64)
+
+
+if __name__ == '__main__':
+    # Compare converting 30,000 readings one at a time, as plotGraph() used
+    # to, with converting them as an array.
+    import datetime
+    import sys
+    import time
+    import pytz
+
+    utcBaseTime = datetime.datetime(2009, 1, 1, tzinfo=pytz.UTC)
+    count = 30000
+    secs = np.arange(300000000, 300000000 + 300 * count, 300, dtype=np.int64)
+
+    startTime = time.time()
+    rowNums = [mdates.date2num(utcBaseTime + datetime.timedelta(seconds=int(s))) for s in secs]
+    rowTime = time.time() - startTime
+
+    startTime = time.time()
+    arrayNums = ReceiverSecondsToNum(secs)
+    arrayTime = time.time() - startTime
+
+    startTime = time.time()
+    dt64 = ReceiverSecondsToDatetime64(secs)
+    dt64Time = time.time() - startTime
+
+    # Date numbers are floats of about 14000 days, so allow for rounding
+    # to a few microseconds
+    agree = np.allclose(rowNums, arrayNums, rtol=0, atol=1e-10)
+    roundTrip = np.array_equal(NumToReceiverSeconds(arrayNums), secs)
+    sameAsDatetime = np.array_equal(mdates.date2num(dt64), arrayNums)
+    print('%d readings : one at a time %.4f s, as an array %.4f s (%.0fx), datetime64 %.4f s' %
+          (count, rowTime, arrayTime, rowTime / max(arrayTime, 1e-9), dt64Time))
+    print('Results agree = %s, round trip = %s, datetime64 agrees = %s' % (agree, roundTrip, sameAsDatetime))
+    sys.exit(0 if (agree and roundTrip) else 1)
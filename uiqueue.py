@@ -0,0 +1,115 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# Matplotlib artists are not thread safe. Changing them from a device thread,
+# while the main thread is drawing, can fail with errors like
+# "RuntimeError: dictionary changed size during iteration".
+#
+# UiQueue lets other threads post updates, which are run on the main thread
+# by a canvas timer. Updates are keyed, so if several updates with the same
+# key arrive within one frame, only the newest is run. After each frame's
+# updates have run, the canvas is redrawn once, at most.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import sys
+import threading
+from collections import OrderedDict
+from traceback import print_exc
+
+# Milliseconds between checks of the queue
+DEFAULT_INTERVAL = 50
+
+
+class UiQueue(object):
+    """A queue of updates to be run on the main (GUI) thread.
+
+    Call start() from the main thread, once the figure exists. Then any
+    thread may call post() or requestDraw().
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._drawRequested = False
+        self._serial = 0
+        self._canvas = None
+        self._timer = None
+
+    def start(self, canvas):
+        self._canvas = canvas
+        self._timer = canvas.new_timer(interval=self.interval)
+        self._timer.add_callback(self.process)
+        self._timer.start()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        with self._lock:
+            self._pending.clear()
+            self._drawRequested = False
+
+    def post(self, key, func, *args):
+        """Run func(*args) on the main thread.
+
+        Args:
+            key: updates with the same key replace any still waiting, so
+                 only the newest is run. With a key of None, the update
+                 is always run.
+            func: the function to run. Its result is ignored.
+        """
+        with self._lock:
+            if key is None:
+                self._serial += 1
+                key = ('unkeyed', self._serial)
+            else:
+                # Replace, and move to the end, so updates stay in posting order
+                self._pending.pop(key, None)
+            self._pending[key] = (func, args)
+
+    def requestDraw(self):
+        """Redraw the canvas on the main thread, at the end of the next frame"""
+        with self._lock:
+            self._drawRequested = True
+
+    def process(self):
+        """Run all waiting updates, then redraw once if anything changed.
+        This is called by the timer, on the main thread."""
+        with self._lock:
+            pending = self._pending
+            self._pending = OrderedDict()
+            drawRequested = self._drawRequested
+            self._drawRequested = False
+
+        for (key, (func, args)) in pending.items():
+            try:
+                func(*args)
+            except Exception as e:
+                print('UiQueue.process() : update', key, 'failed :', e)
+                print_exc()
+                if sys.version_info < (3, 0):
+                    sys.exc_clear()
+
+        if (pending or drawRequested) and (self._canvas is not None):
+            self._canvas.draw_idle()
@@ -32,6 +32,8 @@
 # routine has been greatly simplified, eliminating the need for
 # linux_find_usbserial() and osx_find_usbserial(). The updates make
 # this file usable under both python2.7.* and python3.*.
+#   The find_all_usbserial() and usb_hotplug_observer() routines have
+# been added.
 #
 #########################################################################
 
@@ -91,6 +93,22 @@ def find_usbserial(vendor, product):
     Returns:
        String, like /dev/ttyACM0 or /dev/tty.usb...
     """
+    devices = find_all_usbserial(vendor, product)
+    if devices:
+        return devices[0]
+    return None
+
+def find_all_usbserial(vendor, product):
+    """Find the tty devices for all attached usbserial devices with the
+    given identifiers.
+
+    Args:
+       vendor: (int) something like 0x0000
+       product: (int) something like 0x0000
+
+    Returns:
+       A list of Strings, like ['/dev/ttyACM0', '/dev/ttyACM1']
+    """
     if platform.system() == 'Linux':
         pass
     elif platform.system() == 'Darwin':
@@ -105,15 +123,66 @@ def find_usbserial(vendor, product):
             # If the Dexcom device is plugged in, it will be mapped to COM33 or greater.
             # We have no way of identifying which port >= COM33 is the right one, so
             # we'll just guess the first available one.
-            return "\\\\.\\com33"
+            return ["\\\\.\\com33"]
         else:
             pass
     else:
         raise NotImplementedError('Cannot find serial ports on %s' % platform.system())
 
     # Linux, OSX, or non-Wine Windows
+    devices = []
     for cport in serial.tools.list_ports.comports():
         if (cport.vid == vendor) and (cport.pid == product):
             if cport.device is not None:
-              return cport.device
-    return None
+                devices.append(cport.device)
+    return devices
+
+def usb_hotplug_observer(vendor, product, callback):
+    """Watch for a usbserial device being attached or removed.
+
+    This relies on udev, so it is only available on Linux systems which
+    have the optional pyudev package installed. Callers should fall back
+    to polling find_usbserial() when no observer can be created.
+
+    Args:
+       vendor: (int) something like 0x0000
+       product: (int) something like 0x0000
+       callback: function called as callback(action, device_node), where
+                 action is 'add' or 'remove'. This runs on the observer's
+                 own thread.
+
+    Returns:
+       A started observer, with a stop() method, or None if hotplug
+       notifications are not available.
+    """
+    if platform.system() != 'Linux':
+        return None
+    try:
+        import pyudev
+    except ImportError:
+        if sys.version_info < (3, 0):
+            sys.exc_clear()
+        return None
+
+    vendorId = '%04x' % vendor
+    productId = '%04x' % product
+
+    def handleEvent(device):
+        if device.action not in ('add', 'remove'):
+            return
+        if (device.get('ID_VENDOR_ID') == vendorId) and (device.get('ID_MODEL_ID') == productId):
+            callback(device.action, device.device_node)
+
+    try:
+        context = pyudev.Context()
+        monitor = pyudev.Monitor.from_netlink(context)
+        monitor.filter_by(subsystem='tty')
+        observer = pyudev.MonitorObserver(monitor, callback=handleEvent, name='usb-hotplug')
+        observer.daemon = True
+        observer.start()
+    except Exception as e:
+        #print ('usb_hotplug_observer() : Exception =', e)
+        if sys.version_info < (3, 0):
+            sys.exc_clear()
+        return None
+    return observer
@@ -0,0 +1,230 @@
+###############################################################################
+#    Copyright 2018 Steve Erlenborn
+###############################################################################
+#    This file is part of DexcTrack.
+#
+#    DexcTrack is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    DexcTrack is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+#
+# Dragging the legend or an annotation, or moving the scale slider, used
+# to open the database, write and commit on the GUI thread, for every
+# change. WriteBehind queues those writes instead, and runs them on a
+# worker thread, once the changes have paused for a moment.
+#
+# Writes are keyed, like UiQueue updates. A write replaces any waiting
+# write with the same key, so a slider moved through twenty positions
+# leads to just one write of the Config row. All of the waiting writes
+# for a database are made in a single transaction.
+#
+###############################################################################
+
+# Support python3 print syntax in python2
+from __future__ import print_function
+
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from traceback import print_exc
+
+# Seconds without a new write before the waiting writes are made
+DEFAULT_DELAY = 0.5
+# Longest time a write may wait, while new writes keep arriving
+DEFAULT_MAX_DELAY = 3.0
+
+
+class WriteBehind(object):
+    """A debounced queue of database writes, made on a worker thread.
+
+    Args:
+        delay: seconds to wait after the latest write is posted
+        maxDelay: most seconds to wait after the oldest waiting write
+        onFlushed: optional callback(dbPath, keys), called on the writing
+                   thread after the writes to a database have been
+                   committed, with the keys of those writes
+    """
+
+    def __init__(self, delay=DEFAULT_DELAY, maxDelay=DEFAULT_MAX_DELAY, onFlushed=None):
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self.onFlushed = onFlushed
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # Held while writing, so flush() and the worker take turns
+        self._writeLock = threading.Lock()
+        self._pending = OrderedDict()   # (dbPath, key) -> (func, args)
+        self._firstPostTime = None
+        self._lastPostTime = None
+        self._thread = None
+        self._stopping = False
+
+    def post(self, dbPath, key, func, *args):
+        """Queue func(curs, *args) to write to dbPath.
+
+        func must only use the values it's given, since it runs on another
+        thread. Read anything from matplotlib before posting. Once stop()
+        has been called, there's no worker, so the write is made at once,
+        on the calling thread.
+        """
+        with self._lock:
+            stopped = self._stopping
+        if stopped:
+            with self._writeLock:
+                self._write(OrderedDict([((dbPath, key), (func, args))]))
+            return
+        with self._lock:
+            now = time.time()
+            self._pending.pop((dbPath, key), None)
+            self._pending[(dbPath, key)] = (func, args)
+            if self._firstPostTime is None:
+                self._firstPostTime = now
+            self._lastPostTime = now
+            if (self._thread is None) and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name='WriteBehind')
+                self._thread.daemon = True
+                self._thread.start()
+            self._wake.notify()
+
+    def flush(self):
+        """Make all waiting writes now, on the calling thread"""
+        with self._writeLock:
+            with self._lock:
+                pending = self._pending
+                self._pending = OrderedDict()
+                self._firstPostTime = None
+                self._lastPostTime = None
+            self._write(pending)
+
+    def stop(self):
+        """Stop the worker, then make any waiting writes"""
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while True:
+                    if self._stopping:
+                        return
+                    if self._pending:
+                        deadline = min(self._lastPostTime + self.delay,
+                                       self._firstPostTime + self.maxDelay)
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._wake.wait(remaining)
+                    else:
+                        self._wake.wait()
+            self.flush()
+
+    def _write(self, pending):
+        # Group the writes by database, keeping the order they were posted in
+        byDb = OrderedDict()
+        for ((dbPath, key), (func, args)) in pending.items():
+            byDb.setdefault(dbPath, []).append((key, func, args))
+
+        for (dbPath, writes) in byDb.items():
+            conn = sqlite3.connect(dbPath)
+            try:
+                curs = conn.cursor()
+                for (key, func, args) in writes:
+                    func(curs, *args)
+                curs.close()
+                conn.commit()
+            except sqlite3.Error as e:
+                print('WriteBehind : Rolling back', len(writes), 'writes to', dbPath, 'due to exception =', e)
+                conn.rollback()
+                if sys.version_info < (3, 0):
+                    sys.exc_clear()
+                continue
+            finally:
+                conn.close()
+
+            if self.onFlushed is not None:
+                try:
+                    self.onFlushed(dbPath, [key for (key, func, args) in writes])
+                except Exception as e:
+                    print('WriteBehind : onFlushed callback failed :', e)
+                    print_exc()
+                    if sys.version_info < (3, 0):
+                        sys.exc_clear()
+
+
+if __name__ == '__main__':
+    # Post 200 scale changes and 200 moves of one annotation, as a slider
+    # or drag would, and compare against writing each one immediately.
+    import os
+    import tempfile
+
+    def writeScale(curs, scale):
+        curs.execute('INSERT OR REPLACE INTO Config (id, scale) VALUES (0, ?);', (scale,))
+
+    def writeOffset(curs, secs, xoff, yoff):
+        curs.execute('UPDATE UserNote SET xoffset=?, yoffset=? WHERE sysSeconds=?;', (xoff, yoff, secs))
+
+    (fd, dbPath) = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    conn = sqlite3.connect(dbPath)
+    conn.execute('CREATE TABLE Config (id INTEGER PRIMARY KEY, scale REAL);')
+    conn.execute('CREATE TABLE UserNote (sysSeconds INT PRIMARY KEY, message TEXT, xoffset REAL, yoffset REAL);')
+    conn.execute("INSERT INTO UserNote VALUES (1000, 'note', 0.0, 0.0);")
+    conn.commit()
+
+    startTime = time.time()
+    for i in range(200):
+        writeScale(conn.cursor(), float(i))
+        conn.commit()
+        writeOffset(conn.cursor(), 1000, float(i), float(i))
+        conn.commit()
+    directTime = time.time() - startTime
+
+    flushes = []
+    writer = WriteBehind(delay=0.2, onFlushed=lambda dbPath, keys: flushes.append(keys))
+    startTime = time.time()
+    for i in range(200):
+        writer.post(dbPath, ('Config',), writeScale, float(i) + 0.5)
+        writer.post(dbPath, ('UserNote', 1000), writeOffset, 1000, float(i) + 0.5, 1.0)
+    postTime = time.time() - startTime
+    time.sleep(0.5)
+    writer.stop()
+
+    curs = conn.cursor()
+    curs.execute('SELECT scale FROM Config WHERE id=0')
+    scale = curs.fetchone()[0]
+    curs.execute('SELECT xoffset FROM UserNote WHERE sysSeconds=1000')
+    xoffset = curs.fetchone()[0]
+    flushCount = len(flushes)
+
+    # After stop(), a write is made before post() returns
+    writer.post(dbPath, ('Config',), writeScale, 500.0)
+    curs.execute('SELECT scale FROM Config WHERE id=0')
+    lateScale = curs.fetchone()[0]
+    conn.close()
+    os.remove(dbPath)
+
+    ok = (scale == 199.5) and (xoffset == 199.5) and (flushCount == 1) and \
+         (flushes[0] == [('Config',), ('UserNote', 1000)])
+    print('400 writes : committed one at a time %.4f s, posted %.4f s, flushes = %d' %
+          (directTime, postTime, flushCount))
+    print('Final scale = %s, xoffset = %s : %s' % (scale, xoffset, 'OK' if ok else 'FAILED'))
+    lateOk = (lateScale == 500.0)
+    print('Write posted after stop() = %s : %s' % (lateScale, 'OK' if lateOk else 'FAILED'))
+    sys.exit(0 if ok and lateOk else 1)